@@ -6,11 +6,8 @@ set -e
 # Navigate to the src directory
 cd src
 
-# Execute commands in order
-sh period0.sh
-uv run period0.py
-uv run period2.py
-uv run period3.py
+# Every chain's stages, in dependency order, as far as resources allow
+uv run pipeline.py
 
 echo "All commands executed successfully!"
 
@@ -1,10 +1,22 @@
 import polars as pl
-import requests
 import json
-from utils import Provider
+import asyncio
+import os
+import sys
+import dataclasses
+import dataset
+from registry import CHAIN_IDS
+from metrics import METRICS, run_metrics
+from traces import TraceCache
+from utils import AddressSet, AsyncRpcClient, Provider, RpcError, as_address_bytes
 from web3 import Web3
 from tqdm import tqdm
 import multiprocessing
+# traces are large, so fewer per JSON-RPC batch than the provider default;
+# in-flight requests are bounded by max_in_flight_<chain> from config.json
+TRACE_BATCH_SIZE = 10
+TRACE_CHUNK = 1000
+PARSE_WORKERS = 4
 FUNCTION_MAP = {
     "0xa9059cbb": "erc20_transfer",
     "0x23b872dd": "erc20_transferFrom",
@@ -24,73 +36,111 @@ FUNCTION_MAP = {
     "0xdd62ed3e": "allowance",
     "0xfa461e33": "uniswapV3SwapCallback",
 }
-adig = set(map(lambda x: x.lower(), pl.read_parquet("../arbitrum_pools.parquet")["pool_address"].to_list())).union(set(map(lambda x: x.lower(), pl.read_parquet("../arbitrum_tokens.parquet")["contract_address"].to_list())))
-ARBITRUM_DEBUG_RPC = Provider.generate().arbitrum_rpc
+# set per worker by init_worker; pools and tokens of the chain being traced
+IGNORE = AddressSet()
 
-def flatten_data(y):
-    out = {}
-    def flatten(x, name=''):
-        if type(x) is dict:
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif type(x) is list:
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + '_')
-                i += 1
-        else:
-            out[name[:-1]] = x
-    flatten(y)
-    return out
-def main2(tx_hash):
-    TX_HASH = tx_hash
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "debug_traceTransaction",
-        "params": [TX_HASH, {"tracer": "callTracer"}],
-        "id": 1
-    }
-    response = requests.post(ARBITRUM_DEBUG_RPC, json=payload).json()
-    d = flatten_data(response)
-    address_to_associated_sig = dict() 
-    for x in d.keys():
-        if "input" in x:
-            sel = d[x][:10]
-            a1 = d[x[:-5]+"from"]
-            a2 = d[x[:-5]+"to"]
-            v1 = address_to_associated_sig.get(a1,set())
-            v1.add(sel)
-            v2 = address_to_associated_sig.get(a2,set())
-            v2.add(sel)
-            address_to_associated_sig[a1] = v1
-            address_to_associated_sig[a2] = v2
-    additional_addresses_to_ignore = set()
-    for x in address_to_associated_sig.keys():
-        if len(address_to_associated_sig[x] - set(FUNCTION_MAP.keys())) == 0:
-            additional_addresses_to_ignore.add(x.lower())
-    additional_addresses_to_ignore = adig.union(additional_addresses_to_ignore)
-    filtered_out = set()
-    for x in d.keys():
-        if x[-3:] == "_to":
-            ff = x[:-3] + "_from"
-            if d[ff] == None or d[x] == None: continue
-            to_check = set([d[ff].lower(),d[x].lower()])
-            if len(to_check.intersection(additional_addresses_to_ignore)) == 0:
-                filtered_out.add(x[:-3])
+def load_ignore_set(chain):
+    # next to the mev files when run by pipeline.py from src/, one level up otherwise
+    root = "." if os.path.exists(f"{chain}_pools.parquet") else ".."
+    pools = as_address_bytes(pl.scan_parquet(f"{root}/{chain}_pools.parquet").select(pl.col("pool_address").alias("address")), ["address"])
+    tokens = as_address_bytes(pl.scan_parquet(f"{root}/{chain}_tokens.parquet").select(pl.col("contract_address").alias("address")), ["address"])
+    return AddressSet.from_series(pl.concat([pools, tokens]).collect()["address"])
 
+def init_worker(ignore):
+    global IGNORE
+    IGNORE = ignore
+
+def trace_endpoint(chain):
+    return dataclasses.replace(Provider.generate().endpoint(chain), batch_size=TRACE_BATCH_SIZE)
+
+async def fetch_chunk(client, cache, chain, chunk):
+    # only traces missing from the cache go to the node; failures are not cached
+    traces = cache.get_many(CHAIN_IDS[chain], chunk)
+    todo = [x for x in chunk if x not in traces]
+    METRICS.count("trace_cache_hits", len(traces))
+    fetched = await client.map([("debug_traceTransaction", [x, {"tracer": "callTracer"}]) for x in todo])
+    failed = sum(1 for t in fetched if isinstance(t, RpcError))
+    if failed > 0:
+        METRICS.count("trace_failures", failed)
+        print(f"{failed} of {len(todo)} traces failed")
+    ok = {x: t for (x, t) in zip(todo, fetched) if t is not None and not isinstance(t, RpcError)}
+    cache.put_many(CHAIN_IDS[chain], ok)
+    traces.update(ok)
+    return [traces.get(x) for x in chunk]
+
+async def trace_and_parse(tx_hashes, pool, cache, chain, endpoint):
+    # fetch chunk i+1 while the pool parses chunk i; at most 2 chunks wait for parsing
+    loop = asyncio.get_running_loop()
+    pending = []
+    results = []
+    async with AsyncRpcClient(endpoint) as client:
+        with tqdm(total=len(tx_hashes)) as progress:
+            for i in range(0, len(tx_hashes), TRACE_CHUNK):
+                chunk = tx_hashes[i:i + TRACE_CHUNK]
+                traces = await fetch_chunk(client, cache, chain, chunk)
+                pending.append((len(chunk), pool.starmap_async(main2, zip(chunk, traces))))
+                while len(pending) > 2 or (len(pending) > 0 and pending[0][1].ready()):
+                    (n, r) = pending.pop(0)
+                    results.extend(await loop.run_in_executor(None, r.get))
+                    progress.update(n)
+            for (n, r) in pending:
+                results.extend(await loop.run_in_executor(None, r.get))
+                progress.update(n)
+    return results
+
+def walk_calls(trace):
+    # iterative pre-order walk of the callTracer tree; path is the old flatten_data key
+    frames = []
+    selectors = dict()
+    stack = [(trace, "result", 0)]
+    while len(stack) > 0:
+        (call, path, depth) = stack.pop()
+        if "input" in call:
+            sel = call["input"][:10]
+            for a in (call.get("from"), call.get("to")):
+                if a is not None:
+                    selectors.setdefault(a, set()).add(sel)
+        if "to" in call:
+            frames.append((path, depth, call))
+        calls = call.get("calls") or []
+        for i in range(len(calls) - 1, -1, -1):
+            stack.append((calls[i], f"{path}_calls_{i}", depth + 1))
+    return frames, selectors
+
+def main2(tx_hash, trace):
+    if trace is None or isinstance(trace, RpcError):
+        return []
+    (frames, selectors) = walk_calls(trace)
+    known = set(FUNCTION_MAP.keys())
+    ignore = set(a.lower() for (a, sels) in selectors.items() if sels <= known)
     df = list()
-    for x in filtered_out:
-        v = {"tx_hash":TX_HASH,"flattened_trace": x, "to": d[x+"_to"], "from": d[x+"_from"], "function_selector":d[x+"_input"][:10], "gas_used":int(d[x+"_gasUsed"],16)}
-        df.append(v)
+    for (path, depth, call) in frames:
+        if call.get("from") is None or call["to"] is None:
+            continue
+        if call["from"].lower() in ignore or call["to"].lower() in ignore or call["from"] in IGNORE or call["to"] in IGNORE:
+            continue
+        gas_used = call.get("gasUsed")
+        df.append({"tx_hash": tx_hash, "flattened_trace": path, "depth": depth, "call_type": call.get("type"), "to": call["to"], "from": call["from"], "function_selector": (call.get("input") or "")[:10], "gas_used": None if gas_used is None else int(gas_used, 16)})
     return df
 
 if __name__ == "__main__":
-    num_cores = multiprocessing.cpu_count()  # Get number of CPU cores
-    print(f"Using {num_cores} cores")
-    df = pl.read_parquet("arbitrum_mev.parquet")["transaction_hash"].to_list()
-    
-    with multiprocessing.Pool(processes=num_cores) as pool:
-        results = list(tqdm(pool.imap(main2, df), total=len(df)))
+    # sqling.py [chain], arbitrum by default
+    chain = sys.argv[1] if len(sys.argv) > 1 else "arbitrum"
+    endpoint = trace_endpoint(chain)
+    num_cores = min(PARSE_WORKERS, multiprocessing.cpu_count())
+    print(f"Using {num_cores} cores, {endpoint.max_in_flight} requests in flight")
+    # the mev dataset sits next to the pools file, see load_ignore_set
+    root = "." if os.path.exists(dataset.DATASET_DIR) else ".."
+    df = dataset.scan_mev(chain, root=os.path.join(root, dataset.DATASET_DIR)).select("transaction_hash").collect()["transaction_hash"].unique(maintain_order=True).to_list()
+
+    ignore = load_ignore_set(chain)
+    print(f"Ignoring {len(ignore)} pool and token addresses")
+    cache = TraceCache()
+    with run_metrics("sqling", Provider.generate().profile), METRICS.stage("trace_and_parse") as stage:
+        with multiprocessing.Pool(num_cores, init_worker, (ignore,)) as pool:
+            results = asyncio.run(trace_and_parse(df, pool, cache, chain, endpoint))
+        stage.add(len(df))
+    cache.close()
     ret = list()
     for x in results:
         for y in x:
@@ -98,4 +148,4 @@ if __name__ == "__main__":
     
     dd = pl.DataFrame(ret)
     print(dd)
-    dd.write_parquet("interesting_traces_arb.parquet")
+    dd.write_parquet(f"interesting_traces_{chain[:3]}.parquet")
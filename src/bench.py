@@ -0,0 +1,328 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Optional
+import polars as pl
+from ingest import V2_TOPIC0, V3_TOPIC0
+
+CHAIN_ID = 42161
+STAGES = [
+    "process_log_v3",
+    "process_log_v2",
+    "bundle_analyze",
+    "detect_arbitrage",
+    "period3_summary",
+]
+RESULTS_FILE = "bench_results.jsonl"
+
+
+class SyntheticChain:
+    # cryo-shaped swap logs: random one to three hop trades plus closed 2-4 hop
+    # cycles whose intermediate legs cancel exactly, over a fixed token/pool set
+    def __init__(self, seed: int, n_tokens: int, n_pools: int, senders: int = 200):
+        self.r = random.Random(seed)
+        self.tokens = [self._address() for _ in range(n_tokens)]
+        self.decimals = [self.r.choice([6, 8, 18, 18, 18]) for _ in range(n_tokens)]
+        self.pools: List[tuple] = []
+        self.by_pair: Dict[frozenset, List[int]] = {}
+        for i in range(n_pools):
+            (a, b) = self.r.sample(range(n_tokens), 2)
+            self._add_pool(a, b, i % 2 == 0)
+        self.senders = [self._address() for _ in range(senders)]
+        self.v2: List[dict] = []
+        self.v3: List[dict] = []
+
+    def _address(self) -> bytes:
+        return self.r.getrandbits(160).to_bytes(20, "big")
+
+    def _add_pool(self, a: int, b: int, is_v3: bool) -> int:
+        self.pools.append((self._address(), a, b, is_v3))
+        self.by_pair.setdefault(frozenset((a, b)), []).append(len(self.pools) - 1)
+        return len(self.pools) - 1
+
+    def _pool_for(self, a: int, b: int) -> int:
+        pools = self.by_pair.get(frozenset((a, b)))
+        if pools is None:
+            return self._add_pool(a, b, self.r.random() < 0.5)
+        return self.r.choice(pools)
+
+    def _amount(self, token: int) -> int:
+        return self.r.randint(1, 10 ** (self.decimals[token] + 4))
+
+    def _swap(self, log: dict, pool: int, t_in: int, amount_in: int, amount_out: int):
+        (address, token0, _, is_v3) = self.pools[pool]
+        sell0 = t_in == token0
+        row = {
+            **log,
+            "address": address,
+            "topic0": V3_TOPIC0 if is_v3 else V2_TOPIC0,
+            "event__sender": self.r.choice(self.senders),
+        }
+        if is_v3:
+            (a0, a1) = (amount_in, -amount_out) if sell0 else (-amount_out, amount_in)
+            for name, value in (("amount0", a0), ("amount1", a1)):
+                row[f"event__{name}_f64"] = float(value)
+                row[f"event__{name}_string"] = str(value)
+            row["event__recipient"] = row["event__sender"]
+            row["event__sqrtPriceX96_f64"] = self.r.random() * 2**96
+            row["event__liquidity_f64"] = self.r.random() * 1e20
+            row["event__tick"] = self.r.randint(-887272, 887272)
+            self.v3.append(row)
+            return
+        values = {
+            "amount0In": amount_in if sell0 else 0,
+            "amount1In": 0 if sell0 else amount_in,
+            "amount0Out": 0 if sell0 else amount_out,
+            "amount1Out": amount_out if sell0 else 0,
+        }
+        for name, value in values.items():
+            row[f"event__{name}_f64"] = float(value)
+            row[f"event__{name}_string"] = str(value)
+        row["event__to"] = row["event__sender"]
+        self.v2.append(row)
+
+    def generate(self, n_swaps: int, arb_share: float, blocks_per_tx: float = 0.2):
+        block = 1_000_000
+        tx_index = 0
+        while len(self.v2) + len(self.v3) < n_swaps:
+            if self.r.random() < blocks_per_tx:
+                block = block + 1
+                tx_index = 0
+            tx_index = tx_index + 1
+            log = {
+                "block_number": block,
+                "transaction_index": tx_index,
+                "transaction_hash": self.r.getrandbits(256).to_bytes(32, "big"),
+                "chain_id": CHAIN_ID,
+            }
+            log_index = self.r.randint(0, 400)
+            if self.r.random() < arb_share:
+                cycle = self.r.sample(range(len(self.tokens)), self.r.randint(2, 4))
+                hops = list(zip(cycle, cycle[1:] + cycle[:1]))
+                start = self._amount(cycle[0])
+                amount = start
+                for n, (t_in, t_out) in enumerate(hops):
+                    out = (
+                        start + self.r.randint(1, start // 100 + 1)
+                        if n == len(hops) - 1
+                        else self._amount(t_out)
+                    )
+                    log_index = log_index + 1
+                    self._swap(
+                        {**log, "log_index": log_index},
+                        self._pool_for(t_in, t_out),
+                        t_in,
+                        amount,
+                        out,
+                    )
+                    amount = out
+                continue
+            for _ in range(self.r.randint(1, 3)):
+                pool = self.r.randrange(len(self.pools))
+                (_, a, b, _) = self.pools[pool]
+                (t_in, t_out) = (a, b) if self.r.random() < 0.5 else (b, a)
+                log_index = log_index + 1
+                self._swap(
+                    {**log, "log_index": log_index},
+                    pool,
+                    t_in,
+                    self._amount(t_in),
+                    self._amount(t_out),
+                )
+
+    def write(self, out: str, chain: str, chunk_blocks: int = 10_000):
+        os.makedirs(os.path.join(out, chain), exist_ok=True)
+        for version, rows in (("v2", self.v2), ("v3", self.v3)):
+            df = pl.DataFrame(rows).with_columns(
+                pl.col("block_number", "transaction_index", "log_index").cast(
+                    pl.UInt32
+                ),
+                pl.col("chain_id").cast(pl.UInt64),
+                *([pl.col("event__tick").cast(pl.Int32)] if version == "v3" else []),
+            )
+            df = df.with_columns(
+                (pl.col("block_number") // chunk_blocks * chunk_blocks).alias("chunk")
+            )
+            for (first,), part in df.group_by(["chunk"]):
+                last = first + chunk_blocks - 1
+                part.drop("chunk").write_parquet(
+                    os.path.join(
+                        out,
+                        chain,
+                        f"{chain}__logs__{version}_{chain}__{first:08d}_to_{last:08d}.parquet",
+                    )
+                )
+        pl.DataFrame(
+            {
+                "pool_address": [p[0] for p in self.pools],
+                "token0": [self.tokens[p[1]] for p in self.pools],
+                "token1": [self.tokens[p[2]] for p in self.pools],
+                "is_v3": [p[3] for p in self.pools],
+            }
+        ).write_parquet(os.path.join(out, f"{chain}_pools.parquet"))
+        pl.DataFrame(
+            {
+                "symbol": [f"TKN{i}" for i in range(len(self.tokens))],
+                "decimal": self.decimals,
+                "contract_address": self.tokens,
+            }
+        ).write_parquet(os.path.join(out, f"{chain}_tokens.parquet"))
+
+
+def generate_dataset(
+    out: str,
+    n_swaps: int,
+    n_tokens: int = 200,
+    n_pools: int = 1000,
+    arb_share: float = 0.3,
+    seed: int = 0,
+    chain: str = "arbitrum",
+) -> str:
+    data = SyntheticChain(seed, n_tokens, n_pools)
+    data.generate(n_swaps, arb_share)
+    data.write(out, chain)
+    return out
+
+
+def _status_kb(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak() -> bool:
+    # linux: writing 5 to clear_refs sets VmHWM back to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return _status_kb("VmHWM") is not None
+
+
+def _maxrss_kb() -> int:
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _run_stage(stage: str, data: str, chain: str) -> tuple[int, float, int]:
+    # inputs are loaded first; the memory reported is how far the timed section
+    # alone rose above the RSS it started from. Without /proc only the rise of
+    # the process peak is known, which undercounts stages that stay below the
+    # peak of loading
+    logging.disable(logging.INFO)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import period2
+    import period3
+
+    tokens = os.path.join(data, f"{chain}_tokens.parquet")
+    pools = os.path.join(data, f"{chain}_pools.parquet")
+    logs = os.path.join(data, chain, f"{chain}__logs__")
+    df2 = pl.read_parquet(logs + "v2*.parquet")
+    df3 = pl.read_parquet(logs + "v3*.parquet")
+    lookup = period2.build_pool_lookup(pl.read_parquet(tokens), pl.read_parquet(pools))
+    if stage == "bundle_analyze":
+        swaps = period2.swaps_from_frame(period2.enrich_swaps(df2, df3, lookup))
+    if stage == "period3_summary":
+        mev = period2.detect_arbitrage(period2.enrich_swaps(df2, df3, lookup))
+    gc.collect()
+    exact = _reset_peak()
+    before = _status_kb("VmRSS") if exact else _maxrss_kb()
+    start = time.perf_counter()
+    if stage == "process_log_v3":
+        rows = len(period2.SwapV3.process_log_v3(df3, tokens, pools))
+    elif stage == "process_log_v2":
+        rows = len(period2.SwapV2.process_log_v2(df2, tokens, pools))
+    elif stage == "bundle_analyze":
+        for tx in period2.Transaction.bundle_swaps(swaps):
+            tx.analyze()
+        rows = len(swaps)
+    elif stage == "detect_arbitrage":
+        period2.detect_arbitrage(period2.enrich_swaps(df2, df3, lookup))
+        rows = df2.shape[0] + df3.shape[0]
+    elif stage == "period3_summary":
+        period3.summarize_senders(mev)
+        rows = mev.shape[0]
+    else:
+        raise ValueError(f"unknown stage {stage}")
+    seconds = time.perf_counter() - start
+    after = _status_kb("VmHWM") if exact else _maxrss_kb()
+    return (rows, seconds, max(0, after - before))
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(scales: List[int], stages: List[str], data_root: str, results: str, seed: int):
+    commit = _commit()
+    for scale in scales:
+        data = os.path.join(data_root, f"{scale}_{seed}")
+        if not os.path.isdir(data):
+            logging.info(f"Generating {scale} swaps into {data}!!!")
+            generate_dataset(data, scale, seed=seed)
+        for stage in stages:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                (rows, seconds, stage_kb) = pool.submit(
+                    _run_stage, stage, data, "arbitrum"
+                ).result()
+            record = {
+                "time": int(time.time()),
+                "commit": commit,
+                "stage": stage,
+                "scale": scale,
+                "seed": seed,
+                "rows": rows,
+                "seconds": round(seconds, 4),
+                "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+                "stage_rss_mb": round(stage_kb / 1024, 1),
+                "python": platform.python_version(),
+                "polars": pl.__version__,
+            }
+            logging.info(json.dumps(record))
+            with open(results, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline stages on synthetic cryo data"
+    )
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--data", default="bench_data")
+    parser.add_argument("--out", default=RESULTS_FILE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.scales, args.stages, args.data, args.out, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import glob
+import logging
+import os
+import time
+from typing import List
+import polars as pl
+from web3 import Web3
+from registry import CHAIN_IDS
+from utils import RpcEndpoint, RpcError, as_address_bytes, rpc_map
+
+CODE_SCHEMA = {"code_hash": pl.String, "code_size": pl.Int64, "bytecode": pl.Binary}
+ADDRESS_SCHEMA = {
+    "chain_id": pl.Int64,
+    "address": pl.Binary,
+    "block_number": pl.Int64,
+    "code_hash": pl.String,
+}
+
+
+class BytecodeStore:
+    # content-addressed: code/ holds every distinct bytecode once, keyed by its
+    # keccak hash, addresses/ maps (chain_id, address, block) -> code_hash
+    def __init__(self, root: str = "bytecode_store"):
+        self.root = root
+
+    def _scan(self, kind: str, schema) -> pl.LazyFrame:
+        files = sorted(glob.glob(os.path.join(self.root, kind, "*.parquet")))
+        if len(files) == 0:
+            return pl.LazyFrame(schema=schema)
+        if kind == "code":
+            return pl.scan_parquet(files)
+        # address segments written before addresses were binary hold checksums
+        return pl.concat(
+            [as_address_bytes(pl.scan_parquet(f), ["address"]) for f in files]
+        )
+
+    def _write(self, kind: str, df: pl.DataFrame):
+        if df.shape[0] == 0:
+            return
+        os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        segment = os.path.join(self.root, kind, f"{time.time_ns()}.parquet")
+        tmp = f"{segment}.tmp"
+        df.write_parquet(tmp)
+        os.replace(tmp, segment)
+
+    def codes(self) -> pl.LazyFrame:
+        return self._scan("code", CODE_SCHEMA)
+
+    def code(self, code_hash: str) -> bytes:
+        df = self.codes().filter(pl.col("code_hash") == code_hash).head(1).collect()
+        if df.shape[0] == 0:
+            raise KeyError(code_hash)
+        return df["bytecode"][0]
+
+    def addresses(self, chain: str) -> pl.DataFrame:
+        return (
+            self._scan("addresses", ADDRESS_SCHEMA)
+            .filter(pl.col("chain_id") == CHAIN_IDS[chain])
+            .unique(["address", "block_number"], keep="first")
+            .join(self.codes().select("code_hash", "code_size"), on="code_hash")
+            .select("address", "block_number", "code_hash", "code_size")
+            .collect()
+        )
+
+    def add(self, chain: str, fetched: pl.DataFrame):
+        # fetched: address, block_number, bytecode
+        hashed = fetched.with_columns(
+            pl.col("bytecode")
+            .map_elements(lambda x: Web3.to_hex(Web3.keccak(x)), return_dtype=pl.String)
+            .alias("code_hash"),
+            pl.col("bytecode").bin.size().cast(pl.Int64).alias("code_size"),
+        )
+        known = self.codes().select("code_hash").collect()
+        self._write(
+            "code",
+            hashed.unique("code_hash", keep="first")
+            .join(known, on="code_hash", how="anti")
+            .select(list(CODE_SCHEMA.keys())),
+        )
+        self._write(
+            "addresses",
+            hashed.with_columns(pl.lit(CHAIN_IDS[chain]).alias("chain_id")).select(
+                [pl.col(k).cast(v) for (k, v) in ADDRESS_SCHEMA.items()]
+            ),
+        )
+
+
+def _latest(store: BytecodeStore, chain: str, wanted: pl.DataFrame) -> pl.DataFrame:
+    # newest stored code of each address at or before the wanted block, with the
+    # block it was stored for
+    stored = store.addresses(chain).rename({"block_number": "stored_block"})
+    return (
+        wanted.with_row_index("row")
+        .sort("block_number")
+        .join_asof(
+            stored.sort("stored_block"),
+            left_on="block_number",
+            right_on="stored_block",
+            by="address",
+            strategy="backward",
+        )
+        .sort("row")
+        .drop("row")
+    )
+
+
+def fetch_code_hashes(
+    store: BytecodeStore,
+    chain: str,
+    addresses: List[bytes],
+    blocks: List[int],
+    endpoint: RpcEndpoint,
+) -> pl.DataFrame:
+    # code of each address at the given block; contract code stored for any
+    # earlier block is reused, as EIP-6780 leaves SELFDESTRUCT unable to remove
+    # it, while an address without code then may have been deployed to since;
+    # an empty code stored for the wanted block itself is final
+    wanted = pl.DataFrame(
+        {"address": addresses, "block_number": blocks},
+        schema={"address": pl.Binary, "block_number": pl.Int64},
+    )
+    todo = _latest(store, chain, wanted).filter(
+        pl.col("code_hash").is_null()
+        | (
+            (pl.col("code_size") == 0)
+            & (pl.col("stored_block") < pl.col("block_number"))
+        )
+    )
+    logging.info(f"Fetching code of {todo.shape[0]} of {wanted.shape[0]} addresses!!!")
+    calls = [
+        ("eth_getCode", ["0x" + a.hex(), hex(b)])
+        for (a, b) in zip(todo["address"], todo["block_number"])
+    ]
+    fetched = []
+    for address, block, code in zip(
+        todo["address"], todo["block_number"], rpc_map(endpoint, calls)
+    ):
+        if isinstance(code, RpcError) or code is None:
+            logging.warning(f"Failed to fetch code of 0x{address.hex()}: {code}")
+            continue
+        fetched.append((address, block, bytes.fromhex(code[2:])))
+    store.add(
+        chain,
+        pl.DataFrame(
+            fetched,
+            schema={
+                "address": pl.Binary,
+                "block_number": pl.Int64,
+                "bytecode": pl.Binary,
+            },
+            orient="row",
+        ),
+    )
+    return _latest(store, chain, wanted).drop("stored_block")
@@ -0,0 +1,165 @@
+import argparse
+import glob
+import logging
+import os
+import re
+from typing import Dict, List, Optional, Union
+import polars as pl
+from manifest import Manifest
+
+# mev/chain={chain}/bucket={first block of the bucket}/part-{low}-{high}.parquet;
+# a window never crosses a bucket, so a block range maps to whole directories
+DATASET_DIR = "mev"
+BUCKET_BLOCKS = 1_000_000
+ROW_GROUP_ROWS = 64_000
+PART = re.compile(r"part-(\d+)-(\d+)\.parquet$")
+HIVE_SCHEMA = {"chain": pl.String, "bucket": pl.Int64}
+
+MEV_SCHEMA = {
+    "transaction_hash": pl.String,
+    "block_number": pl.Int64,
+    "transaction_index": pl.Int64,
+    "profit_token": pl.String,
+    "profit_amount": pl.Float64,
+    "path": pl.String,
+    "senders": pl.List(pl.Binary),
+}
+
+
+def bucket_of(block: int) -> int:
+    return block // BUCKET_BLOCKS * BUCKET_BLOCKS
+
+
+def split_buckets(low: int, high: int) -> List[tuple[int, int]]:
+    ret = []
+    while low < high:
+        end = min(high, bucket_of(low) + BUCKET_BLOCKS)
+        ret.append((low, end))
+        low = end
+    return ret
+
+
+def window_file(chain: str, low: int, high: int, root: str = DATASET_DIR) -> str:
+    return os.path.join(
+        root, f"chain={chain}", f"bucket={bucket_of(low)}", f"part-{low}-{high}.parquet"
+    )
+
+
+def file_range(file: str) -> Optional[tuple[int, int]]:
+    m = PART.search(file)
+    return None if m is None else (int(m[1]), int(m[2]))
+
+
+def write_window(df: Union[pl.DataFrame, pl.LazyFrame], file: str):
+    # sorted by block so row-group statistics prune block filters; polars
+    # dictionary-encodes the repetitive symbol and path strings on its own
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp = f"{file}.tmp"
+    df.lazy().sort(["block_number", "transaction_index"]).sink_parquet(
+        tmp, row_group_size=ROW_GROUP_ROWS, statistics="full"
+    )
+    os.replace(tmp, file)
+
+
+def chains(root: str = DATASET_DIR) -> List[str]:
+    dirs = glob.glob(os.path.join(root, "chain=*"))
+    return sorted(os.path.basename(d).split("=", 1)[1] for d in dirs)
+
+
+def mev_files(
+    chain: str,
+    low: Optional[int] = None,
+    high: Optional[int] = None,
+    root: str = DATASET_DIR,
+) -> List[str]:
+    # buckets, then files, outside [low, high) are skipped by name alone
+    ret = []
+    for d in glob.glob(os.path.join(root, f"chain={chain}", "bucket=*")):
+        bucket = int(os.path.basename(d).split("=", 1)[1])
+        if high is not None and bucket >= high:
+            continue
+        if low is not None and bucket + BUCKET_BLOCKS <= low:
+            continue
+        for f in glob.glob(os.path.join(d, "part-*.parquet")):
+            r = file_range(f)
+            if r is None:
+                continue
+            if (high is None or r[0] < high) and (low is None or r[1] > low):
+                ret.append((r, f))
+    return [f for (_, f) in sorted(ret)]
+
+
+def scan_mev(
+    chain: Optional[str] = None,
+    low: Optional[int] = None,
+    high: Optional[int] = None,
+    root: str = DATASET_DIR,
+) -> pl.LazyFrame:
+    # mev rows of one chain, or all, in [low, high), with chain and bucket
+    # columns from the partition path
+    files = [
+        f
+        for c in ([chain] if chain else chains(root))
+        for f in mev_files(c, low, high, root)
+    ]
+    if len(files) == 0:
+        return pl.LazyFrame(schema={**MEV_SCHEMA, **HIVE_SCHEMA})
+    lf = pl.scan_parquet(files, hive_partitioning=True, hive_schema=HIVE_SCHEMA)
+    if low is not None:
+        lf = lf.filter(pl.col("block_number") >= low)
+    if high is not None:
+        lf = lf.filter(pl.col("block_number") < high)
+    return lf
+
+
+def compact(chain: str, manifest: Manifest, root: str = DATASET_DIR) -> int:
+    # contiguous windows of one bucket become one file and one manifest entry,
+    # keeping the input fingerprints they were recorded with; windows whose
+    # inputs change later are then recomputed together
+    merged = 0
+    for stage in ("swaps", "swaps_exact"):
+        buckets: Dict[int, List[Dict]] = {}
+        for e in manifest.entries_for(stage, chain):
+            outputs = e["outputs"]
+            if len(outputs) != 1 or not outputs[0].startswith(root + os.sep):
+                continue
+            if not os.path.exists(outputs[0]):
+                continue
+            buckets.setdefault(bucket_of(e["low"]), []).append(e)
+        for entries in buckets.values():
+            entries.sort(key=lambda e: e["low"])
+            runs = [[entries[0]]]
+            for e in entries[1:]:
+                if e["low"] == runs[-1][-1]["high"]:
+                    runs[-1].append(e)
+                else:
+                    runs.append([e])
+            for run in runs:
+                if len(run) < 2:
+                    continue
+                file = window_file(chain, run[0]["low"], run[-1]["high"], root)
+                write_window(pl.scan_parquet([e["outputs"][0] for e in run]), file)
+                manifest.merge(run, [file])
+                merged = merged + len(run)
+    return merged
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Maintain the mev output dataset")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compact_cmd = sub.add_parser(
+        "compact", help="merge contiguous windows into one file per run"
+    )
+    compact_cmd.add_argument("chains", nargs="*")
+    args = parser.parse_args()
+    manifest = Manifest()
+    for chain in args.chains or chains():
+        merged = compact(chain, manifest)
+        logging.info(f"Compacted {merged} windows of {chain}!!!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import bisect
+import glob
+import hashlib
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import polars as pl
+from aiohttp import web
+from eth_abi import decode, encode
+from ingest import V3_TOPIC0
+from registry import CHAIN_IDS
+from utils import as_address_bytes
+
+MULTICALL3 = bytes.fromhex("cA11bde05977b3631167028862bE2a173976CA11")
+AGGREGATE3 = bytes.fromhex("82ad56cb")
+TOKEN0 = bytes.fromhex("0dfe1681")
+TOKEN1 = bytes.fromhex("d21220a7")
+SYMBOL = bytes.fromhex("95d89b41")
+DECIMALS = bytes.fromhex("313ce567")
+V2_SWAP = "0x022c0d9f"
+V3_SWAP = "0x128acb08"
+TRANSFER = "0xa9059cbb"
+V2_AMOUNTS = ["amount0In", "amount1In", "amount0Out", "amount1Out"]
+V3_AMOUNTS = ["amount0", "amount1"]
+
+
+@dataclass
+class Faults:
+    # per HTTP request: latency_ms plus up to jitter_ms, a 503 with probability
+    # error_rate and a 429 once rate_limit requests/s is exceeded; each call in
+    # a request fails on its own with probability call_error_rate; with
+    # block_time the head advances one block per block_time seconds, and every
+    # reorg_every blocks the last reorg_depth blocks are first served with only
+    # half their logs, then replaced once the head reaches the next multiple
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    rate_limit: float = 0.0
+    error_rate: float = 0.0
+    call_error_rate: float = 0.0
+    max_logs: int = 10_000
+    seed: int = 0
+    block_time: float = 0.0
+    reorg_every: int = 0
+    reorg_depth: int = 3
+
+
+def _word(value: int) -> str:
+    return (value % 2**256).to_bytes(32, "big").hex()
+
+
+def _amount(row: dict, name: str) -> int:
+    if row.get(f"event__{name}_string") is not None:
+        return int(row[f"event__{name}_string"])
+    return int(row[f"event__{name}_f64"])
+
+
+class Fixture:
+    # everything the node answers from: pools/tokens files and cryo log chunks,
+    # as written by period0 or by bench.generate_dataset
+    def __init__(self, data: str, chain: str):
+        self.chain_id = CHAIN_IDS[chain]
+        pools = as_address_bytes(
+            pl.read_parquet(os.path.join(data, f"{chain}_pools.parquet")),
+            ["pool_address", "token0", "token1"],
+        )
+        tokens = as_address_bytes(
+            pl.read_parquet(os.path.join(data, f"{chain}_tokens.parquet")),
+            ["contract_address"],
+        )
+        self.pools = {
+            p["pool_address"]: (p["token0"], p["token1"])
+            for p in pools.iter_rows(named=True)
+        }
+        self.tokens = {
+            t["contract_address"]: (t["symbol"], t["decimal"])
+            for t in tokens.iter_rows(named=True)
+        }
+        self.logs: List[dict] = []
+        self.txs: Dict[str, List[dict]] = {}
+        for f in sorted(glob.glob(os.path.join(data, chain, "*__logs__*.parquet"))):
+            for row in pl.read_parquet(f).iter_rows(named=True):
+                self._add_log(row)
+        self.logs.sort(key=lambda x: (x["_block"], int(x["logIndex"], 16)))
+        self.blocks = [x["_block"] for x in self.logs]
+
+    def _add_log(self, row: dict):
+        is_v3 = row["topic0"] == V3_TOPIC0
+        if is_v3:
+            words = [_amount(row, x) for x in V3_AMOUNTS] + [
+                _amount(row, "sqrtPriceX96"),
+                _amount(row, "liquidity"),
+                row["event__tick"],
+            ]
+            other = row["event__recipient"]
+        else:
+            words = [_amount(row, x) for x in V2_AMOUNTS]
+            other = row["event__to"]
+        log = {
+            "address": "0x" + row["address"].hex(),
+            "topics": [
+                "0x" + row["topic0"].hex(),
+                "0x" + row["event__sender"].rjust(32, b"\x00").hex(),
+                "0x" + other.rjust(32, b"\x00").hex(),
+            ],
+            "data": "0x" + "".join(_word(x) for x in words),
+            "blockNumber": hex(row["block_number"]),
+            "transactionHash": "0x" + row["transaction_hash"].hex(),
+            "transactionIndex": hex(row["transaction_index"]),
+            "logIndex": hex(row["log_index"]),
+            "removed": False,
+            "_block": row["block_number"],
+        }
+        self.logs.append(log)
+        self.txs.setdefault(log["transactionHash"], []).append(log)
+
+    def get_logs(self, query: dict) -> List[dict]:
+        low = int(query["fromBlock"], 16)
+        high = int(query["toBlock"], 16)
+        topics = query.get("topics") or [None]
+        wanted = topics[0]
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        ret = []
+        for log in self.logs[
+            bisect.bisect_left(self.blocks, low) : bisect.bisect_right(
+                self.blocks, high
+            )
+        ]:
+            if wanted is None or log["topics"][0] in wanted:
+                ret.append({k: v for (k, v) in log.items() if k != "_block"})
+        return ret
+
+    def call(self, to: bytes, data: bytes) -> Optional[bytes]:
+        # None reverts
+        selector = data[:4]
+        if to in self.pools and selector in (TOKEN0, TOKEN1):
+            token = self.pools[to][0 if selector == TOKEN0 else 1]
+            return encode(["address"], ["0x" + token.hex()])
+        if to in self.tokens and selector == SYMBOL:
+            return encode(["string"], [self.tokens[to][0]])
+        if to in self.tokens and selector == DECIMALS:
+            return encode(["uint8"], [self.tokens[to][1]])
+        return None
+
+    def aggregate3(self, data: bytes) -> Optional[bytes]:
+        (calls,) = decode(["(address,bool,bytes)[]"], data[4:])
+        results = []
+        for target, allow_failure, call_data in calls:
+            ret = self.call(bytes.fromhex(target[2:]), call_data)
+            if ret is None and not allow_failure:
+                return None
+            results.append((ret is not None, ret or b""))
+        return encode(["(bool,bytes)[]"], [results])
+
+    @staticmethod
+    def code(address: bytes) -> bytes:
+        # deterministic per address, a quarter of the addresses are EOAs
+        digest = hashlib.sha256(address).digest()
+        if digest[0] < 64:
+            return b""
+        return bytes.fromhex("6080604052") + digest * (1 + digest[1] % 8)
+
+    def trace(self, tx_hash: str) -> Optional[dict]:
+        # callTracer shape: sender -> bot -> one swap per log, each swap
+        # transferring a token back to the bot
+        logs = self.txs.get(tx_hash.lower())
+        if logs is None:
+            return None
+        sender = "0x" + logs[0]["topics"][1][-40:]
+        bot = "0x" + hashlib.sha256(sender.encode()).hexdigest()[:40]
+        calls = []
+        for log in logs:
+            pool = bytes.fromhex(log["address"][2:])
+            (token0, _) = self.pools.get(pool, (bytes(20), bytes(20)))
+            is_v3 = log["topics"][0] == "0x" + V3_TOPIC0.hex()
+            calls.append(
+                {
+                    "type": "CALL",
+                    "from": bot,
+                    "to": log["address"],
+                    "input": (V3_SWAP if is_v3 else V2_SWAP) + log["data"][2:130],
+                    "gasUsed": hex(60000 + int(log["logIndex"], 16)),
+                    "calls": [
+                        {
+                            "type": "CALL",
+                            "from": log["address"],
+                            "to": "0x" + token0.hex(),
+                            "input": TRANSFER + bot[2:].rjust(64, "0"),
+                            "gasUsed": hex(30000),
+                        }
+                    ],
+                }
+            )
+        return {
+            "type": "CALL",
+            "from": sender,
+            "to": bot,
+            "input": "0x" + tx_hash[2:10],
+            "gasUsed": hex(21000 + 90000 * len(logs)),
+            "calls": calls,
+        }
+
+
+class FakeNode:
+    def __init__(self, fixture: Fixture, faults: Faults):
+        self.fixture = fixture
+        self.faults = faults
+        self.random = random.Random(faults.seed)
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.started = time.monotonic()
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "calls": 0,
+            "rate_limited": 0,
+            "http_errors": 0,
+            "call_errors": 0,
+        }
+
+    def _error(self, id: Any, code: int, message: str) -> dict:
+        return {"jsonrpc": "2.0", "id": id, "error": {"code": code, "message": message}}
+
+    def _head(self) -> int:
+        blocks = self.fixture.blocks
+        if len(blocks) == 0:
+            return 0
+        if self.faults.block_time <= 0:
+            return blocks[-1]
+        passed = int((time.monotonic() - self.started) / self.faults.block_time)
+        return min(blocks[0] + passed, blocks[-1])
+
+    def _orphaned(self, block: int, head: int) -> bool:
+        # the version of a block that the next reorg replaces
+        every = self.faults.reorg_every
+        if every <= 0:
+            return False
+        reorg_at = -(-block // every) * every
+        return reorg_at - block < self.faults.reorg_depth and head < reorg_at
+
+    def _block_hash(self, block: int, head: int) -> str:
+        key = f"{self.fixture.chain_id}:{block}:{self._orphaned(block, head)}"
+        return "0x" + hashlib.sha256(key.encode()).hexdigest()
+
+    def _get_logs(self, query: dict) -> List[dict]:
+        head = self._head()
+        ret = []
+        for log in self.fixture.get_logs(query):
+            block = int(log["blockNumber"], 16)
+            if block > head:
+                continue
+            if self._orphaned(block, head) and int(log["logIndex"], 16) % 2 == 1:
+                continue
+            ret.append({**log, "blockHash": self._block_hash(block, head)})
+        return ret
+
+    def _dispatch(self, method: str, params: list) -> Any:
+        fixture = self.fixture
+        if method == "eth_chainId":
+            return hex(fixture.chain_id)
+        if method == "eth_blockNumber":
+            return hex(self._head())
+        if method == "eth_call":
+            to = bytes.fromhex(params[0]["to"][2:])
+            data = bytes.fromhex(params[0].get("data", "0x")[2:])
+            ret = (
+                fixture.aggregate3(data)
+                if to == MULTICALL3 and data[:4] == AGGREGATE3
+                else fixture.call(to, data)
+            )
+            if ret is None:
+                raise ValueError((3, "execution reverted"))
+            return "0x" + ret.hex()
+        if method == "eth_getCode":
+            return "0x" + fixture.code(bytes.fromhex(params[0][2:])).hex()
+        if method == "eth_getLogs":
+            logs = self._get_logs(params[0])
+            if len(logs) > self.faults.max_logs:
+                raise ValueError(
+                    (-32005, f"query returned more than {self.faults.max_logs} results")
+                )
+            return logs
+        if method == "debug_traceTransaction":
+            trace = fixture.trace(params[0])
+            if trace is None:
+                raise ValueError((-32000, f"transaction {params[0]} not found"))
+            return trace
+        raise ValueError((-32601, f"the method {method} does not exist"))
+
+    def _answer(self, call: dict) -> dict:
+        self.stats["calls"] += 1
+        if self.random.random() < self.faults.call_error_rate:
+            self.stats["call_errors"] += 1
+            return self._error(call.get("id"), -32603, "injected error")
+        try:
+            result = self._dispatch(call["method"], call.get("params", []))
+        except ValueError as e:
+            return self._error(call.get("id"), *e.args[0])
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    def _rate_limited(self) -> bool:
+        if self.faults.rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            (self.window_start, self.window_requests) = (now, 0)
+        self.window_requests += 1
+        return self.window_requests > self.faults.rate_limit
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        delay = self.faults.latency_ms + self.random.random() * self.faults.jitter_ms
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self._rate_limited():
+            self.stats["rate_limited"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        if self.random.random() < self.faults.error_rate:
+            self.stats["http_errors"] += 1
+            return web.Response(status=503)
+        body = await request.json()
+        if isinstance(body, list):
+            return web.json_response([self._answer(x) for x in body])
+        return web.json_response(self._answer(body))
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=2**30)
+        app.router.add_post("/", self.handle)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+def serve(data: str, chain: str, faults: Faults, port: int):
+    logging.info(f"Serving {data} for {chain} on port {port}!!!")
+    web.run_app(
+        FakeNode(Fixture(data, chain), faults).app(),
+        host="127.0.0.1",
+        port=port,
+        print=None,
+        access_log=None,
+    )
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Local JSON-RPC node answering from fixture data"
+    )
+    parser.add_argument("data", help="directory with pools/tokens and log chunks")
+    parser.add_argument("--chain", default="arbitrum", choices=list(CHAIN_IDS.keys()))
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--call-error-rate", type=float, default=0.0)
+    parser.add_argument("--max-logs", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--block-time", type=float, default=0.0)
+    parser.add_argument("--reorg-every", type=int, default=0)
+    parser.add_argument("--reorg-depth", type=int, default=3)
+    args = parser.parse_args()
+    faults = Faults(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        call_error_rate=args.call_error_rate,
+        max_logs=args.max_logs,
+        seed=args.seed,
+        block_time=args.block_time,
+        reorg_every=args.reorg_every,
+        reorg_depth=args.reorg_depth,
+    )
+    serve(args.data, args.chain, faults, args.port)
+
+
+if __name__ == "__main__":
+    main()
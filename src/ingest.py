@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Tuple
+import polars as pl
+from manifest import merge_ranges, missing_ranges
+from metrics import METRICS, Progress, run_metrics
+from registry import CHAIN_IDS
+from utils import AsyncRpcClient, Provider, RpcEndpoint, RpcError
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+V2_TOPIC0 = bytes.fromhex(
+    "d78ad95fa46c994b6551d0da85fc275fe613ce37657fb8d5e3d130840159d822"
+)
+V3_TOPIC0 = bytes.fromhex(
+    "c42079f94a6350d7e6235f29174924f928cc2ac818eb64fed8004e115fbcca67"
+)
+TOPIC0 = {"v2": V2_TOPIC0, "v3": V3_TOPIC0}
+# chunks being fetched at once per chain; the decode of finished chunks runs in
+# worker processes meanwhile
+CHUNKS_IN_FLIGHT = 2
+# fragments of the errors nodes return when a getLogs range holds too much
+TOO_LARGE = (
+    "more than",
+    "too many",
+    "too large",
+    "limit exceeded",
+    "size exceeded",
+    "range too",
+    "exceeds max",
+    "query timeout",
+)
+
+LOG_SCHEMA = {
+    "block_number": pl.UInt32,
+    "transaction_index": pl.UInt32,
+    "log_index": pl.UInt32,
+    "transaction_hash": pl.Binary,
+    "address": pl.Binary,
+    "topic0": pl.Binary,
+    "topic1": pl.Binary,
+    "topic2": pl.Binary,
+    "topic3": pl.Binary,
+    "data": pl.Binary,
+    "n_data_bytes": pl.UInt32,
+    "chain_id": pl.UInt64,
+}
+
+
+def _u256_schema(name: str) -> Dict[str, pl.DataType]:
+    # same three representations as cryo's --u256-types binary string f64
+    return {
+        f"event__{name}_binary": pl.Binary,
+        f"event__{name}_string": pl.String,
+        f"event__{name}_f64": pl.Float64,
+    }
+
+
+V2_SCHEMA = {
+    **LOG_SCHEMA,
+    "event__sender": pl.Binary,
+    "event__to": pl.Binary,
+    **_u256_schema("amount0In"),
+    **_u256_schema("amount1In"),
+    **_u256_schema("amount0Out"),
+    **_u256_schema("amount1Out"),
+}
+V3_SCHEMA = {
+    **LOG_SCHEMA,
+    "event__sender": pl.Binary,
+    "event__recipient": pl.Binary,
+    **_u256_schema("amount0"),
+    **_u256_schema("amount1"),
+    **_u256_schema("sqrtPriceX96"),
+    **_u256_schema("liquidity"),
+    "event__tick": pl.Int32,
+}
+SCHEMAS = {"v2": V2_SCHEMA, "v3": V3_SCHEMA}
+# data words of each event: (name, signed), tick is handled separately
+V2_WORDS = [
+    ("amount0In", False),
+    ("amount1In", False),
+    ("amount0Out", False),
+    ("amount1Out", False),
+]
+V3_WORDS = [
+    ("amount0", True),
+    ("amount1", True),
+    ("sqrtPriceX96", False),
+    ("liquidity", False),
+]
+
+
+def chunk_file(chain: str, version: str, first: int, last: int) -> str:
+    # cryo's layout, so manifest and period0/2 read these chunks unchanged
+    return os.path.join(
+        chain, f"{chain}__logs__{version}_{chain}__{first:08d}_to_{last:08d}.parquet"
+    )
+
+
+def _hex(value: str) -> bytes:
+    return bytes.fromhex(value[2:])
+
+
+def decode_log(log: dict, chain_id: int) -> Optional[tuple[str, dict]]:
+    # None for logs that only share topic0 with a swap event, e.g. a different
+    # indexed layout, as cryo cannot decode them either
+    topics = [_hex(t) for t in log["topics"]]
+    version = "v2" if topics[0] == V2_TOPIC0 else "v3"
+    data = _hex(log["data"])
+    words = V2_WORDS if version == "v2" else V3_WORDS
+    n_words = len(words) + (1 if version == "v3" else 0)
+    if len(topics) != 3 or len(data) != 32 * n_words:
+        return None
+    row = {
+        "block_number": int(log["blockNumber"], 16),
+        "transaction_index": int(log["transactionIndex"], 16),
+        "log_index": int(log["logIndex"], 16),
+        "transaction_hash": _hex(log["transactionHash"]),
+        "address": _hex(log["address"]),
+        "topic0": topics[0],
+        "topic1": topics[1],
+        "topic2": topics[2],
+        "topic3": None,
+        "data": data,
+        "n_data_bytes": len(data),
+        "chain_id": chain_id,
+        "event__sender": topics[1][12:],
+        "event__to" if version == "v2" else "event__recipient": topics[2][12:],
+    }
+    for n, (name, signed) in enumerate(words):
+        raw = data[32 * n : 32 * n + 32]
+        value = int.from_bytes(raw, "big", signed=signed)
+        row[f"event__{name}_binary"] = raw
+        row[f"event__{name}_string"] = str(value)
+        row[f"event__{name}_f64"] = float(value)
+    if version == "v3":
+        row["event__tick"] = int.from_bytes(data[128:160], "big", signed=True)
+    return (version, row)
+
+
+def write_chunk(
+    chain: str, logs: List[dict], versions: List[str], first: int, last: int
+) -> Dict[str, int]:
+    # runs in a worker process; every requested version gets a file, empty or
+    # not, so the range counts as fetched
+    rows = {v: [] for v in versions}
+    skipped = 0
+    for log in logs:
+        if log.get("removed"):
+            continue
+        decoded = decode_log(log, CHAIN_IDS[chain])
+        if decoded is None or decoded[0] not in rows:
+            skipped = skipped + 1
+            continue
+        rows[decoded[0]].append(decoded[1])
+    for version in versions:
+        file = chunk_file(chain, version, first, last)
+        tmp = f"{file}.tmp"
+        pl.DataFrame(rows[version], schema=SCHEMAS[version]).sort(
+            ["block_number", "log_index"]
+        ).write_parquet(tmp)
+        os.replace(tmp, file)
+    return {**{v: len(rows[v]) for v in versions}, "skipped": skipped}
+
+
+def _too_large(error: RpcError) -> bool:
+    message = str(error).lower()
+    return any(x in message for x in TOO_LARGE)
+
+
+class LogFetcher:
+    # eth_getLogs over [low, high) in sub-ranges of `span` blocks; a range the
+    # node refuses as too large is bisected and the span shrinks for the rest
+    # of the run, it grows again after a chunk without refusals
+    def __init__(self, client: AsyncRpcClient, span: int, max_span: int):
+        self.client = client
+        self.span = span
+        self.max_span = max_span
+        self.splits = 0
+
+    async def get_logs(self, low: int, high: int, topics: List[bytes]) -> List[dict]:
+        query = {
+            "fromBlock": hex(low),
+            "toBlock": hex(high - 1),
+            "topics": [["0x" + t.hex() for t in topics]],
+        }
+        try:
+            return await self.client.request("eth_getLogs", [query])
+        except RpcError as e:
+            if high - low <= 1 or not _too_large(e):
+                raise
+        METRICS.count("get_logs_splits")
+        self.splits = self.splits + 1
+        self.span = max(1, min(self.span, (high - low) // 2))
+        mid = (low + high) // 2
+        (left, right) = await asyncio.gather(
+            self.get_logs(low, mid, topics), self.get_logs(mid, high, topics)
+        )
+        return left + right
+
+    async def fetch(self, low: int, high: int, topics: List[bytes]) -> List[dict]:
+        splits = self.splits
+        step = self.span
+        parts = await asyncio.gather(
+            *[
+                self.get_logs(x, min(x + step, high), topics)
+                for x in range(low, high, step)
+            ]
+        )
+        if self.splits == splits:
+            self.span = min(self.max_span, self.span * 2)
+        return [log for part in parts for log in part]
+
+
+def plan_chunks(
+    chain: str, low: int, high: int, chunk_blocks: int
+) -> List[tuple[int, int, List[str]]]:
+    # one getLogs pass per chunk covers every version still missing in it
+    path = os.path.join(chain, chain)
+    gaps = {v: missing_ranges(path, v, low, high) for v in TOPIC0}
+    ret = []
+    for g_low, g_high in merge_ranges([g for v in gaps for g in gaps[v]]):
+        for x in range(g_low, g_high, chunk_blocks):
+            y = min(x + chunk_blocks, g_high)
+            versions = [v for v in TOPIC0 if any(a < y and b > x for (a, b) in gaps[v])]
+            ret.append((x, y, versions))
+    return ret
+
+
+async def ingest_chain(
+    chain: str,
+    low: int,
+    high: int,
+    endpoint: RpcEndpoint,
+    chunk_blocks: int,
+    span: int,
+    pool: ProcessPoolExecutor,
+) -> List[Tuple[int, int]]:
+    # returns the block ranges that could not be fetched
+    chunks = plan_chunks(chain, low, high, chunk_blocks)
+    if len(chunks) == 0:
+        logging.info(f"Logs for {chain} already fetched, skipping!!!")
+        return []
+    os.makedirs(chain, exist_ok=True)
+    logging.info(f"Fetching logs for {len(chunks)} chunks of {chain}!!!")
+    loop = asyncio.get_running_loop()
+    progress = Progress(f"{chain} log chunks", len(chunks))
+    in_flight = asyncio.Semaphore(CHUNKS_IN_FLIGHT)
+    failed = []
+
+    async def run(fetcher: LogFetcher, first: int, end: int, versions: List[str]):
+        async with in_flight:
+            try:
+                with METRICS.stage("get_logs") as stage:
+                    logs = await fetcher.fetch(
+                        first, end, [TOPIC0[v] for v in versions]
+                    )
+                    stage.add(len(logs))
+            except RpcError as e:
+                logging.warning(f"Failed to fetch {chain} {first}-{end}: {e}")
+                failed.append((first, end))
+                return
+        with METRICS.stage("decode_logs") as stage:
+            counts = await loop.run_in_executor(
+                pool, write_chunk, chain, logs, versions, first, end - 1
+            )
+            stage.add(len(logs))
+        METRICS.count("undecodable_logs", counts["skipped"])
+        progress.update()
+
+    async with AsyncRpcClient(endpoint) as client:
+        fetcher = LogFetcher(client, span, chunk_blocks)
+        await asyncio.gather(*[run(fetcher, *c) for c in chunks])
+    if len(failed) > 0:
+        logging.error(f"{len(failed)} chunks of {chain} failed, rerun to fetch them!!!")
+    return failed
+
+
+def main():
+    logging.info("Started Processing!!!")
+    provider = Provider.generate()
+    chains = sys.argv[1:] or list(CHAIN_IDS.keys())
+    context = get_context("spawn")
+    failed = []
+    with run_metrics("ingest", provider.profile):
+        with ProcessPoolExecutor(
+            provider.workers or os.cpu_count(), mp_context=context
+        ) as pool:
+            for chain in chains:
+                logging.info(f"Processing {chain}!!!")
+                chunks = asyncio.run(
+                    ingest_chain(
+                        chain,
+                        getattr(provider, f"start_block_{chain}"),
+                        getattr(provider, f"end_block_{chain}"),
+                        provider.endpoint(chain),
+                        provider.log_chunk_blocks,
+                        provider.getlogs_block_range,
+                        pool,
+                    )
+                )
+                if len(chunks) > 0:
+                    failed.append(chain)
+                logging.info(f"Processing {chain} done!!!")
+    # dependent stages must not start on missing logs
+    if len(failed) > 0:
+        sys.exit(f"Failed chunks in {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from typing import Dict, List, Optional
+import polars as pl
+import dataset
+import ingest
+import period0
+import period2
+from manifest import Manifest
+from metrics import METRICS, run_metrics
+from registry import CHAIN_IDS, MetadataRegistry
+from utils import AsyncRpcClient, Provider, RpcError
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# blocks fetched per poll while catching up, so a follower far behind the head
+# still holds a bounded window in memory
+CATCH_UP_BLOCKS = 5_000
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+class LiveFollower:
+    # follows the head of one chain by polling: every poll re-fetches all
+    # blocks past the last confirmed one, so a reorg inside that window only
+    # changes what the next poll sees; blocks `confirmations` deep are final and
+    # their arbitrage is written as ordinary swaps windows
+    def __init__(self, chain: str, provider: Provider, until: Optional[int] = None):
+        self.chain = chain
+        self.provider = provider
+        self.endpoint = provider.endpoint(chain)
+        self.until = until
+        self.path = f"./{chain}/{chain}"
+        self.stage = "swaps_exact" if provider.exact_amounts else "swaps"
+        self.manifest = Manifest()
+        self.registry = MetadataRegistry(chain)
+        pools_file = f"{chain}_pools.parquet"
+        tokens_file = f"{chain}_tokens.parquet"
+        if (
+            self.registry.is_empty()
+            and os.path.exists(pools_file)
+            and os.path.exists(tokens_file)
+        ):
+            self.registry.import_files(pools_file, tokens_file)
+        self.known = {
+            "pools": self.registry.seen("pools"),
+            "tokens": self.registry.seen("tokens"),
+        }
+        self.lookup = self._lookup()
+        # [flushed, next) is confirmed but not written yet, next onwards is
+        # re-fetched on every poll
+        self.next = 0
+        self.flushed = 0
+        self.confirmed: List[pl.DataFrame] = []
+        self.hashes: Dict[int, str] = {}
+        self.reported: Dict[str, int] = {}
+
+    def _lookup(self) -> pl.DataFrame:
+        return period2.build_pool_lookup(self.registry.tokens(), self.registry.pools())
+
+    def _resume_from(self, head: int, start: Optional[int]) -> int:
+        if start is not None:
+            return start
+        done = [e["high"] for e in self.manifest.entries_for(self.stage, self.chain)]
+        if len(done) > 0:
+            return max(done)
+        return max(0, head - self.provider.live_confirmations)
+
+    def _frames(self, logs: List[dict]) -> tuple[pl.DataFrame, pl.DataFrame]:
+        rows = {v: [] for v in ingest.TOPIC0}
+        self.hashes = {}
+        for log in logs:
+            if log.get("removed"):
+                continue
+            decoded = ingest.decode_log(log, CHAIN_IDS[self.chain])
+            if decoded is None:
+                METRICS.count("undecodable_logs")
+                continue
+            rows[decoded[0]].append(decoded[1])
+            self.hashes[decoded[1]["block_number"]] = log.get("blockHash")
+        (df2, df3) = [
+            pl.DataFrame(rows[v], schema=ingest.SCHEMAS[v]).unique(
+                period2.LOG_KEY, keep="first", maintain_order=True
+            )
+            for v in ("v2", "v3")
+        ]
+        return (df2, df3)
+
+    def _check_reorg(self, previous: Dict[int, str]):
+        # only blocks with swaps carry a hash; a reorged empty block shows up
+        # as new logs and needs no special handling
+        changed = [
+            b for b in previous if b >= self.next and self.hashes.get(b) != previous[b]
+        ]
+        if len(changed) > 0:
+            METRICS.count("reorgs")
+            logging.warning(
+                f"Reorg on {self.chain} from block {min(changed)}, "
+                f"{len(changed)} blocks changed!!!"
+            )
+
+    async def _resolve(self, df2: pl.DataFrame, df3: pl.DataFrame):
+        # pools and tokens first seen at the head are queried before detection;
+        # the queries run their own event loop, hence the thread
+        changed = False
+        for df, is_v3 in ((df2, False), (df3, True)):
+            new = [
+                x
+                for x in df["address"].unique(maintain_order=True).to_list()
+                if x not in self.known["pools"]
+            ]
+            if len(new) == 0:
+                continue
+            logging.info(f"Querying {len(new)} new {'V3' if is_v3 else 'V2'} pools!!!")
+            (pools_df, failures) = await asyncio.to_thread(
+                period0.query_pool, new, is_v3, self.endpoint
+            )
+            self.registry.append("pools", pools_df)
+            self.registry.append_failures("pools", failures)
+            # pools the endpoint didn't answer for are asked again next poll
+            self.known["pools"].update(pools_df["pool_address"].to_list())
+            self.known["pools"].update(failures["address"].to_list())
+            referenced = pl.concat([pools_df["token0"], pools_df["token1"]])
+            tokens = [
+                x
+                for x in referenced.unique(maintain_order=True).to_list()
+                if x not in self.known["tokens"]
+            ]
+            if len(tokens) > 0:
+                (tokens_df, failures) = await asyncio.to_thread(
+                    period0.query_tokens, tokens, self.endpoint
+                )
+                self.registry.append("tokens", tokens_df)
+                self.registry.append_failures("tokens", failures)
+                self.known["tokens"].update(tokens_df["contract_address"].to_list())
+                self.known["tokens"].update(failures["address"].to_list())
+            changed = True
+        if changed:
+            self.lookup = self._lookup()
+
+    def _report(self, mev: pl.DataFrame, confirmed: int):
+        # arbitrage near the head is logged as soon as it is seen; blocks that
+        # are already final while catching up only go to the window files
+        current = dict(zip(mev["transaction_hash"], mev["block_number"]))
+        for row in mev.filter(
+            (pl.col("block_number") > confirmed)
+            & ~pl.col("transaction_hash").is_in(list(self.reported.keys()))
+        ).iter_rows(named=True):
+            logging.info(
+                f"Arbitrage in block {row['block_number']} "
+                f"{row['transaction_hash']}: {row['profit_amount']} "
+                f"{row['profit_token']} via {row['path']}!!!"
+            )
+        for tx, block in self.reported.items():
+            if tx not in current:
+                METRICS.count("retracted_arbitrage")
+                logging.warning(f"Arbitrage {tx} in block {block} was reorged out!!!")
+        self.reported = {tx: b for (tx, b) in current.items() if b > confirmed}
+
+    async def poll(self, client: AsyncRpcClient, fetcher: ingest.LogFetcher) -> bool:
+        # True once the follower has caught up with the head
+        head = int(await client.request("eth_blockNumber", []), 16)
+        high = min(head + 1, self.next + CATCH_UP_BLOCKS)
+        if high <= self.next:
+            return True
+        with METRICS.stage("get_logs") as stage:
+            logs = await fetcher.fetch(self.next, high, list(ingest.TOPIC0.values()))
+            stage.add(len(logs))
+        previous = self.hashes
+        (df2, df3) = self._frames(logs)
+        self._check_reorg(previous)
+        await self._resolve(df2, df3)
+        with METRICS.stage("detect_arbitrage") as stage:
+            swaps = period2.enrich_swaps(
+                df2, df3, self.lookup, self.provider.exact_amounts
+            )
+            mev = period2.detect_arbitrage(swaps)
+            stage.add(swaps.shape[0])
+        confirmed = min(high, head + 1 - self.provider.live_confirmations)
+        self._report(mev, confirmed - 1)
+        if confirmed > self.next:
+            self.confirmed.append(mev.filter(pl.col("block_number") < confirmed))
+            self.hashes = {b: h for (b, h) in self.hashes.items() if b >= confirmed}
+            self.next = confirmed
+        if self.next - self.flushed >= self.provider.live_flush_blocks:
+            self.flush()
+        return high == head + 1
+
+    def flush(self):
+        # confirmed blocks become a swaps window like period2's, so summary,
+        # traces and later batch runs pick them up unchanged
+        if self.next <= self.flushed:
+            return
+        mev = pl.concat([pl.DataFrame(schema=dataset.MEV_SCHEMA), *self.confirmed])
+        for low, high in dataset.split_buckets(self.flushed, self.next):
+            file = dataset.window_file(self.chain, low, high)
+            window = mev.filter(
+                (pl.col("block_number") >= low) & (pl.col("block_number") < high)
+            )
+            dataset.write_window(window, file)
+            self.manifest.record(
+                self.stage,
+                self.chain,
+                low,
+                high,
+                period2.window_inputs(self.path, low, high),
+                [file],
+            )
+            logging.info(f"Written {file} with {window.shape[0]} arbitrages!!!")
+        self.registry.export(
+            f"{self.chain}_pools.parquet", f"{self.chain}_tokens.parquet"
+        )
+        self.confirmed = []
+        self.flushed = self.next
+
+    async def run(self, start: Optional[int] = None):
+        span = self.provider.getlogs_block_range
+        async with AsyncRpcClient(self.endpoint) as client:
+            head = int(await client.request("eth_blockNumber", []), 16)
+            self.next = self._resume_from(head, start)
+            self.flushed = self.next
+            logging.info(f"Following {self.chain} from block {self.next}!!!")
+            fetcher = ingest.LogFetcher(client, span, span)
+            try:
+                while self.until is None or self.next < self.until:
+                    try:
+                        caught_up = await self.poll(client, fetcher)
+                    except RpcError as e:
+                        logging.warning(f"Poll of {self.chain} failed: {e}")
+                        caught_up = True
+                    if caught_up:
+                        await asyncio.sleep(self.provider.live_poll_seconds)
+            finally:
+                self.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Follow the chain head and detect arbitrage as blocks arrive"
+    )
+    parser.add_argument("chain", choices=list(CHAIN_IDS.keys()))
+    parser.add_argument(
+        "--from",
+        dest="start",
+        type=int,
+        help="first block, defaults to the end of the last swaps window",
+    )
+    parser.add_argument(
+        "--until", type=int, help="stop once every block before this one is final"
+    )
+    args = parser.parse_args()
+    provider = Provider.generate()
+    signal.signal(signal.SIGTERM, _stop)
+    with run_metrics(f"live_{args.chain}", provider.profile):
+        try:
+            asyncio.run(LiveFollower(args.chain, provider, args.until).run(args.start))
+        except KeyboardInterrupt:
+            logging.info(f"Stopped following {args.chain}!!!")
+
+
+if __name__ == "__main__":
+    main()
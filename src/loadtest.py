@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+import polars as pl
+import bench
+import ingest
+import period0
+from bytecode import BytecodeStore, fetch_code_hashes
+from fakenode import Faults, serve
+from metrics import METRICS
+from traces import TraceCache
+from utils import AsyncRpcClient, RpcEndpoint, as_address_bytes
+
+STAGES = ["metadata", "code", "logs", "traces"]
+RESULTS_FILE = "loadtest_results.jsonl"
+CHAIN = "arbitrum"
+
+
+def _sqling():
+    # sqling.py lives next to src/, not in it
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sqling
+
+    return sqling
+
+
+def run_metadata(data: str, endpoint: RpcEndpoint, work: str) -> int:
+    pools = as_address_bytes(
+        pl.read_parquet(os.path.join(data, f"{CHAIN}_pools.parquet")),
+        ["pool_address", "token0", "token1"],
+    )
+    tokens = as_address_bytes(
+        pl.read_parquet(os.path.join(data, f"{CHAIN}_tokens.parquet")),
+        ["contract_address"],
+    )
+    period0.query_pool(pools["pool_address"].to_list(), False, endpoint)
+    period0.query_tokens(tokens["contract_address"].to_list(), endpoint)
+    return 2 * (pools.shape[0] + tokens.shape[0])
+
+
+def run_code(data: str, endpoint: RpcEndpoint, work: str) -> int:
+    swaps = pl.read_parquet(
+        os.path.join(data, CHAIN, "*__logs__*.parquet"),
+        columns=["event__sender", "block_number"],
+    )
+    senders = swaps.group_by("event__sender").agg(pl.col("block_number").max())
+    fetch_code_hashes(
+        BytecodeStore(os.path.join(work, "bytecode_store")),
+        CHAIN,
+        senders["event__sender"].to_list(),
+        senders["block_number"].to_list(),
+        endpoint,
+    )
+    return senders.shape[0]
+
+
+def run_logs(data: str, endpoint: RpcEndpoint, work: str) -> int:
+    blocks = pl.read_parquet(
+        os.path.join(data, CHAIN, "*__logs__*.parquet"), columns=["block_number"]
+    )["block_number"]
+    (low, high) = (blocks.min(), blocks.max() + 1)
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        with ProcessPoolExecutor(2, mp_context=get_context("spawn")) as pool:
+            asyncio.run(
+                ingest.ingest_chain(
+                    CHAIN, low, high, endpoint, max(1, (high - low) // 10), 100, pool
+                )
+            )
+    finally:
+        os.chdir(cwd)
+    return blocks.shape[0]
+
+
+def run_traces(data: str, endpoint: RpcEndpoint, work: str) -> int:
+    sqling = _sqling()
+    tx_hashes = (
+        pl.read_parquet(
+            os.path.join(data, CHAIN, "*__logs__*.parquet"),
+            columns=["transaction_hash"],
+        )["transaction_hash"]
+        .unique(maintain_order=True)
+        .bin.encode("hex")
+        .to_list()
+    )
+    tx_hashes = ["0x" + x for x in tx_hashes]
+    cache = TraceCache(os.path.join(work, "traces.sqlite"))
+    traced = dataclasses.replace(endpoint, batch_size=sqling.TRACE_BATCH_SIZE)
+
+    async def fetch():
+        async with AsyncRpcClient(traced) as client:
+            for i in range(0, len(tx_hashes), sqling.TRACE_CHUNK):
+                chunk = tx_hashes[i : i + sqling.TRACE_CHUNK]
+                await sqling.fetch_chunk(client, cache, CHAIN, chunk)
+
+    asyncio.run(fetch())
+    cache.close()
+    return len(tx_hashes)
+
+
+RUNNERS = {
+    "metadata": run_metadata,
+    "code": run_code,
+    "logs": run_logs,
+    "traces": run_traces,
+}
+
+
+def _wait_for(port: int, timeout: float = 60.0):
+    start = time.monotonic()
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as r:
+                return json.loads(r.read())
+        except OSError:
+            if time.monotonic() - start > timeout:
+                raise
+            time.sleep(0.2)
+
+
+def run(
+    data: str,
+    stages: List[str],
+    faults: Faults,
+    port: int,
+    max_in_flight: int,
+    batch_size: int,
+    results: str,
+):
+    node = get_context("spawn").Process(
+        target=serve, args=(data, CHAIN, faults, port), daemon=True
+    )
+    node.start()
+    try:
+        _wait_for(port)
+        endpoint = RpcEndpoint(
+            url=f"http://127.0.0.1:{port}/",
+            max_in_flight=max_in_flight,
+            batch_size=batch_size,
+            backoff=0.05,
+        )
+        for stage in stages:
+            work = tempfile.mkdtemp(prefix=f"loadtest_{stage}_")
+            METRICS.reset()
+            before = _wait_for(port)
+            start = time.perf_counter()
+            try:
+                items = RUNNERS[stage](data, endpoint, work)
+            finally:
+                shutil.rmtree(work, ignore_errors=True)
+            seconds = time.perf_counter() - start
+            after = _wait_for(port)
+            record = _record(stage, items, seconds, before, after)
+            record.update(
+                {
+                    "time": int(time.time()),
+                    "faults": dataclasses.asdict(faults),
+                    "max_in_flight": max_in_flight,
+                    "batch_size": batch_size,
+                }
+            )
+            logging.info(
+                f"{stage}: {record['items_per_sec']} items/s, "
+                f"{record['requests_per_sec']} requests/s, "
+                f"p50 {record['p50_ms']} ms, p99 {record['p99_ms']} ms, "
+                f"{record['errors']} errors!!!"
+            )
+            with open(results, "a") as f:
+                f.write(json.dumps(record) + "\n")
+    finally:
+        node.terminate()
+        node.join()
+
+
+def _record(stage: str, items: int, seconds: float, before: Dict, after: Dict):
+    # latency quantiles are those of the stage's busiest method, as upper bounds
+    # of the metrics histogram buckets
+    summary = METRICS.summary()
+    rpc = list(summary["rpc"].values())
+    requests = sum(x["requests"] for x in rpc)
+    busiest = max(rpc, key=lambda x: x["requests"], default=None)
+    return {
+        "stage": stage,
+        "items": items,
+        "seconds": round(seconds, 3),
+        "items_per_sec": round(items / seconds, 1),
+        "requests": requests,
+        "requests_per_sec": round(requests / seconds, 1),
+        "errors": sum(x["errors"] for x in rpc),
+        "p50_ms": busiest["p50_ms"] if busiest else None,
+        "p99_ms": busiest["p99_ms"] if busiest else None,
+        "rpc": summary["rpc"],
+        "node": {k: after[k] - before[k] for k in after},
+    }
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Run the RPC stages against a local fake node"
+    )
+    parser.add_argument("--data", help="fixture directory, generated when missing")
+    parser.add_argument("--scale", type=int, default=10_000)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--call-error-rate", type=float, default=0.0)
+    parser.add_argument("--max-logs", type=int, default=10_000)
+    parser.add_argument("--out", default=RESULTS_FILE)
+    args = parser.parse_args()
+    data = args.data or os.path.join("bench_data", f"{args.scale}_0")
+    if not os.path.isdir(data):
+        logging.info(f"Generating {args.scale} swaps into {data}!!!")
+        bench.generate_dataset(data, args.scale)
+    faults = Faults(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        call_error_rate=args.call_error_rate,
+        max_logs=args.max_logs,
+    )
+    run(
+        data,
+        args.stages,
+        faults,
+        args.port,
+        args.max_in_flight,
+        args.batch_size,
+        args.out,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import fcntl
+import glob
+import json
+import os
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+MANIFEST_FILE = "manifest.json"
+CRYO_CHUNK = re.compile(r"__(\d+)_to_(\d+)\.parquet$")
+
+
+def chunk_range(file: str) -> Optional[tuple[int, int]]:
+    # cryo chunk names carry an inclusive block range, returned here as [low, high)
+    m = CRYO_CHUNK.search(file)
+    if m is None:
+        return None
+    return (int(m[1]), int(m[2]) + 1)
+
+
+def log_files(path: str, version: str) -> List[str]:
+    return sorted(glob.glob(path + f"__logs__{version}*.parquet"))
+
+
+def overlapping_chunks(path: str, version: str, low: int, high: int) -> List[str]:
+    ret = []
+    for f in log_files(path, version):
+        r = chunk_range(f)
+        if r is None or (r[0] < high and r[1] > low):
+            ret.append(f)
+    return ret
+
+
+def fingerprint(file: str) -> str:
+    st = os.stat(file)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def merge_ranges(ranges: List[tuple[int, int]]) -> List[tuple[int, int]]:
+    ret = []
+    for low, high in sorted(ranges):
+        if len(ret) > 0 and low <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], high))
+        else:
+            ret.append((low, high))
+    return ret
+
+
+def subtract_ranges(
+    low: int, high: int, covered: List[tuple[int, int]]
+) -> List[tuple[int, int]]:
+    ret = []
+    curr = low
+    for c_low, c_high in merge_ranges(covered):
+        if c_high <= curr or c_low >= high:
+            continue
+        if c_low > curr:
+            ret.append((curr, c_low))
+        curr = max(curr, c_high)
+    if curr < high:
+        ret.append((curr, high))
+    return ret
+
+
+def _key(entry: Dict) -> tuple:
+    return (entry["stage"], entry["chain"], entry["low"], entry["high"])
+
+
+class Manifest:
+    # one entry per processed (stage, chain, block range) with the fingerprints
+    # of the files it was computed from and the files it produced
+    def __init__(self, path: str = MANIFEST_FILE):
+        self.path = path
+        self.entries: List[Dict] = self._load()
+        # entries recorded (or removed, as None) since the last save
+        self._changed: Dict[tuple, Optional[Dict]] = {}
+
+    def _load(self) -> List[Dict]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return json.load(f)["entries"]
+
+    def save(self):
+        # pipeline.py runs stages of different chains side by side, so the file
+        # is re-read under a lock and only the entries changed here replace it
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = [e for e in self._load() if _key(e) not in self._changed]
+            merged.extend(e for e in self._changed.values() if e is not None)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"entries": merged}, f, indent=2)
+            os.replace(tmp, self.path)
+        self.entries = merged
+        self._changed = {}
+
+    def entries_for(self, stage: str, chain: str) -> List[Dict]:
+        return [e for e in self.entries if e["stage"] == stage and e["chain"] == chain]
+
+    def has_output(self, file: str) -> bool:
+        return any(file in e["outputs"] for e in self.entries)
+
+    def record(
+        self,
+        stage: str,
+        chain: str,
+        low: int,
+        high: int,
+        inputs: List[str],
+        outputs: List[str],
+    ):
+        self.entries = [
+            e
+            for e in self.entries
+            if not (
+                e["stage"] == stage
+                and e["chain"] == chain
+                and e["low"] == low
+                and e["high"] == high
+            )
+        ]
+        entry = {
+            "stage": stage,
+            "chain": chain,
+            "low": low,
+            "high": high,
+            "inputs": {f: fingerprint(f) for f in inputs},
+            "outputs": outputs,
+            "completed_at": int(time.time()),
+        }
+        self.entries.append(entry)
+        self._changed[_key(entry)] = entry
+        self.save()
+
+    @staticmethod
+    def _is_current(entry: Dict, inputs: List[str]) -> bool:
+        if not all(os.path.exists(f) for f in entry["outputs"]):
+            return False
+        if sorted(entry["inputs"].keys()) != sorted(inputs):
+            return False
+        return all(fingerprint(f) == entry["inputs"][f] for f in inputs)
+
+    def drop_stale(
+        self, stage: str, chain: str, inputs_of: Callable[[int, int], List[str]]
+    ) -> List[Dict]:
+        # entries whose inputs changed (or whose outputs vanished) are removed
+        # together with their outputs so the range gets recomputed
+        stale = [
+            e
+            for e in self.entries_for(stage, chain)
+            if not self._is_current(e, inputs_of(e["low"], e["high"]))
+        ]
+        self._remove(stale)
+        return stale
+
+    def discard(self, stage: str, chain: str) -> List[Dict]:
+        entries = self.entries_for(stage, chain)
+        self._remove(entries)
+        return entries
+
+    def _remove(self, entries: List[Dict]):
+        for e in entries:
+            for f in e["outputs"]:
+                if os.path.exists(f):
+                    os.remove(f)
+        self.entries = [e for e in self.entries if not any(e is x for x in entries)]
+        for e in entries:
+            self._changed[_key(e)] = None
+        if len(entries) > 0:
+            self.save()
+
+    def merge(self, entries: List[Dict], outputs: List[str]) -> Dict:
+        # entries of one stage and chain covering a contiguous range become a
+        # single entry with their recorded input fingerprints; old outputs are
+        # deleted once the manifest no longer points at them
+        inputs: Dict[str, str] = {}
+        for e in entries:
+            inputs.update(e["inputs"])
+        entry = {
+            "stage": entries[0]["stage"],
+            "chain": entries[0]["chain"],
+            "low": min(e["low"] for e in entries),
+            "high": max(e["high"] for e in entries),
+            "inputs": inputs,
+            "outputs": outputs,
+            "completed_at": max(e["completed_at"] for e in entries),
+        }
+        self.entries = [e for e in self.entries if not any(e is x for x in entries)]
+        for e in entries:
+            self._changed[_key(e)] = None
+        self.entries.append(entry)
+        self._changed[_key(entry)] = entry
+        self.save()
+        for e in entries:
+            for f in e["outputs"]:
+                if f not in outputs and os.path.exists(f):
+                    os.remove(f)
+        return entry
+
+    def missing(
+        self, stage: str, chain: str, low: int, high: int
+    ) -> List[tuple[int, int]]:
+        covered = [(e["low"], e["high"]) for e in self.entries_for(stage, chain)]
+        return subtract_ranges(low, high, covered)
+
+    def is_complete(
+        self,
+        stage: str,
+        chain: str,
+        low: int,
+        high: int,
+        inputs_of: Callable[[int, int], List[str]],
+    ) -> bool:
+        # [low, high) fully covered by entries whose inputs are unchanged
+        if len(self.missing(stage, chain, low, high)) > 0:
+            return False
+        return all(
+            self._is_current(e, inputs_of(e["low"], e["high"]))
+            for e in self.entries_for(stage, chain)
+        )
+
+    def is_fresh(self, stage: str, chain: str, inputs: List[str]) -> bool:
+        return any(self._is_current(e, inputs) for e in self.entries_for(stage, chain))
+
+
+def missing_ranges(
+    path: str, version: str, low: int, high: int
+) -> List[tuple[int, int]]:
+    fetched = [chunk_range(f) for f in log_files(path, version)]
+    return subtract_ranges(low, high, [r for r in fetched if r is not None])
+
+
+def missing_blocks(path: str, version: str, low: int, high: int) -> List[str]:
+    return [f"{lo}:{hi}" for (lo, hi) in missing_ranges(path, version, low, high)]
+
+
+if __name__ == "__main__":
+    # for a manual cryo run: missing-blocks ./optimism/optimism v3 126100000:130050000
+    if len(sys.argv) != 5 or sys.argv[1] != "missing-blocks":
+        sys.exit("usage: manifest.py missing-blocks <path> <v2|v3> <start:end>")
+    (start, end) = sys.argv[4].split(":")
+    print(" ".join(missing_blocks(sys.argv[2], sys.argv[3], int(start), int(end))))
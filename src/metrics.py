@@ -0,0 +1,259 @@
+import bisect
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+METRICS_DIR = "metrics"
+# upper bounds in ms; the last bucket counts everything slower
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+PROGRESS_INTERVAL = 10.0
+SAMPLE_INTERVAL = 0.005
+
+
+class Stage:
+    def __init__(self):
+        self.rows = 0
+
+    def add(self, rows: int):
+        self.rows = self.rows + rows
+
+
+class Metrics:
+    # process-wide stage timers, counters and rpc latency histograms; worker
+    # processes send their snapshot back and the parent merges it
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages: Dict[str, Dict] = {}
+        self.rpc: Dict[str, Dict] = {}
+        self.counters: Counter = Counter()
+        self.worker_peak_kb = 0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        curr = Stage()
+        start = time.perf_counter()
+        try:
+            yield curr
+        finally:
+            entry = self.stages.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "rows": 0}
+            )
+            entry["calls"] += 1
+            entry["seconds"] += time.perf_counter() - start
+            entry["rows"] += curr.rows
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def rpc_call(self, endpoint: str, method: str, seconds: float, calls: int = 1):
+        entry = self._rpc_entry(endpoint, method)
+        entry["requests"] += 1
+        entry["calls"] += calls
+        entry["seconds"] += seconds
+        entry["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def rpc_error(self, endpoint: str, method: str, n: int = 1):
+        self._rpc_entry(endpoint, method)["errors"] += n
+
+    def _rpc_entry(self, endpoint: str, method: str) -> Dict:
+        return self.rpc.setdefault(
+            f"{endpoint} {method}",
+            {
+                "requests": 0,
+                "calls": 0,
+                "errors": 0,
+                "seconds": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            },
+        )
+
+    def snapshot(self) -> Dict:
+        return {
+            "stages": self.stages,
+            "rpc": self.rpc,
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    def merge(self, snapshot: Dict):
+        for name, other in snapshot["stages"].items():
+            entry = self.stages.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "rows": 0}
+            )
+            for k in entry:
+                entry[k] += other[k]
+        for key, other in snapshot["rpc"].items():
+            entry = self._rpc_entry(*key.split(" ", 1))
+            for k in ("requests", "calls", "errors", "seconds"):
+                entry[k] += other[k]
+            entry["buckets"] = [
+                a + b for (a, b) in zip(entry["buckets"], other["buckets"])
+            ]
+        self.counters.update(snapshot["counters"])
+        self.worker_peak_kb = max(self.worker_peak_kb, snapshot["peak_rss_mb"] * 1024)
+
+    def summary(self) -> Dict:
+        stages = {
+            name: {
+                **x,
+                "seconds": round(x["seconds"], 4),
+                "rows_per_sec": (
+                    round(x["rows"] / x["seconds"], 1) if x["seconds"] > 0 else None
+                ),
+            }
+            for (name, x) in self.stages.items()
+        }
+        rpc = {
+            key: {
+                **x,
+                "seconds": round(x["seconds"], 4),
+                "mean_ms": (
+                    round(x["seconds"] * 1000 / x["requests"], 1)
+                    if x["requests"] > 0
+                    else None
+                ),
+                "p50_ms": _quantile(x["buckets"], 0.5),
+                "p99_ms": _quantile(x["buckets"], 0.99),
+            }
+            for (key, x) in self.rpc.items()
+        }
+        return {
+            "stages": stages,
+            "rpc": rpc,
+            "latency_buckets_ms": LATENCY_BUCKETS_MS,
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb(),
+            "worker_peak_rss_mb": round(self.worker_peak_kb / 1024, 1),
+        }
+
+
+def _quantile(buckets: List[int], q: float) -> Optional[float]:
+    # upper bound of the bucket holding the q-th request, None past the last bound
+    total = sum(buckets)
+    if total == 0:
+        return None
+    seen = 0
+    for bound, n in zip(LATENCY_BUCKETS_MS, buckets):
+        seen = seen + n
+        if seen >= q * total:
+            return bound
+    return None
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 1024), 1)
+
+
+METRICS = Metrics()
+
+
+class Progress:
+    # logs at most once per interval instead of on every row
+    def __init__(self, name: str, total: int, interval: float = PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self, n: int = 1):
+        self.done = self.done + n
+        now = time.perf_counter()
+        if now - self.last < self.interval and self.done < self.total:
+            return
+        self.last = now
+        rate = self.done / max(now - self.start, 1e-9)
+        pct = 100 * self.done / self.total if self.total > 0 else 100.0
+        logging.info(
+            f"{self.name}: {self.done}/{self.total} ({pct:.1f}%), {rate:.1f}/s!!!"
+        )
+
+
+class Sampler:
+    # wall-clock sampling of the main thread's stack, written as collapsed
+    # stacks ("a;b;c count") for flamegraph tools
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._target = threading.main_thread().ident
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, file: str):
+        with open(file, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+@contextmanager
+def run_metrics(name: str, profile: str = "", directory: str = METRICS_DIR):
+    # profile: "" (off), "cprofile" or "sample"; the summary and any profile
+    # land in {directory}/{name}_{start}.*
+    if profile not in ("", "cprofile", "sample"):
+        raise ValueError(f"unknown profile mode {profile}")
+    METRICS.reset()
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"{name}_{int(time.time())}")
+    started_at = time.time()
+    profiler = cProfile.Profile() if profile == "cprofile" else None
+    sampler = Sampler() if profile == "sample" else None
+    if profiler is not None:
+        profiler.enable()
+    if sampler is not None:
+        sampler.start()
+    try:
+        yield METRICS
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(f"{base}.prof")
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(f"{base}.folded")
+        summary = {
+            "name": name,
+            "started_at": int(started_at),
+            "seconds": round(time.time() - started_at, 3),
+            "profile": profile,
+            **METRICS.summary(),
+        }
+        with open(f"{base}.json", "w") as f:
+            json.dump(summary, f, indent=2)
+        for stage, x in summary["stages"].items():
+            logging.info(
+                f"{stage}: {x['rows']} rows in {x['seconds']:.2f}s "
+                f"({x['rows_per_sec']} rows/s)!!!"
+            )
+        logging.info(
+            f"Peak memory {summary['peak_rss_mb']} MB, metrics written to {base}.json!!!"
+        )
@@ -1,7 +1,12 @@
-from web3 import Web3, HTTPProvider
+from eth_abi import decode, encode
+from eth_abi.exceptions import DecodingError
+import asyncio
 import polars as pl
-from typing import List, Set
-from utils import Provider
+from typing import List, Optional, Union
+from manifest import Manifest, chunk_range, log_files
+from metrics import METRICS, Progress, run_metrics
+from registry import FAILURE_SCHEMA, POOL_SCHEMA, TOKEN_SCHEMA, MetadataRegistry
+from utils import AsyncRpcClient, Provider, RpcEndpoint, RpcError
 import logging
 import os
 
@@ -9,141 +14,291 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+USE_MULTICALL = True
+RETRY_FAILED = False
+MULTICALL_BATCH = 500
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")
+SELECTOR_TOKEN0 = bytes.fromhex("0dfe1681")
+SELECTOR_TOKEN1 = bytes.fromhex("d21220a7")
+SELECTOR_SYMBOL = bytes.fromhex("95d89b41")
+SELECTOR_DECIMALS = bytes.fromhex("313ce567")
 
-def generate_pool_data(path: str) -> tuple[List[str], List[str]]:
-    path_v2 = path + "__logs__v2*.parquet"
-    path_v3 = path + "__logs__v3*.parquet"
-    df2 = pl.read_parquet(path_v2)
-    df3 = pl.read_parquet(path_v3)
-    v2_addresses = list(
-        map(
-            lambda x: Web3.to_checksum_address("0x" + x.hex()),
-            set(df2["address"].to_list()),
-        )
-    )
-    v3_addresses = list(
-        map(
-            lambda x: Web3.to_checksum_address("0x" + x.hex()),
-            set(df3["address"].to_list()),
-        )
+
+def generate_pool_data(path: str) -> tuple[List[bytes], List[bytes]]:
+    # only the address column is read; cryo already stores it as 20-byte binary
+    (v2_addresses, v3_addresses) = (
+        pl.scan_parquet(path + f"__logs__{version}*.parquet")
+        .select(pl.col("address").unique())
+        .collect()["address"]
+        .to_list()
+        for version in ("v2", "v3")
     )
     return (v2_addresses, v3_addresses)
 
 
-def query_pool(addresses: List[str], is_v3: bool, w3) -> tuple[pl.DataFrame, List[str]]:
-    minimal_pool_abi = [
-        {
-            "inputs": [],
-            "name": "token0",
-            "outputs": [{"internalType": "address", "name": "", "type": "address"}],
-            "stateMutability": "view",
-            "type": "function",
-        },
-        {
-            "inputs": [],
-            "name": "token1",
-            "outputs": [{"internalType": "address", "name": "", "type": "address"}],
-            "stateMutability": "view",
-            "type": "function",
-        },
-    ]
+def _reverted(e: RpcError) -> bool:
+    # the node ran the call and it failed, as opposed to the request failing
+    error = e.args[0] if len(e.args) > 0 else None
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return error.get("code") == 3 or "revert" in message or "gas" in message
+
+
+async def _aggregate3(
+    client: AsyncRpcClient, calls: List[tuple[bytes, bytes]]
+) -> List[Optional[bytes]]:
+    data = AGGREGATE3_SELECTOR + encode(
+        ["(address,bool,bytes)[]"], [[(target, True, data) for (target, data) in calls]]
+    )
+    try:
+        ret = await client.request(
+            "eth_call",
+            [{"to": MULTICALL3_ADDRESS, "data": "0x" + data.hex()}, "latest"],
+        )
+    except RpcError as e:
+        # a single misbehaving target can revert or exhaust gas for the whole
+        # batch, so bisect until it is isolated; transport errors and rate
+        # limits already went through the client's retries and are raised, as
+        # splitting them would only multiply the load
+        if not _reverted(e):
+            raise
+        if len(calls) == 1:
+            return [None]
+        half = len(calls) // 2
+        left = await _aggregate3(client, calls[:half])
+        right = await _aggregate3(client, calls[half:])
+        return left + right
+    try:
+        results = decode(["(bool,bytes)[]"], bytes.fromhex(ret[2:]))[0]
+    except (DecodingError, ValueError) as e:
+        raise RpcError(f"Undecodable aggregate3 result: {e}")
+    return [data if success else None for (success, data) in results]
+
+
+async def _contract_calls(
+    calls: List[tuple[bytes, bytes]], endpoint: RpcEndpoint
+) -> List[Union[bytes, None, RpcError]]:
+    # None for calls that reverted or returned nothing, RpcError for calls the
+    # endpoint never answered, which are worth asking again later
+    async with AsyncRpcClient(endpoint) as client:
+        if USE_MULTICALL:
+            chunks = [
+                calls[i : i + MULTICALL_BATCH]
+                for i in range(0, len(calls), MULTICALL_BATCH)
+            ]
+            progress = Progress("eth_call multicalls", len(calls))
+
+            async def run(chunk):
+                try:
+                    ret = await _aggregate3(client, chunk)
+                except RpcError as e:
+                    logging.warning(f"Multicall of {len(chunk)} calls failed: {e}")
+                    ret = [e] * len(chunk)
+                progress.update(len(chunk))
+                return ret
+
+            results = await asyncio.gather(*[run(c) for c in chunks])
+            return [x for chunk in results for x in chunk]
+        results = await client.map(
+            [
+                (
+                    "eth_call",
+                    [{"to": "0x" + target.hex(), "data": "0x" + data.hex()}, "latest"],
+                )
+                for (target, data) in calls
+            ]
+        )
+        ret = []
+        for r in results:
+            if isinstance(r, RpcError):
+                ret.append(None if _reverted(r) else r)
+            else:
+                ret.append(None if r is None else bytes.fromhex(r[2:]))
+        return ret
+
+
+def contract_calls(
+    calls: List[tuple[bytes, bytes]], endpoint: RpcEndpoint
+) -> List[Union[bytes, None, RpcError]]:
+    return asyncio.run(_contract_calls(calls, endpoint))
+
+
+def decode_address(data: Optional[bytes]) -> Optional[bytes]:
+    if data is None or len(data) < 32 or any(data[:12]):
+        return None
+    return data[12:32]
+
+
+def decode_decimals(data: Optional[bytes]) -> Optional[int]:
+    if data is None or len(data) < 32:
+        return None
+    value = int.from_bytes(data[:32], "big")
+    return value if value < 256 else None
+
+
+def decode_symbol(data: Optional[bytes]) -> Optional[str]:
+    if data is None or len(data) < 32:
+        return None
+    if len(data) == 32:
+        # non-standard tokens (MKR, SAI, ...) return bytes32
+        return data.rstrip(b"\x00").decode("utf-8", errors="replace")
+    try:
+        return decode(["string"], data)[0]
+    except (DecodingError, UnicodeDecodeError):
+        return None
+
+
+def _failure(name: str, raw: Optional[bytes]) -> str:
+    if raw is None:
+        return f"{name} call reverted"
+    return f"{name} returned undecodable data"
+
+
+def _unanswered(results: List[Union[bytes, None, RpcError]]) -> bool:
+    # only what the contract itself answered is recorded as a failure; an
+    # address the endpoint never answered for stays unseen for the next run
+    return any(isinstance(r, RpcError) for r in results)
+
+
+def _log_unanswered(kind: str, n: int):
+    if n > 0:
+        logging.warning(f"No answer for {n} {kind}, they are queried again next run!!!")
+
+
+def query_pool(
+    addresses: List[bytes], is_v3: bool, endpoint: RpcEndpoint
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    calls = []
+    for i in addresses:
+        calls.append((i, SELECTOR_TOKEN0))
+        calls.append((i, SELECTOR_TOKEN1))
+    with METRICS.stage("query_pool") as stage:
+        results = contract_calls(calls, endpoint)
+        stage.add(len(addresses))
     pl_pool = []
-    total = len(addresses)
-    current = 0
-    tokens = set()
+    failures = []
+    for n, i in enumerate(addresses):
+        if _unanswered(results[2 * n : 2 * n + 2]):
+            METRICS.count("pool_unanswered")
+            continue
+        token0 = decode_address(results[2 * n])
+        token1 = decode_address(results[2 * n + 1])
+        if token0 is None or token1 is None:
+            logging.warning(f"Failed to process pool: 0x{i.hex()}")
+            reason = (
+                _failure("token0", results[2 * n])
+                if token0 is None
+                else _failure("token1", results[2 * n + 1])
+            )
+            failures.append({"address": i, "reason": reason})
+            METRICS.count("pool_failures")
+            continue
+        pl_pool.append(
+            {"pool_address": i, "token0": token0, "token1": token1, "is_v3": is_v3}
+        )
+    _log_unanswered("pools", len(addresses) - len(pl_pool) - len(failures))
+    df = pl.DataFrame(pl_pool, schema=POOL_SCHEMA)
+    return (df, pl.DataFrame(failures, schema=FAILURE_SCHEMA))
+
+
+def query_tokens(
+    addresses: List[bytes], endpoint: RpcEndpoint
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    calls = []
     for i in addresses:
-        try:
-            contract = w3.eth.contract(address=i, abi=minimal_pool_abi)
-            token0 = contract.functions.token0().call()
-            token1 = contract.functions.token1().call()
-            val = {
-                "pool_address": i,
-                "token0": token0,
-                "token1": token1,
-                "is_v3": is_v3,
-            }
-            pl_pool.append(val)
-            tokens.add(token0)
-            tokens.add(token1)
-            current = current + 1
-            print(f"Done with {(100 * current / total):.4f}%", end="\r")
-        except Exception:
-            logging.warning(f"Failed to process pool: {i}")
-    df = pl.DataFrame(pl_pool)
-    tokens = list(tokens)
-    return (df, tokens)
-
-
-def query_tokens(addresses: Set[str], w3) -> pl.DataFrame:
-    minimal_abi_erc20 = [
-        {
-            "inputs": [],
-            "name": "symbol",
-            "outputs": [{"name": "", "type": "string"}],
-            "stateMutability": "view",
-            "type": "function",
-        },
-        {
-            "inputs": [],
-            "name": "decimals",
-            "outputs": [{"name": "", "type": "uint8"}],
-            "stateMutability": "view",
-            "type": "function",
-        },
-    ]
+        calls.append((i, SELECTOR_SYMBOL))
+        calls.append((i, SELECTOR_DECIMALS))
+    with METRICS.stage("query_tokens") as stage:
+        results = contract_calls(calls, endpoint)
+        stage.add(len(addresses))
     pl_tokens = []
-    total = len(addresses)
-    current = 0
-    for i in addresses:
-        try:
-            contract = w3.eth.contract(address=i, abi=minimal_abi_erc20)
-            symbol = contract.functions.symbol().call()
-            decimals = contract.functions.decimals().call()
-            val = {"symbol": symbol, "decimal": decimals, "contract_address": i}
-            pl_tokens.append(val)
-            current = current + 1
-            print(f"Done with {(100 * current / total):.4f}%", end="\r")
-        except Exception:
-            logging.info(f"Failed to process token {i}")
-    df = pl.DataFrame(pl_tokens)
-    return df
-
-
-def process_chain(path: str, rpc: str):
+    failures = []
+    for n, i in enumerate(addresses):
+        if _unanswered(results[2 * n : 2 * n + 2]):
+            METRICS.count("token_unanswered")
+            continue
+        symbol = decode_symbol(results[2 * n])
+        decimals = decode_decimals(results[2 * n + 1])
+        if symbol is None or decimals is None:
+            logging.info(f"Failed to process token 0x{i.hex()}")
+            reason = (
+                _failure("symbol", results[2 * n])
+                if symbol is None
+                else _failure("decimals", results[2 * n + 1])
+            )
+            failures.append({"address": i, "reason": reason})
+            METRICS.count("token_failures")
+            continue
+        pl_tokens.append({"symbol": symbol, "decimal": decimals, "contract_address": i})
+    _log_unanswered("tokens", len(addresses) - len(pl_tokens) - len(failures))
+    df = pl.DataFrame(pl_tokens, schema=TOKEN_SCHEMA)
+    return (df, pl.DataFrame(failures, schema=FAILURE_SCHEMA))
+
+
+def process_chain(path: str, endpoint: RpcEndpoint):
     chain_name = path.split("/")[1]
-    if os.path.exists(f"{chain_name}_tokens.parquet") and os.path.exists(
-        f"{chain_name}_pools.parquet"
-    ):
+    pools_file = f"{chain_name}_pools.parquet"
+    tokens_file = f"{chain_name}_tokens.parquet"
+    inputs = log_files(path, "v2") + log_files(path, "v3")
+    manifest = Manifest()
+    if manifest.is_fresh("metadata", chain_name, inputs):
+        logging.info("Metadata is up to date with the logs, skipping!!!")
         return
-    w3_provider = Web3(HTTPProvider(rpc))
+    registry = MetadataRegistry(chain_name)
+    if (
+        registry.is_empty()
+        and os.path.exists(pools_file)
+        and os.path.exists(tokens_file)
+    ):
+        logging.info("Seeding registry from existing pools and tokens files!!!")
+        registry.import_files(pools_file, tokens_file)
     logging.info("Fetching pool addresses!!!")
-    (v2_addresses, v3_addresses) = generate_pool_data(path)
-    logging.info("Pool add. fetched! Querying V2 pools!!!")
-    (pool2_df, tokens2) = query_pool(v2_addresses, False, w3_provider)
-    logging.info("Querying V3 pools!!!")
-    (pool3_df, tokens3) = query_pool(v3_addresses, True, w3_provider)
-    tokens2.extend(tokens3)
-    pool2_df.extend(pool3_df)
-    pool2_df.write_parquet(f"{chain_name}_pools.parquet")
-    logging.info("Written pools file!!!")
-    tokens2 = set(tokens2)
-    logging.info("Querying tokens!!!")
-    df_tokens = query_tokens(tokens2, w3_provider)
-    df_tokens.write_parquet(f"{chain_name}_tokens.parquet")
-    logging.info("Written tokens file!!!")
+    with METRICS.stage("generate_pool_data") as stage:
+        (v2_addresses, v3_addresses) = generate_pool_data(path)
+        stage.add(len(v2_addresses) + len(v3_addresses))
+    for addresses, is_v3 in ((v2_addresses, False), (v3_addresses, True)):
+        new = registry.unseen("pools", addresses, RETRY_FAILED)
+        logging.info(f"Querying {len(new)} new {'V3' if is_v3 else 'V2'} pools!!!")
+        if len(new) == 0:
+            continue
+        (pools_df, failures) = query_pool(new, is_v3, endpoint)
+        registry.append("pools", pools_df)
+        registry.append_failures("pools", failures)
+    pools = registry.pools()
+    referenced = pl.concat([pools["token0"], pools["token1"]]).unique().to_list()
+    new = registry.unseen("tokens", referenced, RETRY_FAILED)
+    logging.info(f"Querying {len(new)} new tokens!!!")
+    if len(new) > 0:
+        (tokens_df, failures) = query_tokens(new, endpoint)
+        registry.append("tokens", tokens_df)
+        registry.append_failures("tokens", failures)
+    registry.export(pools_file, tokens_file)
+    logging.info("Written pools and tokens files!!!")
+    ranges = [r for r in map(chunk_range, inputs) if r is not None]
+    manifest.record(
+        "metadata",
+        chain_name,
+        min([r[0] for r in ranges], default=0),
+        max([r[1] for r in ranges], default=0),
+        inputs,
+        [pools_file, tokens_file],
+    )
 
 
 def main():
     logging.info("Started Processing!!!")
     provider = Provider.generate()
     paths_rpc = [
-        ("./arbitrum/arbitrum", provider.arbitrum_rpc),
-        ("./optimism/optimism", provider.optimism_rpc),
-    ]  # ("./base/base",provider.base_rpc)]
-    for i in paths_rpc:
-        logging.info(f"Processing {i}!!!")
-        process_chain(i[0], i[1])
-        logging.info(f"Processing {i} done!!!")
+        ("./arbitrum/arbitrum", provider.endpoint("arbitrum")),
+        ("./optimism/optimism", provider.endpoint("optimism")),
+    ]  # ("./base/base",provider.endpoint("base"))]
+    with run_metrics("period0", provider.profile):
+        for i in paths_rpc:
+            logging.info(f"Processing {i}!!!")
+            process_chain(i[0], i[1])
+            logging.info(f"Processing {i} done!!!")
 
 
 if __name__ == "__main__":
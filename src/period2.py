@@ -1,42 +1,99 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
+import decimal
 import json
-from web3 import Web3
 import polars as pl
-from typing import List, Dict, Set, Union
+from typing import List, Dict, Optional, Set, Union
 import logging
-from utils import Provider
+import dataset
+from dataset import MEV_SCHEMA
+from manifest import Manifest, chunk_range, log_files, overlapping_chunks
+from metrics import METRICS, Progress, run_metrics
+from utils import Provider, as_address_bytes, checksum_column, hex_address
+import glob
+import math
+import multiprocessing
 import os
+import re
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 DEBUG = False
+STREAMING = True
+# rough in-memory footprint of one swap through enrichment and detection
+BYTES_PER_SWAP = 2048
+LOG_KEY = ["block_number", "transaction_index", "log_index"]
+LOG_COLUMNS = [
+    "block_number",
+    "transaction_index",
+    "log_index",
+    "transaction_hash",
+    "address",
+    "topic0",
+    "chain_id",
+    "event__sender",
+]
+V2_COLUMNS = LOG_COLUMNS + [
+    "event__to",
+    "event__amount0In_f64",
+    "event__amount0Out_f64",
+    "event__amount1In_f64",
+    "event__amount1Out_f64",
+]
+V3_COLUMNS = LOG_COLUMNS + [
+    "event__recipient",
+    "event__amount0_f64",
+    "event__amount1_f64",
+    "event__sqrtPriceX96_f64",
+    "event__liquidity_f64",
+    "event__tick",
+]
+# exact mode: cryo's decimal-string copies of the uint256/int256 amounts, netted
+# as raw integers; polars has no 256-bit integer, so values past 38 digits are
+# dropped together with their transaction
+EXACT_AMOUNT = pl.Decimal(38, 0)
+V2_EXACT_COLUMNS = [
+    "event__amount0In_string",
+    "event__amount0Out_string",
+    "event__amount1In_string",
+    "event__amount1Out_string",
+]
+V3_EXACT_COLUMNS = ["event__amount0_string", "event__amount1_string"]
+# float(10**d) for every decimals value period0 accepts; pl.lit(10.0).pow() is
+# off by an ulp from 10**23 on
+DECIMAL_SCALES = {d: float(10**d) for d in range(256)}
+# exact 10**d for the decimals gaps an EXACT_AMOUNT can be rescaled by; a
+# symbol's rescaled legs must net below 10**38, checked in floats with enough
+# margin that rounding can't let an overflow through
+EXACT_SCALES = {d: decimal.Decimal(10**d) for d in range(38)}
+EXACT_LIMIT = 1e38 * (1 - 1e-9)
 
 
-@dataclass
+@dataclass(eq=False)
 class Token:
+    # interned by ObjectRegistry, so identity is equality
+    __slots__ = ("id", "ca", "symbol", "decimals")
+    id: int
     ca: str
     symbol: str
     decimals: str
 
     def __str__(self) -> str:
-        return json.dumps(self.__dict__, indent=2)
+        return json.dumps(
+            {"ca": self.ca, "symbol": self.symbol, "decimals": self.decimals},
+            indent=2,
+        )
 
     def __repr__(self) -> str:
         return self.__str__()
 
-    def __eq__(self, other) -> bool:
-        if not isinstance(other, Token):
-            return False
-        return self.ca == other.ca
-
-    def __hash__(self) -> int:
-        return hash(self.ca)
 
-
-@dataclass
+@dataclass(eq=False)
 class Pool:
+    __slots__ = ("id", "ca", "token0", "token1", "is_v3")
+    id: int
     ca: str
     token0: Token
     token1: Token
@@ -56,17 +113,53 @@ class Pool:
     def __repr__(self) -> str:
         return self.__str__()
 
-    def __eq__(self, other) -> bool:
-        if not isinstance(other, Pool):
-            return False
-        return self.ca == other.ca
 
-    def __hash__(self) -> int:
-        return hash(self.ca)
+class ObjectRegistry:
+    # one per frame of swaps: every token and pool is created once and numbered
+    # in order of first appearance, swaps share the interned pool; scoped to the
+    # lookup it was built from, so nothing outlives a run
+    def __init__(self):
+        self.tokens: List[Token] = []
+        self.pools: List[Pool] = []
+        self._token_ids: Dict[str, int] = {}
+        self._pool_ids: Dict[str, int] = {}
+
+    def token(self, ca: str, symbol: str, decimals: str) -> Token:
+        idx = self._token_ids.get(ca)
+        if idx is None:
+            idx = len(self.tokens)
+            self._token_ids[ca] = idx
+            self.tokens.append(Token(idx, ca, symbol, decimals))
+        return self.tokens[idx]
+
+    def pool(self, ca: str, token0: Token, token1: Token, is_v3: bool) -> Pool:
+        idx = self._pool_ids.get(ca)
+        if idx is None:
+            idx = len(self.pools)
+            self._pool_ids[ca] = idx
+            self.pools.append(Pool(idx, ca, token0, token1, is_v3))
+        return self.pools[idx]
 
 
 @dataclass
 class Swap_x:
+    __slots__ = (
+        "block_number",
+        "transaction_index",
+        "log_index",
+        "transaction_hash",
+        "pool",
+        "topic0",
+        "sender",
+        "recipient",
+        "chain_id",
+        "pool_delta_t0_unnormalized",
+        "pool_delta_t1_unnormalized",
+        "user_delta_t0_normalized",
+        "user_delta_t1_normalized",
+        "token0_buy",
+        "execution_price",
+    )
     block_number: int
     transaction_index: int
     log_index: int
@@ -108,6 +201,7 @@ class Swap_x:
 
 @dataclass
 class SwapV3(Swap_x):
+    __slots__ = ("sqrt_price_x86", "liquidity", "tick", "price_after_swap")
     sqrt_price_x86: float
     liquidity: float
     tick: int
@@ -118,190 +212,248 @@ class SwapV3(Swap_x):
         swaps_df: pl.DataFrame,
         tokens: str,
         pools: str,
+        registry: Optional[ObjectRegistry] = None,
     ) -> List[Swap_x]:
         logging.info("Started processing v3 logs!!!")
-        ret_list = []
-
-        pools_df = pl.read_parquet(pools)
-        tokens_df = pl.read_parquet(tokens)
-
-        chain_id = swaps_df["chain_id"][0]
-        rows = 100000 if DEBUG else swaps_df.shape[0]
-
-        for row in range(0, rows):  # range(0,rows)
-            tx_index = swaps_df["transaction_index"][row]
-            block_no = swaps_df["block_number"][row]
-            tx_hash = "0x" + swaps_df["transaction_hash"][row].hex()
-            pool_ca = Web3.to_checksum_address("0x" + swaps_df["address"][row].hex())
-            try:
-                pool_row = pools_df.row(
-                    by_predicate=(pl.col("pool_address") == pool_ca)
-                )
-                token0_ca = pool_row[1]
-                token1_ca = pool_row[2]
-                token0_row = tokens_df.row(
-                    by_predicate=(pl.col("contract_address") == token0_ca)
-                )
-                token1_row = tokens_df.row(
-                    by_predicate=(pl.col("contract_address") == token1_ca)
-                )
-            except Exception:
-                logging.info(f"Exception occured while processing swap v3 row {row}")
-                continue
-            token0_sym = token0_row[0]
-            token1_sym = token1_row[0]
-            token0_decimal = token0_row[1]
-            token1_decimal = token1_row[1]
-            token0 = Token(ca=token0_ca, symbol=token0_sym, decimals=token0_decimal)
-            token1 = Token(ca=token1_ca, symbol=token1_sym, decimals=token1_decimal)
-            my_pool = Pool(ca=pool_ca, token0=token0, token1=token1, is_v3=True)
-            log_index = swaps_df["log_index"][row]
-            topic0 = "0x" + swaps_df["topic0"][row].hex()
-            pool_delta_t0_unnormalized = swaps_df["event__amount0_f64"][row]
-            pool_delta_t1_unnormalized = swaps_df["event__amount1_f64"][row]
-            user_delta_t0_normalized = -pool_delta_t0_unnormalized / (
-                10**token0.decimals
-            )
-            user_delta_t1_normalized = -pool_delta_t1_unnormalized / (
-                10**token1.decimals
-            )
-            execution_price = (
-                (-user_delta_t1_normalized / user_delta_t0_normalized)
-                if user_delta_t0_normalized != 0.0
-                else 0.0
-            )
-            token0_out = True if user_delta_t0_normalized > 0 else False
-            sqrt_price_x86 = swaps_df["event__sqrtPriceX96_f64"][row]
-            price_after_swap = (sqrt_price_x86**2) / (2**192) * 10**12
-            sender = Web3.to_checksum_address(
-                "0x" + swaps_df["event__sender"][row].hex()
-            )
-            recipient = Web3.to_checksum_address(
-                "0x" + swaps_df["event__recipient"][row].hex()
-            )
-            sw = SwapV3(
-                block_number=block_no,
-                transaction_index=tx_index,
-                log_index=log_index,
-                transaction_hash=tx_hash,
-                pool=my_pool,
-                topic0=topic0,
-                sender=sender,
-                recipient=recipient,
-                chain_id=chain_id,
-                pool_delta_t0_unnormalized=pool_delta_t0_unnormalized,
-                pool_delta_t1_unnormalized=pool_delta_t1_unnormalized,
-                price_after_swap=price_after_swap,
-                user_delta_t0_normalized=user_delta_t0_normalized,
-                user_delta_t1_normalized=user_delta_t1_normalized,
-                token0_buy=token0_out,
-                execution_price=execution_price,
-                sqrt_price_x86=sqrt_price_x86,
-                liquidity=swaps_df["event__liquidity_f64"][row],
-                tick=swaps_df["event__tick"][row],
-            )
-            ret_list.append(sw)
-            print(f"Done with {(100 * row / rows):.4f}%", end="\r")
-
+        with METRICS.stage("process_log_v3") as stage:
+            lookup = build_pool_lookup(pl.read_parquet(tokens), pl.read_parquet(pools))
+            ret_list = swaps_from_frame(enrich_swaps_v3(swaps_df, lookup), registry)
+            stage.add(len(ret_list))
         logging.info("Finished v3 logs!!!")
         return ret_list
 
 
 @dataclass
 class SwapV2(Swap_x):
+    __slots__ = ()
+
     @staticmethod
     def process_log_v2(
         swaps_df: pl.DataFrame,
         tokens: str,
         pools: str,
+        registry: Optional[ObjectRegistry] = None,
     ) -> List[Swap_x]:
-        ret_list = []
         logging.info("Started processing v2 logs!!!")
-        pools_df = pl.read_parquet(pools)
-        tokens_df = pl.read_parquet(tokens)
-
-        chain_id = swaps_df["chain_id"][0]
-        rows = 100000 if DEBUG else swaps_df.shape[0]
-
-        for row in range(0, rows):  # range(0,rows)
-            tx_index = swaps_df["transaction_index"][row]
-            block_no = swaps_df["block_number"][row]
-            tx_hash = "0x" + swaps_df["transaction_hash"][row].hex()
-            pool_ca = Web3.to_checksum_address("0x" + swaps_df["address"][row].hex())
-            try:
-                pool_row = pools_df.row(
-                    by_predicate=(pl.col("pool_address") == pool_ca)
-                )
-                token0_ca = pool_row[1]
-                token1_ca = pool_row[2]
-                token0_row = tokens_df.row(
-                    by_predicate=(pl.col("contract_address") == token0_ca)
-                )
-                token1_row = tokens_df.row(
-                    by_predicate=(pl.col("contract_address") == token1_ca)
-                )
-            except Exception:
-                logging.info(f"Exception occured during v2 swap log row {row}")
-                continue
-            token0_sym = token0_row[0]
-            token1_sym = token1_row[0]
-            token0_decimal = token0_row[1]
-            token1_decimal = token1_row[1]
-            token0 = Token(ca=token0_ca, symbol=token0_sym, decimals=token0_decimal)
-            token1 = Token(ca=token1_ca, symbol=token1_sym, decimals=token1_decimal)
-            my_pool = Pool(ca=pool_ca, token0=token0, token1=token1, is_v3=False)
-            log_index = swaps_df["log_index"][row]
-            topic0 = "0x" + swaps_df["topic0"][row].hex()
-            pool_delta_t0_unnormalized = (
-                swaps_df["event__amount0In_f64"][row]
-                - swaps_df["event__amount0Out_f64"][row]
-            )
-            pool_delta_t1_unnormalized = (
-                swaps_df["event__amount1In_f64"][row]
-                - swaps_df["event__amount1Out_f64"][row]
-            )
-            user_delta_t0_normalized = -pool_delta_t0_unnormalized / (
-                10**token0.decimals
-            )
-            user_delta_t1_normalized = -pool_delta_t1_unnormalized / (
-                10**token1.decimals
-            )
-            execution_price = (
-                (-user_delta_t1_normalized / user_delta_t0_normalized)
-                if user_delta_t0_normalized != 0.0
-                else 0.0
-            )
-            token0_out = True if user_delta_t0_normalized > 0 else False
-            sender = Web3.to_checksum_address(
-                "0x" + swaps_df["event__sender"][row].hex()
-            )
-            recipient = Web3.to_checksum_address(
-                "0x" + swaps_df["event__to"][row].hex()
-            )
-            sw = SwapV2(
-                block_number=block_no,
-                transaction_index=tx_index,
-                log_index=log_index,
-                transaction_hash=tx_hash,
-                pool=my_pool,
-                topic0=topic0,
-                sender=sender,
-                recipient=recipient,
-                chain_id=chain_id,
-                pool_delta_t0_unnormalized=pool_delta_t0_unnormalized,
-                pool_delta_t1_unnormalized=pool_delta_t1_unnormalized,
-                user_delta_t0_normalized=user_delta_t0_normalized,
-                user_delta_t1_normalized=user_delta_t1_normalized,
-                token0_buy=token0_out,
-                execution_price=execution_price,
-            )
-            ret_list.append(sw)
-            print(f"Done with {(100 * row / rows):.4f}%", end="\r")
-
+        with METRICS.stage("process_log_v2") as stage:
+            lookup = build_pool_lookup(pl.read_parquet(tokens), pl.read_parquet(pools))
+            ret_list = swaps_from_frame(enrich_swaps_v2(swaps_df, lookup), registry)
+            stage.add(len(ret_list))
         logging.info("Finished processing v2 logs!!!")
         return ret_list
 
 
+def build_pool_lookup(tokens_df: pl.DataFrame, pools_df: pl.DataFrame) -> pl.DataFrame:
+    # duplicated addresses are dropped entirely, as the old row(by_predicate=...)
+    # lookup raised on them and skipped the swap
+    tokens_df = as_address_bytes(tokens_df, ["contract_address"])
+    pools_df = as_address_bytes(pools_df, ["pool_address", "token0", "token1"])
+    # and tokens without decimals can't be normalized, so their pools go too
+    tokens_df = (
+        tokens_df.unique("contract_address", keep="none")
+        .drop_nulls("decimal")
+        .select(
+            pl.col("contract_address"),
+            pl.col("symbol"),
+            pl.col("decimal"),
+            pl.col("decimal")
+            .replace_strict(DECIMAL_SCALES, default=None, return_dtype=pl.Float64)
+            .alias("scale"),
+        )
+    )
+    lookup = pools_df.unique("pool_address", keep="none").select(
+        pl.col("pool_address").alias("address"),
+        pl.col("token0"),
+        pl.col("token1"),
+    )
+    for side in ("token0", "token1"):
+        lookup = lookup.join(
+            tokens_df.rename(
+                {
+                    "contract_address": side,
+                    "symbol": f"{side}_symbol",
+                    "decimal": f"{side}_decimals",
+                    "scale": f"{side}_scale",
+                }
+            ),
+            on=side,
+            how="inner",
+            maintain_order="left",
+        )
+    return lookup
+
+
+def _join_pools(swaps_df: pl.DataFrame, lookup: pl.DataFrame) -> pl.DataFrame:
+    if DEBUG:
+        swaps_df = swaps_df.head(100000)
+    joined = swaps_df.join(lookup, on="address", how="inner", maintain_order="left")
+    dropped = swaps_df.shape[0] - joined.shape[0]
+    METRICS.count("swaps_unknown_pool", dropped)
+    if dropped > 0:
+        logging.info(f"Dropped {dropped} swaps with unknown pool or tokens")
+    return joined
+
+
+def _swap_columns(pool_delta_t0: pl.Expr, pool_delta_t1: pl.Expr) -> List[pl.Expr]:
+    return [
+        pl.col("block_number"),
+        pl.col("transaction_index"),
+        pl.col("log_index"),
+        hex_address("transaction_hash").alias("transaction_hash"),
+        pl.col("address").alias("pool_address"),
+        hex_address("topic0").alias("topic0"),
+        pl.col("chain_id"),
+        pl.col("token0"),
+        pl.col("token0_symbol"),
+        pl.col("token0_decimals"),
+        pl.col("token0_scale"),
+        pl.col("token1"),
+        pl.col("token1_symbol"),
+        pl.col("token1_decimals"),
+        pl.col("token1_scale"),
+        pool_delta_t0.alias("pool_delta_t0_unnormalized"),
+        pool_delta_t1.alias("pool_delta_t1_unnormalized"),
+    ]
+
+
+def _finish_swaps(df: pl.DataFrame) -> pl.DataFrame:
+    df = df.with_columns(
+        (-pl.col("pool_delta_t0_unnormalized") / pl.col("token0_scale")).alias(
+            "user_delta_t0_normalized"
+        ),
+        (-pl.col("pool_delta_t1_unnormalized") / pl.col("token1_scale")).alias(
+            "user_delta_t1_normalized"
+        ),
+    ).with_columns(
+        pl.when(pl.col("user_delta_t0_normalized") != 0.0)
+        .then(-pl.col("user_delta_t1_normalized") / pl.col("user_delta_t0_normalized"))
+        .otherwise(0.0)
+        .alias("execution_price"),
+        (pl.col("user_delta_t0_normalized") > 0).alias("token0_buy"),
+    )
+    return df.drop("token0_scale", "token1_scale")
+
+
+def _raw_amount(column: str) -> pl.Expr:
+    return pl.col(column).cast(EXACT_AMOUNT, strict=False)
+
+
+def _exact_columns(pool_delta_t0: pl.Expr, pool_delta_t1: pl.Expr) -> List[pl.Expr]:
+    return [
+        pool_delta_t0.cast(EXACT_AMOUNT, strict=False).alias("pool_delta_t0_raw"),
+        pool_delta_t1.cast(EXACT_AMOUNT, strict=False).alias("pool_delta_t1_raw"),
+    ]
+
+
+def enrich_swaps_v3(
+    swaps_df: pl.DataFrame, lookup: pl.DataFrame, exact: bool = False
+) -> pl.DataFrame:
+    raw = []
+    if exact:
+        raw = _exact_columns(
+            _raw_amount("event__amount0_string"), _raw_amount("event__amount1_string")
+        )
+    df = _join_pools(swaps_df, lookup).select(
+        *_swap_columns(pl.col("event__amount0_f64"), pl.col("event__amount1_f64")),
+        pl.col("event__sender").alias("sender"),
+        pl.col("event__recipient").alias("recipient"),
+        pl.lit(True).alias("is_v3"),
+        pl.col("event__sqrtPriceX96_f64").alias("sqrt_price_x86"),
+        pl.col("event__liquidity_f64").alias("liquidity"),
+        pl.col("event__tick").alias("tick"),
+        # token1 per whole token0, scaled by both tokens' decimals
+        (
+            pl.col("event__sqrtPriceX96_f64")
+            * pl.col("event__sqrtPriceX96_f64")
+            / float(2**192)
+            * pl.col("token0_scale")
+            / pl.col("token1_scale")
+        ).alias("price_after_swap"),
+        *raw,
+    )
+    return _finish_swaps(df)
+
+
+def enrich_swaps_v2(
+    swaps_df: pl.DataFrame, lookup: pl.DataFrame, exact: bool = False
+) -> pl.DataFrame:
+    raw = []
+    if exact:
+        raw = _exact_columns(
+            _raw_amount("event__amount0In_string")
+            - _raw_amount("event__amount0Out_string"),
+            _raw_amount("event__amount1In_string")
+            - _raw_amount("event__amount1Out_string"),
+        )
+    df = _join_pools(swaps_df, lookup).select(
+        *_swap_columns(
+            pl.col("event__amount0In_f64") - pl.col("event__amount0Out_f64"),
+            pl.col("event__amount1In_f64") - pl.col("event__amount1Out_f64"),
+        ),
+        pl.col("event__sender").alias("sender"),
+        pl.col("event__to").alias("recipient"),
+        pl.lit(False).alias("is_v3"),
+        *raw,
+    )
+    return _finish_swaps(df)
+
+
+def enrich_swaps(
+    df2: pl.DataFrame, df3: pl.DataFrame, lookup: pl.DataFrame, exact: bool = False
+) -> pl.DataFrame:
+    return pl.concat(
+        [enrich_swaps_v3(df3, lookup, exact), enrich_swaps_v2(df2, lookup, exact)],
+        how="diagonal_relaxed",
+    )
+
+
+def swaps_from_frame(
+    swaps: pl.DataFrame, registry: Optional[ObjectRegistry] = None
+) -> List[Swap_x]:
+    # v2 and v3 swaps analyzed together must share one registry
+    if registry is None:
+        registry = ObjectRegistry()
+    for column in ("pool_address", "token0", "token1", "sender", "recipient"):
+        swaps = checksum_column(swaps, column)
+    ret_list = []
+    for row in swaps.iter_rows(named=True):
+        pool = registry.pool(
+            row["pool_address"],
+            registry.token(row["token0"], row["token0_symbol"], row["token0_decimals"]),
+            registry.token(row["token1"], row["token1_symbol"], row["token1_decimals"]),
+            row["is_v3"],
+        )
+        fields = {
+            "block_number": row["block_number"],
+            "transaction_index": row["transaction_index"],
+            "log_index": row["log_index"],
+            "transaction_hash": row["transaction_hash"],
+            "pool": pool,
+            "topic0": row["topic0"],
+            "sender": row["sender"],
+            "recipient": row["recipient"],
+            "chain_id": row["chain_id"],
+            "pool_delta_t0_unnormalized": row["pool_delta_t0_unnormalized"],
+            "pool_delta_t1_unnormalized": row["pool_delta_t1_unnormalized"],
+            "user_delta_t0_normalized": row["user_delta_t0_normalized"],
+            "user_delta_t1_normalized": row["user_delta_t1_normalized"],
+            "token0_buy": row["token0_buy"],
+            "execution_price": row["execution_price"],
+        }
+        if row["is_v3"]:
+            sw = SwapV3(
+                **fields,
+                sqrt_price_x86=row["sqrt_price_x86"],
+                liquidity=row["liquidity"],
+                tick=row["tick"],
+                price_after_swap=row["price_after_swap"],
+            )
+        else:
+            sw = SwapV2(**fields)
+        ret_list.append(sw)
+    return ret_list
+
+
 @dataclass
 class Transaction:
     block_number: int
@@ -310,16 +462,12 @@ class Transaction:
     swaps: List[Swap_x]
 
     def analyze(self) -> (bool, Dict[str, Union[int, float, str, List[str]]]):
-        pools: Set[Pool] = set(map(lambda x: x.pool, self.swaps))
-        tokens: Set[Token] = set()
-        for pool in pools:
-            tokens.add(pool.token1)
-            tokens.add(pool.token0)
         self.swaps.sort(key=lambda x: x.log_index)
+        pools = [swap.pool for swap in self.swaps]
         balance_changes: Dict[str, float] = {}
-        for swap in self.swaps:
-            token0_sym = swap.pool.token0.symbol
-            token1_sym = swap.pool.token1.symbol
+        for swap, pool in zip(self.swaps, pools):
+            token0_sym = pool.token0.symbol
+            token1_sym = pool.token1.symbol
             if token0_sym in balance_changes.keys():
                 balance_changes[token0_sym] = (
                     balance_changes[token0_sym] + swap.user_delta_t0_normalized
@@ -334,13 +482,14 @@ class Transaction:
                 balance_changes[token1_sym] = swap.user_delta_t1_normalized
         self.balance_changes = balance_changes
 
-        ins: Set[Token] = set()
-        outs: Set[Token] = set()
+        # token ids from here on
+        ins: Set[int] = set()
+        outs: Set[int] = set()
         factor4 = True
-        stack4: List[Token] = []
-        for swap in self.swaps:
-            tin = swap.pool.token1 if swap.token0_buy else swap.pool.token0
-            tout = swap.pool.token0 if swap.token0_buy else swap.pool.token1
+        stack4: List[int] = []
+        for swap, pool in zip(self.swaps, pools):
+            tin = pool.token1.id if swap.token0_buy else pool.token0.id
+            tout = pool.token0.id if swap.token0_buy else pool.token1.id
             if factor4:
                 if len(stack4) == 0:
                     stack4.append(tin)
@@ -355,32 +504,33 @@ class Transaction:
                 ins.add(tin)
         sec = ins.intersection(outs)
         t_in = (
-            self.swaps[0].pool.token1.symbol
+            pools[0].token1.symbol
             if self.swaps[0].token0_buy
-            else self.swaps[0].pool.token0.symbol
+            else pools[0].token0.symbol
         )
         last = len(self.swaps) - 1
         t_out = (
-            self.swaps[last].pool.token0.symbol
+            pools[last].token0.symbol
             if self.swaps[last].token0_buy
-            else self.swaps[last].pool.token1.symbol
+            else pools[last].token1.symbol
         )
         deltas = list(balance_changes.values())
         factor1 = len(sec) > 0
         factor2 = t_out == t_in
         factor3 = len(deltas) - 1 == deltas.count(0.0)
         factor4 = factor4 and len(stack4) == 2 and stack4[0] == stack4[1]
-        path_str = t_in
+        # an unreadable symbol is spelled "None" along the whole path
+        path_str = f"{t_in}"
         if factor1 and factor2 and factor3 and factor4:
             senders = set()
             recipients = set()
-            for swap in self.swaps:
+            for swap, pool in zip(self.swaps, pools):
                 senders.add(swap.sender)
                 recipients.add(swap.recipient)
                 if swap.token0_buy:
-                    path_str = path_str + f"->{swap.pool.token0.symbol}"
+                    path_str = path_str + f"->{pool.token0.symbol}"
                 else:
-                    path_str = path_str + f"->{swap.pool.token1.symbol}"
+                    path_str = path_str + f"->{pool.token1.symbol}"
             self.profit_token_amount = [
                 (x, balance_changes[x])
                 for x in balance_changes
@@ -401,26 +551,28 @@ class Transaction:
     @staticmethod
     def bundle_swaps(swaps: List[Swap_x]) -> List["Transaction"]:
         logging.info("Started bundling swaps!!!")
-        indexer = {}
-        txs = []
-        new_idx = 0
-        for s in swaps:
-            if s.transaction_hash in indexer.keys():
-                txs[indexer[s.transaction_hash]].append(s)
-            else:
-                indexer[s.transaction_hash] = new_idx
-                txs.append([s])
-                new_idx = new_idx + 1
-        txs_ret = []
-        for tx in txs:
-            txs_ret.append(
-                Transaction(
-                    block_number=tx[0].block_number,
-                    transaction_index=tx[0].transaction_index,
-                    transaction_hash=tx[0].transaction_hash,
-                    swaps=tx,
+        with METRICS.stage("bundle_swaps") as stage:
+            indexer = {}
+            txs = []
+            new_idx = 0
+            for s in swaps:
+                if s.transaction_hash in indexer.keys():
+                    txs[indexer[s.transaction_hash]].append(s)
+                else:
+                    indexer[s.transaction_hash] = new_idx
+                    txs.append([s])
+                    new_idx = new_idx + 1
+            txs_ret = []
+            for tx in txs:
+                txs_ret.append(
+                    Transaction(
+                        block_number=tx[0].block_number,
+                        transaction_index=tx[0].transaction_index,
+                        transaction_hash=tx[0].transaction_hash,
+                        swaps=tx,
+                    )
                 )
-            )
+            stage.add(len(swaps))
 
         logging.info("Done with bundling swaps!!!")
         return txs_ret
@@ -441,73 +593,489 @@ class Transaction:
         return self.__str__()
 
 
+def _exact_profits(df: pl.DataFrame) -> pl.DataFrame:
+    # raw integer amounts net exactly; a symbol shared by tokens with different
+    # decimals is netted at the largest of them
+    legs = pl.concat(
+        [
+            df.select(
+                "tx",
+                "step",
+                pl.lit(0).alias("leg"),
+                pl.col("token0_symbol").alias("symbol"),
+                pl.col("token0_decimals").alias("decimals"),
+                (-pl.col("pool_delta_t0_raw")).alias("delta"),
+            ),
+            df.select(
+                "tx",
+                "step",
+                pl.lit(1).alias("leg"),
+                pl.col("token1_symbol").alias("symbol"),
+                pl.col("token1_decimals").alias("decimals"),
+                (-pl.col("pool_delta_t1_raw")).alias("delta"),
+            ),
+        ]
+    ).sort(["tx", "step", "leg"])
+    shift = pl.col("scale") - pl.col("decimals")
+    legs = (
+        legs.with_columns(
+            pl.col("decimals").max().over(["tx", "symbol"]).alias("scale")
+        )
+        .with_columns(
+            shift.replace_strict(
+                EXACT_SCALES, default=None, return_dtype=EXACT_AMOUNT
+            ).alias("factor"),
+            (
+                pl.col("delta").cast(pl.Float64)
+                * shift.replace_strict(
+                    DECIMAL_SCALES, default=None, return_dtype=pl.Float64
+                )
+            ).alias("magnitude"),
+        )
+        .with_columns(
+            # every running balance lies between the sums of the inflows and outflows
+            pl.max_horizontal(
+                pl.col("magnitude").clip(lower_bound=0).sum(),
+                -pl.col("magnitude").clip(upper_bound=0).sum(),
+            ).over(["tx", "symbol"])
+        )
+    )
+    incomplete = (
+        legs.filter(
+            pl.col("delta").is_null()
+            | pl.col("factor").is_null()
+            | (pl.col("magnitude") >= EXACT_LIMIT)
+        )
+        .select("tx")
+        .unique()
+    )
+    if incomplete.shape[0] > 0:
+        logging.info(
+            f"Skipped {incomplete.shape[0]} transactions with amounts past 38 digits"
+        )
+    return (
+        legs.join(incomplete, on="tx", how="anti", maintain_order="left")
+        .with_columns(pl.col("delta") * pl.col("factor"))
+        .group_by(["tx", "symbol"], maintain_order=True)
+        .agg(pl.col("delta").sum().alias("balance"), pl.col("scale").first())
+        .filter(pl.col("balance") != 0)
+        .group_by("tx", maintain_order=True)
+        .agg(
+            pl.col("symbol").first().alias("profit_token"),
+            (
+                pl.col("balance").first().cast(pl.Float64)
+                / pl.col("scale")
+                .first()
+                .replace_strict(DECIMAL_SCALES, default=None, return_dtype=pl.Float64)
+            ).alias("profit_amount"),
+            pl.len().alias("non_zero"),
+        )
+        .filter(pl.col("non_zero") == 1)
+    )
+
+
+def detect_arbitrage(swaps: pl.DataFrame) -> pl.DataFrame:
+    # same rules as Transaction.analyze; a transaction is keyed by the position
+    # of its first swap so the output keeps bundle_swaps ordering
+    df = (
+        swaps.with_row_index("seen")
+        .with_columns(
+            pl.col("seen").min().over("transaction_hash").alias("tx"),
+            pl.when(pl.col("token0_buy"))
+            .then(pl.col("token1"))
+            .otherwise(pl.col("token0"))
+            .alias("t_in"),
+            pl.when(pl.col("token0_buy"))
+            .then(pl.col("token0"))
+            .otherwise(pl.col("token1"))
+            .alias("t_out"),
+            pl.when(pl.col("token0_buy"))
+            .then(pl.col("token1_symbol"))
+            .otherwise(pl.col("token0_symbol"))
+            .alias("t_in_symbol"),
+            pl.when(pl.col("token0_buy"))
+            .then(pl.col("token0_symbol"))
+            .otherwise(pl.col("token1_symbol"))
+            .alias("t_out_symbol"),
+        )
+        .sort(["tx", "log_index", "seen"])
+        .with_columns(pl.int_range(pl.len()).over("tx").alias("step"))
+        .with_columns(
+            (
+                (pl.col("step") == 0)
+                | pl.col("t_in").eq_missing(pl.col("t_out").shift(1).over("tx"))
+            ).alias("chained")
+        )
+    )
+
+    # factor1: a token that enters the cycle before it is first bought back
+    first_in = df.group_by(["tx", "t_in"]).agg(pl.col("step").min().alias("first_in"))
+    first_out = df.group_by(["tx", "t_out"]).agg(
+        pl.col("step").min().alias("first_out")
+    )
+    cyclic = (
+        first_in.join(first_out, left_on=["tx", "t_in"], right_on=["tx", "t_out"])
+        .filter(pl.col("first_in") < pl.col("first_out"))
+        .select("tx")
+        .unique()
+    )
+
+    # factor3: balances are netted per symbol in swap order, token0 leg first
+    if "pool_delta_t0_raw" in df.columns:
+        profits = _exact_profits(df)
+    else:
+        legs = pl.concat(
+            [
+                df.select(
+                    "tx",
+                    "step",
+                    pl.lit(0).alias("leg"),
+                    pl.col("token0_symbol").alias("symbol"),
+                    pl.col("user_delta_t0_normalized").alias("delta"),
+                ),
+                df.select(
+                    "tx",
+                    "step",
+                    pl.lit(1).alias("leg"),
+                    pl.col("token1_symbol").alias("symbol"),
+                    pl.col("user_delta_t1_normalized").alias("delta"),
+                ),
+            ]
+        ).sort(["tx", "step", "leg"])
+        profits = (
+            legs.group_by(["tx", "symbol"], maintain_order=True)
+            .agg(pl.col("delta").cum_sum().last().alias("balance"))
+            .filter(pl.col("balance").abs() != 0.0)
+            .group_by("tx", maintain_order=True)
+            .agg(
+                pl.col("symbol").first().alias("profit_token"),
+                pl.col("balance").first().alias("profit_amount"),
+                pl.len().alias("non_zero"),
+            )
+            .filter(pl.col("non_zero") == 1)
+        )
+
+    txs = df.group_by("tx").agg(
+        pl.col("transaction_hash").first(),
+        pl.col("block_number").sort_by("seen").first(),
+        pl.col("transaction_index").sort_by("seen").first(),
+        pl.col("t_in_symbol")
+        .first()
+        .eq_missing(pl.col("t_out_symbol").last())
+        .alias("factor2"),
+        (
+            pl.col("chained").all()
+            & pl.col("t_in").first().eq_missing(pl.col("t_out").last())
+        ).alias("factor4"),
+        pl.concat_str(
+            pl.col("t_in_symbol").first().fill_null("None"),
+            pl.lit("->"),
+            pl.col("t_out_symbol").fill_null("None").str.join("->"),
+        ).alias("path"),
+        pl.col("sender").unique(maintain_order=True).alias("senders"),
+    )
+    mev = (
+        txs.filter(pl.col("factor2") & pl.col("factor4"))
+        .join(cyclic, on="tx", how="semi")
+        .join(profits, on="tx")
+        .sort("tx")
+    )
+    return mev.select([pl.col(k).cast(v) for (k, v) in MEV_SCHEMA.items()])
+
+
+def analyze_reference(swaps: pl.DataFrame) -> pl.DataFrame:
+    mev = []
+    txs = Transaction.bundle_swaps(swaps_from_frame(swaps))
+    with METRICS.stage("analyze") as stage:
+        for x in txs:
+            a = x.analyze()
+            if a[0]:
+                mev.append(a[1])
+        stage.add(len(txs))
+    # the Swap objects carry checksummed senders
+    schema = {**MEV_SCHEMA, "senders": pl.List(pl.String)}
+    return as_address_bytes(pl.DataFrame(mev, schema=schema), ["senders"])
+
+
+def check_detection(swaps: pl.DataFrame):
+    # senders come out of a python set in analyze, so only their contents compare
+    ordered = pl.col("senders").list.sort()
+    expected = analyze_reference(swaps).with_columns(ordered)
+    actual = detect_arbitrage(swaps).with_columns(ordered)
+    if not actual.equals(expected):
+        raise AssertionError(
+            f"detect_arbitrage disagrees with Transaction.analyze:\n{actual}\n{expected}"
+        )
+
+
+def chunk_files(path: str, version: str, low: int, high: int) -> List[str]:
+    # cryo names chunks {chain}__logs__{label}__{first}_to_{last}.parquet, so
+    # chunks outside [low, high) are skipped without opening them
+    ret = overlapping_chunks(path, version, low, high)
+    # keep one file so an empty window still has the cryo schema
+    return ret if len(ret) > 0 else log_files(path, version)[:1]
+
+
+def window_inputs(path: str, low: int, high: int) -> List[str]:
+    return overlapping_chunks(path, "v2", low, high) + overlapping_chunks(
+        path, "v3", low, high
+    )
+
+
+def scan_swaps(
+    path: str, version: str, low: int, high: int, exact: bool = False
+) -> pl.LazyFrame:
+    columns = V2_COLUMNS if version == "v2" else V3_COLUMNS
+    if exact:
+        columns = columns + (V2_EXACT_COLUMNS if version == "v2" else V3_EXACT_COLUMNS)
+    # overlapping or re-fetched cryo chunks contain the same logs twice
+    return (
+        pl.scan_parquet(chunk_files(path, version, low, high))
+        .select(columns)
+        .filter((pl.col("block_number") >= low) & (pl.col("block_number") < high))
+        .unique(LOG_KEY, keep="first", maintain_order=True)
+    )
+
+
+def estimate_swaps(path: str, low: int, high: int) -> int:
+    total = 0
+    for version in ("v2", "v3"):
+        for f in chunk_files(path, version, low, high):
+            rows = pl.scan_parquet(f).select(pl.len()).collect().item()
+            r = chunk_range(f)
+            if r is None:
+                total = total + rows
+                continue
+            overlap = min(high, r[1]) - max(low, r[0])
+            total = total + rows * max(overlap, 0) // (r[1] - r[0])
+    return total
+
+
+def plan_batches(
+    path: str, low: int, high: int, memory_budget_mb: int
+) -> List[tuple[int, int]]:
+    # transactions never span blocks, so a window can be split on block
+    # boundaries without changing the detection result
+    estimated = estimate_swaps(path, low, high) * BYTES_PER_SWAP
+    n = max(1, min(high - low, math.ceil(estimated / (memory_budget_mb * 2**20))))
+    step = math.ceil((high - low) / n)
+    return [(x, min(x + step, high)) for x in range(low, high, step)]
+
+
+def process_window_streaming(
+    path: str,
+    low: int,
+    high: int,
+    lookup: pl.DataFrame,
+    file_name: str,
+    memory_budget_mb: int,
+    exact: bool = False,
+):
+    batches = plan_batches(path, low, high, memory_budget_mb)
+    # parts sit next to the window file, in its partition directory
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    parts = []
+    for n, (lo, hi) in enumerate(batches):
+        with METRICS.stage("scan_swaps") as stage:
+            df2 = scan_swaps(path, "v2", lo, hi, exact).collect()
+            df3 = scan_swaps(path, "v3", lo, hi, exact).collect()
+            stage.add(df2.shape[0] + df3.shape[0])
+        swaps = _enrich(df2, df3, lookup, exact)
+        del df2, df3
+        if DEBUG and not exact:
+            check_detection(swaps)
+        mev_df = _detect(swaps)
+        del swaps
+        part = f"{file_name}.part{n}"
+        mev_df.write_parquet(part)
+        parts.append(part)
+    dataset.write_window(pl.scan_parquet(parts), file_name)
+    for part in parts:
+        os.remove(part)
+
+
+def _enrich(
+    df2: pl.DataFrame, df3: pl.DataFrame, lookup: pl.DataFrame, exact: bool
+) -> pl.DataFrame:
+    with METRICS.stage("enrich_swaps") as stage:
+        swaps = enrich_swaps(df2, df3, lookup, exact)
+        stage.add(swaps.shape[0])
+    return swaps
+
+
+def _detect(swaps: pl.DataFrame) -> pl.DataFrame:
+    with METRICS.stage("detect_arbitrage") as stage:
+        mev_df = detect_arbitrage(swaps)
+        stage.add(swaps.shape[0])
+    METRICS.count("arbitrage_transactions", mev_df.shape[0])
+    return mev_df
+
+
 def fetch_swap_data(path: str) -> tuple[pl.DataFrame, pl.DataFrame]:
     path_v2 = path + "__logs__v2*.parquet"
     path_v3 = path + "__logs__v3*.parquet"
-    df2 = pl.read_parquet(path_v2)
-    df3 = pl.read_parquet(path_v3)
+    df2 = pl.read_parquet(path_v2).unique(LOG_KEY, keep="first", maintain_order=True)
+    df3 = pl.read_parquet(path_v3).unique(LOG_KEY, keep="first", maintain_order=True)
     return (df2, df3)
 
 
+_LOOKUP = None
+
+
+def _init_worker(lookup: pl.DataFrame):
+    global _LOOKUP
+    _LOOKUP = lookup
+
+
+def _process_window_task(args: tuple) -> tuple[int, int, str, Dict]:
+    (path, low, high, file_name, memory_budget_mb, exact) = args
+    METRICS.reset()
+    process_window_streaming(
+        path, low, high, _LOOKUP, file_name, memory_budget_mb, exact
+    )
+    return (low, high, file_name, METRICS.snapshot())
+
+
+@contextmanager
+def _worker_pool(workers: int, lookup: pl.DataFrame):
+    # polars sizes its thread pool from the environment on import, so the cap is
+    # set only while the workers are spawned and never reaches this process's
+    # later stages or its other subprocesses
+    previous = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // workers))
+    try:
+        pool = multiprocessing.get_context("spawn").Pool(
+            workers, _init_worker, (lookup,)
+        )
+    finally:
+        if previous is None:
+            del os.environ["POLARS_MAX_THREADS"]
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous
+    with pool:
+        yield pool
+
+
+def _adopt_outputs(manifest: Manifest, path: str, chain_name: str):
+    # window files from before the dataset layout move into it, with their
+    # checksummed senders as binary; those written before the manifest existed
+    # count as done
+    for f in glob.glob(f"{chain_name}_*_mev.parquet"):
+        m = re.fullmatch(rf"{chain_name}_(\d+)_(\d+)_mev\.parquet", f)
+        if m is None:
+            continue
+        (low, high) = (int(m[1]), int(m[2]))
+        outputs = []
+        for lo, hi in dataset.split_buckets(low, high):
+            out = dataset.window_file(chain_name, lo, hi)
+            dataset.write_window(
+                as_address_bytes(pl.scan_parquet(f), ["senders"]).filter(
+                    (pl.col("block_number") >= lo) & (pl.col("block_number") < hi)
+                ),
+                out,
+            )
+            outputs.append(out)
+        entries = [e for e in manifest.entries if f in e["outputs"]]
+        if len(entries) > 0:
+            manifest.merge(entries, outputs)
+            continue
+        manifest.record(
+            "swaps", chain_name, low, high, window_inputs(path, low, high), outputs
+        )
+        os.remove(f)
+
+
 def process_chain(path: str, provider: Provider):
-    (df2, df3) = fetch_swap_data(path)
     chain_name = path.split("/")[1]
     path_tokens = f"{chain_name}_tokens.parquet"
     path_pools = f"{chain_name}_pools.parquet"
-    range_low = (
-        provider.start_block_arbitrum
-        if chain_name == "arbitrum"
-        else provider.start_block_optimism
+    range_low = getattr(provider, f"start_block_{chain_name}")
+    range_high = getattr(provider, f"end_block_{chain_name}")
+    exact = provider.exact_amounts
+    # both modes write the same window files, so switching modes drops the
+    # other mode's windows and recomputes them
+    stage = "swaps_exact" if exact else "swaps"
+    manifest = Manifest()
+    _adopt_outputs(manifest, path, chain_name)
+    if len(manifest.discard("swaps" if exact else "swaps_exact", chain_name)) > 0:
+        logging.info("Amount mode changed, recomputing all windows!!!")
+    for e in manifest.drop_stale(
+        stage, chain_name, lambda low, high: window_inputs(path, low, high)
+    ):
+        logging.info(f"Inputs of {e['outputs']} changed, recomputing!!!")
+    delta = max(1, (range_high - range_low) // provider.window_count)
+    windows = []
+    for low, high in manifest.missing(stage, chain_name, range_low, range_high):
+        for curr in range(low, high, delta):
+            # windows stop at bucket boundaries so each lands in one partition
+            for lo, hi in dataset.split_buckets(curr, min(curr + delta, high)):
+                windows.append((lo, hi, dataset.window_file(chain_name, lo, hi)))
+    if len(windows) == 0:
+        logging.info(f"All of {range_low}-{range_high} already done, skipping!!")
+        return
+    lookup = build_pool_lookup(
+        pl.read_parquet(path_tokens), pl.read_parquet(path_pools)
     )
-    range_high = (
-        provider.end_block_arbitrum
-        if chain_name == "arbitrum"
-        else provider.end_block_optimism
-    )
-    curr = range_low
-    delta = (range_high - range_low) // 50
-    while curr < range_high:
-        curr_high = curr + delta
+
+    progress = Progress(f"{chain_name} windows", len(windows), interval=0)
+
+    def done(low: int, high: int, file_name: str):
+        manifest.record(
+            stage, chain_name, low, high, window_inputs(path, low, high), [file_name]
+        )
+        logging.info(f"Written {file_name}!!!")
+        progress.update()
+
+    workers = min(provider.workers or os.cpu_count(), len(windows))
+    if STREAMING and workers > 1:
+        # spawned workers receive the lookup once; each gets an equal share of
+        # the memory budget and of the polars thread pool
+        tasks = [
+            (path, low, high, file_name, provider.memory_budget_mb / workers, exact)
+            for (low, high, file_name) in windows
+        ]
+        with _worker_pool(workers, lookup) as pool:
+            for low, high, file_name, snapshot in pool.imap_unordered(
+                _process_window_task, tasks
+            ):
+                METRICS.merge(snapshot)
+                done(low, high, file_name)
+        return
+    if not STREAMING:
+        (df2, df3) = fetch_swap_data(path)
+    for low, high, file_name in windows:
+        logging.info(f"Operating on {file_name}!!!")
+        if STREAMING:
+            process_window_streaming(
+                path, low, high, lookup, file_name, provider.memory_budget_mb, exact
+            )
+            done(low, high, file_name)
+            continue
         df2x = df2.filter(
-            (pl.col("block_number") >= curr) & (pl.col("block_number") < curr_high)
+            (pl.col("block_number") >= low) & (pl.col("block_number") < high)
         )
         df3x = df3.filter(
-            (pl.col("block_number") >= curr) & (pl.col("block_number") < curr_high)
+            (pl.col("block_number") >= low) & (pl.col("block_number") < high)
         )
-        file_name = f"{chain_name}_{curr}_{curr_high}_mev.parquet"
-        if os.path.exists(file_name):
-            logging.info(f"Already done: {file_name}, skipping!!")
-            curr = curr_high
-            continue
-        logging.info(f"Operating on {file_name}!!!")
 
-        l3 = SwapV3.process_log_v3(df3x, path_tokens, path_pools)
-        l2 = SwapV2.process_log_v2(df2x, path_tokens, path_pools)
-        l3.extend(l2)
-        txs = Transaction.bundle_swaps(l3)
-        mev = []
+        swaps = _enrich(df2x, df3x, lookup, exact)
         logging.info("Processing txs!!!")
-        total = len(txs)
-        done = 0
-        for x in txs:
-            a = x.analyze()
-            if a[0]:
-                mev.append(a[1])
-            done = done + 1
-            print(f"Done with {(100 * done / total):.4f}%", end="\r")
-        mev_df = pl.DataFrame(mev)
-        mev_df.write_parquet(f"{chain_name}_{curr}_{curr_high}_mev.parquet")
-        curr = curr_high
+        if DEBUG and not exact:
+            check_detection(swaps)
+        mev_df = _detect(swaps)
+        dataset.write_window(mev_df, file_name)
+        done(low, high, file_name)
 
 
 def main():
     logging.info("Started Processing!!!")
     provider = Provider.generate()
     paths = ["./arbitrum/arbitrum", "./optimism/optimism"]  # "./base/base"]
-    for i in paths:
-        logging.info(f"Processing {i}!!!")
-        process_chain(i, provider)
-        logging.info(f"Processing {i} done!!!")
+    with run_metrics("period2", provider.profile):
+        for i in paths:
+            logging.info(f"Processing {i}!!!")
+            process_chain(i, provider)
+            logging.info(f"Processing {i} done!!!")
 
 
 if __name__ == "__main__":
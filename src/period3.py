@@ -1,85 +1,130 @@
 import polars as pl
-from typing import Dict
-from web3 import Web3, HTTPProvider
 import logging
 import os
-import re
-from utils import Provider
+from typing import List
+import dataset
+import prices
+from manifest import Manifest
+from metrics import METRICS, run_metrics
+from bytecode import BytecodeStore, fetch_code_hashes
+from utils import Provider, RpcEndpoint, checksum_column
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 
-def process_chain(path: str, rpc: str):
-    files = [f for f in os.listdir(".") if os.path.isfile(f)]
-    pattern = rf"{path}.*mev\.parquet$"
-    matches = [s for s in files if re.fullmatch(pattern, s)]
+def summarize_senders(mev_df: pl.DataFrame) -> pl.DataFrame:
+    # one row per (mev row, distinct sender), then everything is a group-by;
+    # profits valued by prices.value_mev are summed across tokens as well
+    valued = "profit_usd" in mev_df.columns
+    exploded = (
+        mev_df.select(
+            "block_number",
+            "profit_token",
+            "profit_amount",
+            *(["profit_usd"] if valued else []),
+            pl.col("senders").list.unique().alias("address"),
+        )
+        .explode("address")
+        .drop_nulls("address")
+    )
+    per_token = exploded.group_by(["address", "profit_token"]).agg(
+        pl.len().cast(pl.Int64).alias("count"),
+        pl.col("profit_amount").sum().alias("total_profit"),
+    )
+    by_token = per_token.group_by("address").agg(
+        pl.col("profit_token")
+        .sort_by(["count", "profit_token"], descending=[True, False])
+        .first()
+        .alias("main_profit_token"),
+        pl.col("count").max().alias("count_main"),
+        pl.struct("profit_token", "count", "total_profit")
+        .sort_by(["count", "profit_token"], descending=[True, False])
+        .alias("profit_by_token"),
+    )
+    return (
+        exploded.group_by("address")
+        .agg(
+            pl.len().cast(pl.Int64).alias("count"),
+            pl.col("block_number").min().alias("first_block"),
+            pl.col("block_number").max().alias("last_block"),
+            *([pl.col("profit_usd").sum().alias("total_profit_usd")] if valued else []),
+        )
+        .join(by_token, on="address")
+        .sort(["count", "address"], descending=[True, False])
+    )
+
+
+def summary_inputs(path: str) -> List[str]:
+    # the price index is optional; once built, profits are valued with it
+    chain_name = path.rstrip("_")
+    index = [prices.index_file(chain_name)]
+    return dataset.mev_files(chain_name) + [f for f in index if os.path.exists(f)]
+
+
+def process_chain(path: str, endpoint: RpcEndpoint):
+    matches = dataset.mev_files(path.rstrip("_"))
     if len(matches) == 0:
         logging.warning(f"Mev files for {path} don't exist!!!")
         return
     resulting_fn = f"{path}mev_address_summary.parquet"
-    if os.path.exists(resulting_fn):
+    chain_name = path.rstrip("_")
+    inputs = summary_inputs(path)
+    manifest = Manifest()
+    if manifest.is_fresh("summary", chain_name, inputs):
+        logging.info(f"{resulting_fn} is up to date, skipping!!!")
         return
-    mev_df = pl.read_parquet(f"{path}*mev.parquet")
-    print(mev_df)
-    w3 = Web3(HTTPProvider(rpc))
-    rows = mev_df.shape[0]
-    ref: Dict[str, int] = {}
-    logging.info("Processing mev data!!!")
-    for i in range(0, rows):
-        addresses = set(mev_df["senders"][i].to_list())
-        for x in addresses:
-            if x in ref.keys():
-                ref[x] = ref[x] + 1
-            else:
-                ref[x] = 1
-        print(f"Done with {(100 * i / rows):.4f}%", end="\r")
-    ref = {k: v for k, v in sorted(ref.items(), key=lambda item: -item[1])}
-    address_summary_df = []
+    mev_df = (
+        dataset.scan_mev(chain_name).select(list(dataset.MEV_SCHEMA.keys())).collect()
+    )
+    logging.info(f"Processing {mev_df.shape[0]} mev rows!!!")
+    if len(inputs) > len(matches):
+        mev_df = prices.value_chain_mev(chain_name, mev_df)
+    with METRICS.stage("summarize_senders") as stage:
+        summary = summarize_senders(mev_df)
+        stage.add(mev_df.shape[0])
     logging.info("Queying contracts!!!")
-    to_do = len(ref)
-    done = 0
-    for i in ref.keys():
-        count = ref[i]
-        code = w3.eth.get_code(i)
-        profit_tokens = (
-            mev_df.filter(pl.col("senders").list.contains(i))
-            .group_by("profit_token")
-            .count()
-            .sort(-1 * pl.col("count"))
+    # code as of the last block the address was seen in; contracts already in the
+    # store for an earlier block aren't fetched again
+    with METRICS.stage("fetch_code_hashes") as stage:
+        codes = fetch_code_hashes(
+            BytecodeStore(),
+            chain_name,
+            summary["address"].to_list(),
+            summary["last_block"].to_list(),
+            endpoint,
         )
-        main_profit_token = profit_tokens["profit_token"][0]
-        main_p_count = profit_tokens["count"][0]
-        lentt = len("0x" + code.hex())
-        val = {
-            "address": i,
-            "count": count,
-            "main_profit_token": main_profit_token,
-            "count_main": main_p_count,
-            "bytecode": code,
-            "bytecode_length": lentt,
-        }
-        address_summary_df.append(val)
-        done = done + 1
-        print(f"Done with {(100 * done / to_do):.4f}%", end="\r")
-    address_summary_dfed = pl.DataFrame(address_summary_df)
-    address_summary_dfed = address_summary_dfed.sort(pl.col("bytecode_length") * -1)
-    address_summary_dfed.write_parquet(resulting_fn)
+        stage.add(summary.shape[0])
+    address_summary_dfed = summary.join(
+        codes.select("address", "code_hash", "code_size"), on="address", how="left"
+    ).sort(["code_size", "count"], descending=True, nulls_last=True)
+    # addresses stay binary up to this final output
+    checksum_column(address_summary_dfed, "address").write_parquet(resulting_fn)
+    blocks = [r for r in map(dataset.file_range, matches) if r is not None]
+    manifest.record(
+        "summary",
+        chain_name,
+        min([b[0] for b in blocks], default=0),
+        max([b[1] for b in blocks], default=0),
+        inputs,
+        [resulting_fn],
+    )
 
 
 def main():
     logging.info("Started Processing!!!")
     provider = Provider.generate()
     paths_rpc = [
-        ("optimism_", provider.optimism_rpc),
-        ("arbitrum_", provider.arbitrum_rpc),
-        ("base_", provider.base_rpc),
+        ("optimism_", provider.endpoint("optimism")),
+        ("arbitrum_", provider.endpoint("arbitrum")),
+        ("base_", provider.endpoint("base")),
     ]
-    for i in paths_rpc:
-        logging.info(f"Processing {i}!!!")
-        process_chain(i[0], i[1])
-        logging.info(f"Processing {i} done!!!")
+    with run_metrics("period3", provider.profile):
+        for i in paths_rpc:
+            logging.info(f"Processing {i}!!!")
+            process_chain(i[0], i[1])
+            logging.info(f"Processing {i} done!!!")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+from urllib.parse import urlsplit
+import dataset
+import ingest
+import period0
+import period2
+import period3
+import prices
+from manifest import Manifest, log_files, missing_ranges
+from metrics import run_metrics
+from registry import CHAIN_IDS
+from utils import Provider
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+STAGES = ["logs", "metadata", "swaps", "prices", "summary", "traces"]
+DEPENDS = {
+    "logs": [],
+    "metadata": ["logs"],
+    "swaps": ["metadata"],
+    "prices": ["metadata"],
+    "summary": ["swaps", "prices"],
+    "traces": ["swaps"],
+}
+# swaps keeps every core busy through its own worker pool, the others mostly
+# wait on the chain's rpc endpoint
+RESOURCES = {
+    "logs": "rpc",
+    "metadata": "rpc",
+    "swaps": "cpu",
+    "prices": "cpu",
+    "summary": "rpc",
+    "traces": "rpc",
+}
+# traces issues one debug_traceTransaction per mev transaction, so it only runs
+# when asked for
+DEFAULT_STAGES = ["logs", "metadata", "swaps", "prices", "summary"]
+SQLING = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sqling.py"
+)
+
+
+def chain_path(chain: str) -> str:
+    return f"./{chain}/{chain}"
+
+
+def traces_file(chain: str) -> str:
+    return f"interesting_traces_{chain[:3]}.parquet"
+
+
+def up_to_date(stage: str, chain: str, provider: Provider) -> bool:
+    # the same checks the stages make themselves, done here so finished stages
+    # don't even start a process
+    low = getattr(provider, f"start_block_{chain}")
+    high = getattr(provider, f"end_block_{chain}")
+    path = chain_path(chain)
+    manifest = Manifest()
+    if stage == "logs":
+        return all(len(missing_ranges(path, v, low, high)) == 0 for v in ("v2", "v3"))
+    if stage == "metadata":
+        inputs = log_files(path, "v2") + log_files(path, "v3")
+        return manifest.is_fresh("metadata", chain, inputs)
+    if stage == "swaps":
+        name = "swaps_exact" if provider.exact_amounts else "swaps"
+        other = "swaps" if provider.exact_amounts else "swaps_exact"
+        if len(manifest.entries_for(other, chain)) > 0:
+            return False
+        return manifest.is_complete(
+            name,
+            chain,
+            low,
+            high,
+            lambda lo, hi: period2.window_inputs(path, lo, hi),
+        )
+    if stage == "prices":
+        inputs = prices.index_inputs(path, chain, low, high)
+        return manifest.is_fresh("prices", chain, inputs)
+    mev = dataset.mev_files(chain)
+    if len(mev) == 0:
+        return False
+    if stage == "summary":
+        return manifest.is_fresh(stage, chain, period3.summary_inputs(f"{chain}_"))
+    return manifest.is_fresh(stage, chain, mev)
+
+
+def run_stage(stage: str, chain: str):
+    # entry point of the per-stage processes started by the scheduler
+    provider = Provider.generate()
+    with run_metrics(f"{stage}_{chain}", provider.profile):
+        if stage == "logs":
+            with ProcessPoolExecutor(
+                provider.workers or os.cpu_count(), mp_context=get_context("spawn")
+            ) as pool:
+                failed = asyncio.run(
+                    ingest.ingest_chain(
+                        chain,
+                        getattr(provider, f"start_block_{chain}"),
+                        getattr(provider, f"end_block_{chain}"),
+                        provider.endpoint(chain),
+                        provider.log_chunk_blocks,
+                        provider.getlogs_block_range,
+                        pool,
+                    )
+                )
+            if len(failed) > 0:
+                sys.exit(f"{len(failed)} chunks of {chain} failed")
+        elif stage == "metadata":
+            period0.process_chain(chain_path(chain), provider.endpoint(chain))
+        elif stage == "swaps":
+            period2.process_chain(chain_path(chain), provider)
+        elif stage == "prices":
+            prices.process_chain(chain_path(chain), provider)
+        elif stage == "summary":
+            period3.process_chain(f"{chain}_", provider.endpoint(chain))
+        else:
+            raise ValueError(f"unknown stage {stage}")
+
+
+class Scheduler:
+    # one task per (chain, stage); a task starts once its dependencies are done
+    # and a slot of its resource is free: cpu slots are global, rpc slots are
+    # per endpoint host so chains sharing a provider share its limit
+    def __init__(
+        self,
+        provider: Provider,
+        chains: List[str],
+        stages: List[str],
+        cpu_slots: int,
+        rpc_slots: int,
+    ):
+        self.provider = provider
+        self.chains = chains
+        self.stages = stages
+        self.cpu_slots = cpu_slots
+        self.rpc_slots = rpc_slots
+        self.tasks: Dict[tuple, asyncio.Task] = {}
+        self.failed: List[tuple] = []
+
+    def _slot(self, stage: str, chain: str) -> asyncio.Semaphore:
+        if RESOURCES[stage] == "cpu":
+            return self.cpu
+        url = self.provider.endpoint(chain).url
+        return self.rpc[urlsplit(url).hostname or url]
+
+    def _command(self, stage: str, chain: str) -> List[str]:
+        if stage == "traces":
+            return [sys.executable, SQLING, chain]
+        return [sys.executable, os.path.abspath(__file__), "stage", stage, chain]
+
+    async def _relay(self, stream: asyncio.StreamReader, prefix: str):
+        async for line in stream:
+            sys.stderr.write(f"{prefix} {line.decode(errors='replace')}")
+
+    async def _execute(self, stage: str, chain: str) -> bool:
+        env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+        proc = await asyncio.create_subprocess_exec(
+            *self._command(stage, chain),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+        )
+        await self._relay(proc.stdout, f"[{chain} {stage}]")
+        return await proc.wait() == 0
+
+    async def _run(self, stage: str, chain: str) -> bool:
+        deps = [self.tasks[(chain, d)] for d in DEPENDS[stage] if d in self.stages]
+        if not all(await asyncio.gather(*deps)):
+            logging.warning(f"Skipping {stage} of {chain}, a dependency failed!!!")
+            return False
+        if up_to_date(stage, chain, self.provider):
+            logging.info(f"{stage} of {chain} is up to date, skipping!!!")
+            return True
+        async with self._slot(stage, chain):
+            logging.info(f"Started {stage} of {chain}!!!")
+            ok = await self._execute(stage, chain)
+        if not ok:
+            logging.error(f"{stage} of {chain} failed!!!")
+            self.failed.append((chain, stage))
+            return False
+        if stage == "traces":
+            # sqling keeps no manifest of its own
+            mev = dataset.mev_files(chain)
+            Manifest().record("traces", chain, 0, 0, mev, [traces_file(chain)])
+        logging.info(f"Finished {stage} of {chain}!!!")
+        return True
+
+    async def run(self) -> List[tuple]:
+        # semaphores bind to the running loop on python 3.9
+        self.cpu = asyncio.Semaphore(self.cpu_slots)
+        self.rpc: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self.rpc_slots)
+        )
+        for chain in self.chains:
+            for stage in STAGES:
+                if stage in self.stages:
+                    self.tasks[(chain, stage)] = asyncio.ensure_future(
+                        self._run(stage, chain)
+                    )
+        await asyncio.gather(*self.tasks.values())
+        return self.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline stages of every chain as a dependency graph"
+    )
+    sub = parser.add_subparsers(dest="command")
+    stage = sub.add_parser("stage", help="run one stage of one chain")
+    stage.add_argument("stage", choices=[s for s in STAGES if s != "traces"])
+    stage.add_argument("chain", choices=list(CHAIN_IDS.keys()))
+    parser.add_argument("--chains", nargs="+", choices=list(CHAIN_IDS.keys()))
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=DEFAULT_STAGES)
+    args = parser.parse_args()
+    if args.command == "stage":
+        run_stage(args.stage, args.chain)
+        return
+    provider = Provider.generate()
+    chains = args.chains or [
+        c
+        for c in CHAIN_IDS
+        if getattr(provider, f"end_block_{c}") > getattr(provider, f"start_block_{c}")
+    ]
+    logging.info(f"Running {args.stages} for {chains}!!!")
+    scheduler = Scheduler(
+        provider,
+        chains,
+        args.stages,
+        provider.pipeline_cpu_slots,
+        provider.pipeline_rpc_slots,
+    )
+    failed = asyncio.run(scheduler.run())
+    if len(failed) > 0:
+        sys.exit(f"Failed stages: {failed}")
+    logging.info("All stages done!!!")
+
+
+if __name__ == "__main__":
+    main()
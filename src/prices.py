@@ -0,0 +1,289 @@
+import logging
+import os
+import sys
+from typing import List
+import polars as pl
+import period2
+from manifest import Manifest
+from metrics import METRICS, run_metrics
+from utils import Provider
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# profits are valued in these, directly or through a hub token's own price
+REFERENCE_SYMBOLS = ["USDC", "USDC.e", "USDbC", "USDT", "DAI"]
+HUB_SYMBOLS = ["WETH"]
+INDEX_KEY = ["pool_address", "block_number", "transaction_index", "log_index"]
+INDEX_SCHEMA = {
+    "pool_address": pl.Binary,
+    "block_number": pl.Int64,
+    "transaction_index": pl.Int64,
+    "log_index": pl.Int64,
+    "token0": pl.Binary,
+    "token1": pl.Binary,
+    "is_v3": pl.Boolean,
+    "price": pl.Float64,
+    "liquidity": pl.Float64,
+}
+
+
+def index_file(chain: str) -> str:
+    return f"{chain}_prices.parquet"
+
+
+def index_inputs(path: str, chain: str, low: int, high: int) -> List[str]:
+    return period2.window_inputs(path, low, high) + [
+        f"{chain}_pools.parquet",
+        f"{chain}_tokens.parquet",
+    ]
+
+
+def price_rows(swaps: pl.DataFrame) -> pl.DataFrame:
+    # price is token1 per whole token0 after the swap: the pool price for v3,
+    # the execution price for v2 whose Swap event carries no reserves
+    price = (
+        pl.when(pl.col("is_v3"))
+        .then(pl.col("price_after_swap"))
+        .otherwise(pl.col("execution_price"))
+    )
+    return (
+        swaps.select(
+            pl.col("pool_address"),
+            pl.col("block_number"),
+            pl.col("transaction_index"),
+            pl.col("log_index"),
+            pl.col("token0"),
+            pl.col("token1"),
+            pl.col("is_v3"),
+            price.alias("price"),
+            pl.col("liquidity"),
+        )
+        .filter(pl.col("price").is_finite() & (pl.col("price") > 0))
+        .select([pl.col(k).cast(v) for (k, v) in INDEX_SCHEMA.items()])
+    )
+
+
+def build_price_index(
+    path: str,
+    low: int,
+    high: int,
+    lookup: pl.DataFrame,
+    file_name: str,
+    memory_budget_mb: int,
+):
+    # same batches as the swaps windows, then one streaming sort into the index
+    parts = []
+    for n, (lo, hi) in enumerate(
+        period2.plan_batches(path, low, high, memory_budget_mb)
+    ):
+        with METRICS.stage("price_index") as stage:
+            df2 = period2.scan_swaps(path, "v2", lo, hi).collect()
+            df3 = period2.scan_swaps(path, "v3", lo, hi).collect()
+            rows = price_rows(period2.enrich_swaps(df2, df3, lookup))
+            stage.add(rows.shape[0])
+        part = f"{file_name}.part{n}"
+        rows.write_parquet(part)
+        parts.append(part)
+    tmp = f"{file_name}.tmp"
+    pl.scan_parquet(parts).sort(INDEX_KEY).sink_parquet(tmp)
+    os.replace(tmp, file_name)
+    for part in parts:
+        os.remove(part)
+
+
+def _last_per_block(df: pl.DataFrame, by: str, columns: List[str]) -> pl.DataFrame:
+    # state at the end of each block, sorted for join_asof
+    return (
+        df.sort(["block_number", "transaction_index", "log_index"])
+        .group_by([by, "block_number"], maintain_order=True)
+        .agg([pl.col(c).last() for c in columns])
+        .sort("block_number")
+    )
+
+
+def pool_state(index: pl.LazyFrame, queries: pl.DataFrame) -> pl.DataFrame:
+    # price and liquidity of each (pool_address, block_number) query as left by
+    # the last swap before that block; null before the pool's first swap
+    pools = queries["pool_address"].unique()
+    state = _last_per_block(
+        index.filter(pl.col("pool_address").is_in(pools)).collect(),
+        "pool_address",
+        ["price", "liquidity"],
+    )
+    return (
+        queries.with_row_index("row")
+        .with_columns(pl.col("block_number").cast(pl.Int64))
+        .sort("block_number")
+        .join_asof(
+            state,
+            on="block_number",
+            by="pool_address",
+            allow_exact_matches=False,
+        )
+        .sort("row")
+        .drop("row")
+    )
+
+
+def canonical_tokens(index: pl.LazyFrame, lookup: pl.DataFrame) -> pl.DataFrame:
+    # mev rows only name the profit token by symbol; a symbol is taken to mean
+    # its most swapped token, so look-alike tokens don't set its price
+    swaps = (
+        pl.concat(
+            [
+                index.select(pl.col("token0").alias("token")),
+                index.select(pl.col("token1").alias("token")),
+            ]
+        )
+        .group_by("token")
+        .agg(pl.len().alias("swaps"))
+        .collect()
+    )
+    symbols = pl.concat(
+        [
+            lookup.select(
+                pl.col(f"{side}").alias("token"),
+                pl.col(f"{side}_symbol").alias("symbol"),
+            )
+            for side in ("token0", "token1")
+        ]
+    ).unique("token")
+    return (
+        swaps.join(symbols, on="token")
+        .sort(["swaps", "token"], descending=[True, False])
+        .group_by("symbol", maintain_order=True)
+        .agg(pl.col("token").first())
+    )
+
+
+def token_prices(
+    index: pl.LazyFrame,
+    canonical: pl.DataFrame,
+    reference: List[str] = REFERENCE_SYMBOLS,
+    hubs: List[str] = HUB_SYMBOLS,
+) -> pl.DataFrame:
+    # reference-token price of every token at the end of each block it traded
+    # in, from its pools with a reference token or, failing that, a hub token
+    ref = canonical.filter(pl.col("symbol").is_in(reference))["token"]
+    hub = canonical.filter(pl.col("symbol").is_in(hubs))["token"]
+    key = [pl.col("block_number"), pl.col("transaction_index"), pl.col("log_index")]
+    legs = pl.concat(
+        [
+            index.select(
+                *key,
+                pl.col("token0").alias("token"),
+                pl.col("token1").alias("quote"),
+                pl.col("price"),
+            ),
+            index.select(
+                *key,
+                pl.col("token1").alias("token"),
+                pl.col("token0").alias("quote"),
+                (1.0 / pl.col("price")).alias("price"),
+            ),
+        ]
+    )
+    direct = legs.filter(pl.col("quote").is_in(ref)).collect()
+    hub_prices = _last_per_block(
+        direct.filter(pl.col("token").is_in(hub)), "token", ["price"]
+    ).rename({"token": "quote", "price": "quote_price"})
+    via_hub = (
+        legs.filter(pl.col("quote").is_in(hub) & ~pl.col("token").is_in(ref))
+        .collect()
+        .sort("block_number")
+        .join_asof(
+            hub_prices,
+            on="block_number",
+            by="quote",
+            allow_exact_matches=False,
+        )
+        .with_columns((pl.col("price") * pl.col("quote_price")).alias("price"))
+        .drop_nulls("price")
+    )
+    columns = ["token", "block_number", "transaction_index", "log_index", "price"]
+    return _last_per_block(
+        pl.concat([direct.select(columns), via_hub.select(columns)]),
+        "token",
+        ["price"],
+    )
+
+
+def value_mev(
+    mev: pl.DataFrame,
+    prices: pl.DataFrame,
+    canonical: pl.DataFrame,
+    reference: List[str] = REFERENCE_SYMBOLS,
+) -> pl.DataFrame:
+    # profit_usd: profit_amount at the profit token's price as of the end of
+    # the previous block, null where the token has no priced pool yet
+    tokens = canonical.rename({"symbol": "profit_token"})
+    return (
+        mev.with_row_index("row")
+        .join(tokens, on="profit_token", how="left")
+        .with_columns(pl.col("block_number").cast(pl.Int64))
+        .sort("block_number")
+        .join_asof(prices, on="block_number", by="token", allow_exact_matches=False)
+        .with_columns(
+            (
+                pl.col("profit_amount")
+                * pl.when(pl.col("profit_token").is_in(reference))
+                .then(1.0)
+                .otherwise(pl.col("price"))
+            ).alias("profit_usd")
+        )
+        .sort("row")
+        .drop("row", "token", "price")
+    )
+
+
+def value_chain_mev(chain: str, mev: pl.DataFrame) -> pl.DataFrame:
+    index = pl.scan_parquet(index_file(chain))
+    lookup = period2.build_pool_lookup(
+        pl.read_parquet(f"{chain}_tokens.parquet"),
+        pl.read_parquet(f"{chain}_pools.parquet"),
+    )
+    canonical = canonical_tokens(index, lookup)
+    with METRICS.stage("value_mev") as stage:
+        valued = value_mev(mev, token_prices(index, canonical), canonical)
+        stage.add(mev.shape[0])
+    METRICS.count("mev_unpriced", valued["profit_usd"].null_count())
+    return valued
+
+
+def process_chain(path: str, provider: Provider):
+    chain_name = path.split("/")[1]
+    low = getattr(provider, f"start_block_{chain_name}")
+    high = getattr(provider, f"end_block_{chain_name}")
+    inputs = index_inputs(path, chain_name, low, high)
+    file_name = index_file(chain_name)
+    manifest = Manifest()
+    if manifest.is_fresh("prices", chain_name, inputs):
+        logging.info(f"{file_name} is up to date, skipping!!!")
+        return
+    if len(period2.window_inputs(path, low, high)) == 0:
+        logging.warning(f"No logs for {chain_name} in {low}-{high}!!!")
+        return
+    lookup = period2.build_pool_lookup(
+        pl.read_parquet(f"{chain_name}_tokens.parquet"),
+        pl.read_parquet(f"{chain_name}_pools.parquet"),
+    )
+    build_price_index(path, low, high, lookup, file_name, provider.memory_budget_mb)
+    manifest.record("prices", chain_name, low, high, inputs, [file_name])
+    logging.info(f"Written {file_name}!!!")
+
+
+def main():
+    logging.info("Started Processing!!!")
+    provider = Provider.generate()
+    chains = sys.argv[1:] or ["arbitrum", "optimism"]
+    with run_metrics("prices", provider.profile):
+        for chain in chains:
+            logging.info(f"Processing {chain}!!!")
+            process_chain(f"./{chain}/{chain}", provider)
+            logging.info(f"Processing {chain} done!!!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import glob
+import os
+import time
+from typing import Dict, List, Set
+import polars as pl
+from utils import as_address_bytes
+
+CHAIN_IDS = {"arbitrum": 42161, "optimism": 10, "base": 8453}
+
+POOL_SCHEMA = {
+    "pool_address": pl.Binary,
+    "token0": pl.Binary,
+    "token1": pl.Binary,
+    "is_v3": pl.Boolean,
+}
+TOKEN_SCHEMA = {
+    "symbol": pl.String,
+    "decimal": pl.Int64,
+    "contract_address": pl.Binary,
+}
+FAILURE_SCHEMA = {"address": pl.Binary, "reason": pl.String}
+
+KEYS = {"pools": "pool_address", "tokens": "contract_address"}
+ADDRESS_COLUMNS = {
+    "pools": ["pool_address", "token0", "token1"],
+    "tokens": ["contract_address"],
+    "failures": ["address"],
+}
+SCHEMAS = {"pools": POOL_SCHEMA, "tokens": TOKEN_SCHEMA}
+
+
+class MetadataRegistry:
+    # append-only parquet segments under {chain}_registry/{pools,tokens,failures}/,
+    # one segment per run, keyed by (chain_id, address)
+    def __init__(self, chain: str, root: str = "."):
+        self.chain = chain
+        self.chain_id = CHAIN_IDS[chain]
+        self.root = os.path.join(root, f"{chain}_registry")
+
+    def _schema(self, kind: str) -> Dict[str, pl.DataType]:
+        if kind == "failures":
+            return {
+                "chain_id": pl.Int64,
+                "kind": pl.String,
+                **FAILURE_SCHEMA,
+                "failed_at": pl.Int64,
+            }
+        return {"chain_id": pl.Int64, **SCHEMAS[kind]}
+
+    def _scan(self, kind: str) -> pl.LazyFrame:
+        files = sorted(glob.glob(os.path.join(self.root, kind, "*.parquet")))
+        if len(files) == 0:
+            return pl.LazyFrame(schema=self._schema(kind))
+        segments = [
+            as_address_bytes(pl.scan_parquet(f), ADDRESS_COLUMNS[kind]) for f in files
+        ]
+        return pl.concat(segments).filter(pl.col("chain_id") == self.chain_id)
+
+    def _write(self, kind: str, df: pl.DataFrame):
+        if df.shape[0] == 0:
+            return
+        os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        segment = os.path.join(self.root, kind, f"{time.time_ns()}.parquet")
+        df.select(
+            [pl.col(k).cast(v) for (k, v) in self._schema(kind).items()]
+        ).write_parquet(segment)
+
+    def is_empty(self) -> bool:
+        return not os.path.isdir(self.root)
+
+    def pools(self) -> pl.DataFrame:
+        return self._entries("pools")
+
+    def tokens(self) -> pl.DataFrame:
+        return self._entries("tokens")
+
+    def failures(self) -> pl.DataFrame:
+        return self._scan("failures").collect()
+
+    def _entries(self, kind: str) -> pl.DataFrame:
+        return (
+            self._scan(kind)
+            .unique(["chain_id", KEYS[kind]], keep="first", maintain_order=True)
+            .select(list(SCHEMAS[kind].keys()))
+            .collect()
+        )
+
+    def seen(self, kind: str, retry_failed: bool = False) -> Set[bytes]:
+        seen = set(self._scan(kind).select(KEYS[kind]).collect()[KEYS[kind]].to_list())
+        if not retry_failed:
+            failed = (
+                self._scan("failures")
+                .filter(pl.col("kind") == kind)
+                .select("address")
+                .collect()["address"]
+            )
+            seen.update(failed.to_list())
+        return seen
+
+    def unseen(
+        self, kind: str, addresses: List[bytes], retry_failed: bool = False
+    ) -> List[bytes]:
+        seen = self.seen(kind, retry_failed)
+        return [x for x in addresses if x not in seen]
+
+    def append(self, kind: str, df: pl.DataFrame):
+        self._write(kind, df.with_columns(pl.lit(self.chain_id).alias("chain_id")))
+
+    def append_failures(self, kind: str, df: pl.DataFrame):
+        self._write(
+            "failures",
+            df.with_columns(
+                pl.lit(self.chain_id).alias("chain_id"),
+                pl.lit(kind).alias("kind"),
+                pl.lit(time.time_ns()).alias("failed_at"),
+            ),
+        )
+
+    def import_files(self, pools_file: str, tokens_file: str):
+        pools = pl.read_parquet(pools_file)
+        tokens = pl.read_parquet(tokens_file)
+        self.append("pools", as_address_bytes(pools, ADDRESS_COLUMNS["pools"]))
+        self.append("tokens", as_address_bytes(tokens, ADDRESS_COLUMNS["tokens"]))
+
+    def export(self, pools_file: str, tokens_file: str):
+        self.pools().write_parquet(pools_file)
+        self.tokens().write_parquet(tokens_file)
@@ -0,0 +1,124 @@
+import json
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+import polars as pl
+
+TRACE_CACHE_FILE = "traces.sqlite"
+TRACE_CACHE_MAX_MB = 20480
+
+EXPORT_SCHEMA = {"chain_id": pl.Int64, "tx_hash": pl.String, "trace": pl.Binary}
+
+
+class TraceCache:
+    # zlib-compressed callTracer results keyed by (chain_id, tx_hash), evicted
+    # least recently used first once the compressed total exceeds max_mb
+    def __init__(self, path: str = TRACE_CACHE_FILE, max_mb: int = TRACE_CACHE_MAX_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        # several chains may be traced at once by pipeline.py
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS traces ("
+            "chain_id INTEGER NOT NULL, tx_hash TEXT NOT NULL, trace BLOB NOT NULL, "
+            "size INTEGER NOT NULL, accessed_at INTEGER NOT NULL, "
+            "PRIMARY KEY (chain_id, tx_hash))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS traces_accessed ON traces (accessed_at)"
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def get_many(self, chain_id: int, tx_hashes: List[str]) -> Dict[str, Any]:
+        ret = {}
+        keys = [x.lower() for x in tx_hashes]
+        for i in range(0, len(keys), 500):
+            part = keys[i : i + 500]
+            rows = self.db.execute(
+                "SELECT tx_hash, trace FROM traces WHERE chain_id = ? AND tx_hash IN "
+                f"({','.join('?' * len(part))})",
+                [chain_id, *part],
+            ).fetchall()
+            for tx_hash, blob in rows:
+                ret[tx_hash] = json.loads(zlib.decompress(blob))
+        now = time.time_ns()
+        self.db.executemany(
+            "UPDATE traces SET accessed_at = ? WHERE chain_id = ? AND tx_hash = ?",
+            [(now, chain_id, x) for x in ret],
+        )
+        self.db.commit()
+        return {x: ret[x.lower()] for x in tx_hashes if x.lower() in ret}
+
+    def put_many(self, chain_id: int, traces: Dict[str, Any]):
+        now = time.time_ns()
+        rows = []
+        for tx_hash, trace in traces.items():
+            blob = zlib.compress(json.dumps(trace, separators=(",", ":")).encode())
+            rows.append((chain_id, tx_hash.lower(), blob, len(blob), now))
+        self._insert(rows)
+        self.evict()
+
+    def _insert(self, rows: List[tuple]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO traces VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self.db.commit()
+
+    def size(self) -> int:
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM traces"
+        ).fetchone()
+        return total
+
+    def evict(self) -> int:
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        victims = []
+        for rowid, size in self.db.execute(
+            "SELECT rowid, size FROM traces ORDER BY accessed_at"
+        ):
+            victims.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany("DELETE FROM traces WHERE rowid = ?", victims)
+        self.db.commit()
+        return len(victims)
+
+    def export(self, file: str, chain_id: Optional[int] = None):
+        # traces stay zlib-compressed json in the parquet file
+        query = "SELECT chain_id, tx_hash, trace FROM traces"
+        args = []
+        if chain_id is not None:
+            query += " WHERE chain_id = ?"
+            args.append(chain_id)
+        rows = self.db.execute(query, args).fetchall()
+        pl.DataFrame(rows, schema=EXPORT_SCHEMA, orient="row").write_parquet(file)
+
+    def import_file(self, file: str):
+        df = pl.read_parquet(file).select(list(EXPORT_SCHEMA.keys()))
+        now = time.time_ns()
+        self._insert(
+            [
+                (chain_id, tx_hash.lower(), blob, len(blob), now)
+                for (chain_id, tx_hash, blob) in df.iter_rows()
+            ]
+        )
+        self.evict()
+
+
+if __name__ == "__main__":
+    # traces.py export arbitrum_traces.parquet 42161 / traces.py import arbitrum_traces.parquet
+    if len(sys.argv) < 3 or sys.argv[1] not in ("export", "import"):
+        sys.exit("usage: traces.py export <file> [chain_id] | import <file>")
+    cache = TraceCache()
+    if sys.argv[1] == "export":
+        cache.export(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        cache.import_file(sys.argv[2])
+    cache.close()
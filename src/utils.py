@@ -1,6 +1,18 @@
+import aiohttp
+import asyncio
+import itertools
 import json
 import os
+import random
+import time
 from dataclasses import dataclass
+from typing import Any, List, TypeVar, Union
+from urllib.parse import urlsplit
+import polars as pl
+from web3 import Web3
+from metrics import METRICS, Progress
+
+FrameT = TypeVar("FrameT", pl.DataFrame, pl.LazyFrame)
 
 
 @dataclass
@@ -14,6 +26,22 @@ class Provider:
     end_block_base: int
     start_block_optimism: int
     end_block_optimism: int
+    max_in_flight_arbitrum: int = 16
+    max_in_flight_base: int = 16
+    max_in_flight_optimism: int = 16
+    rpc_batch_size: int = 100
+    memory_budget_mb: int = 4096
+    window_count: int = 50
+    workers: int = 0
+    exact_amounts: bool = False
+    profile: str = ""
+    log_chunk_blocks: int = 50_000
+    getlogs_block_range: int = 2_000
+    pipeline_cpu_slots: int = 1
+    pipeline_rpc_slots: int = 2
+    live_poll_seconds: float = 2.0
+    live_confirmations: int = 20
+    live_flush_blocks: int = 10_000
 
     @staticmethod
     def generate() -> "Provider":
@@ -30,4 +58,254 @@ class Provider:
             end_block_base=config["end_block_base"],
             start_block_optimism=config["start_block_optimism"],
             end_block_optimism=config["end_block_optimism"],
+            max_in_flight_arbitrum=config.get("max_in_flight_arbitrum", 16),
+            max_in_flight_base=config.get("max_in_flight_base", 16),
+            max_in_flight_optimism=config.get("max_in_flight_optimism", 16),
+            rpc_batch_size=config.get("rpc_batch_size", 100),
+            memory_budget_mb=config.get("memory_budget_mb", 4096),
+            window_count=config.get("window_count", 50),
+            workers=config.get("workers", 0),
+            exact_amounts=config.get("exact_amounts", False),
+            profile=config.get("profile", ""),
+            log_chunk_blocks=config.get("log_chunk_blocks", 50_000),
+            getlogs_block_range=config.get("getlogs_block_range", 2_000),
+            pipeline_cpu_slots=config.get("pipeline_cpu_slots", 1),
+            pipeline_rpc_slots=config.get("pipeline_rpc_slots", 2),
+            live_poll_seconds=config.get("live_poll_seconds", 2.0),
+            live_confirmations=config.get("live_confirmations", 20),
+            live_flush_blocks=config.get("live_flush_blocks", 10_000),
+        )
+
+    def endpoint(self, chain: str) -> "RpcEndpoint":
+        return RpcEndpoint(
+            url=getattr(self, f"{chain}_rpc"),
+            max_in_flight=getattr(self, f"max_in_flight_{chain}"),
+            batch_size=self.rpc_batch_size,
+        )
+
+
+@dataclass
+class RpcEndpoint:
+    url: str
+    max_in_flight: int = 16
+    batch_size: int = 100
+    max_retries: int = 6
+    backoff: float = 0.5
+    timeout: float = 120.0
+
+
+class RpcError(Exception):
+    pass
+
+
+class AsyncRpcClient:
+    def __init__(self, endpoint: RpcEndpoint):
+        self.endpoint = endpoint
+        self._ids = itertools.count()
+        self._session = None
+        self._in_flight = None
+        # host only, so api keys in the url path stay out of the metrics
+        self._label = urlsplit(endpoint.url).hostname or endpoint.url
+
+    async def __aenter__(self) -> "AsyncRpcClient":
+        self._in_flight = asyncio.Semaphore(self.endpoint.max_in_flight)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.endpoint.max_in_flight, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.endpoint.timeout),
         )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _post(self, payload: Union[dict, list]) -> Any:
+        if isinstance(payload, dict):
+            (method, calls) = (payload["method"], 1)
+        else:
+            (method, calls) = (f"{payload[0]['method']}[batch]", len(payload))
+        delay = self.endpoint.backoff
+        for attempt in range(self.endpoint.max_retries + 1):
+            async with self._in_flight:
+                start = time.perf_counter()
+                try:
+                    async with self._session.post(
+                        self.endpoint.url, json=payload
+                    ) as response:
+                        if response.status == 429 or response.status >= 500:
+                            error = RpcError(f"HTTP {response.status}")
+                            retry_after = response.headers.get("Retry-After", "")
+                            if retry_after.isdigit():
+                                delay = max(delay, float(retry_after))
+                        elif response.status >= 400:
+                            METRICS.rpc_error(self._label, method)
+                            raise RpcError(f"HTTP {response.status}")
+                        else:
+                            ret = await response.json(content_type=None)
+                            METRICS.rpc_call(
+                                self._label,
+                                method,
+                                time.perf_counter() - start,
+                                calls,
+                            )
+                            return ret
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # connection drops, truncated bodies and the like
+                    error = RpcError(f"{type(e).__name__}: {e}")
+                except ValueError as e:
+                    METRICS.rpc_error(self._label, method)
+                    raise RpcError(f"Invalid response: {e}")
+            METRICS.rpc_error(self._label, method)
+            if attempt == self.endpoint.max_retries:
+                raise error
+            await asyncio.sleep(delay * (1 + random.random()))
+            delay = delay * 2
+
+    def _payload(self, method: str, params: list) -> dict:
+        return {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": next(self._ids),
+        }
+
+    @staticmethod
+    def _unwrap(response: dict) -> Any:
+        if response is None:
+            return RpcError("missing response")
+        if "error" in response:
+            return RpcError(response["error"])
+        return response.get("result")
+
+    async def request(self, method: str, params: list) -> Any:
+        result = self._unwrap(await self._post(self._payload(method, params)))
+        if isinstance(result, RpcError):
+            METRICS.rpc_error(self._label, method)
+            raise result
+        return result
+
+    async def batch(self, calls: List[tuple[str, list]]) -> List[Any]:
+        # failed calls come back as RpcError instances in their slot
+        if len(calls) == 0:
+            return []
+        payload = [self._payload(method, params) for (method, params) in calls]
+        responses = await self._post(payload)
+        if not isinstance(responses, list):
+            raise RpcError(responses.get("error", responses))
+        by_id = {r.get("id"): r for r in responses}
+        results = [self._unwrap(by_id.get(p["id"])) for p in payload]
+        for (method, _), result in zip(calls, results):
+            if isinstance(result, RpcError):
+                METRICS.rpc_error(self._label, method)
+        return results
+
+    async def map(self, calls: List[tuple[str, list]]) -> List[Any]:
+        size = self.endpoint.batch_size
+        chunks = [calls[i : i + size] for i in range(0, len(calls), size)]
+        progress = Progress(f"{calls[0][0] if calls else 'rpc'} calls", len(calls))
+        results = await asyncio.gather(
+            *[self._batch_or_fail(c, progress) for c in chunks]
+        )
+        return [x for chunk in results for x in chunk]
+
+    async def _batch_or_fail(
+        self, calls: List[tuple[str, list]], progress: Progress
+    ) -> List[Any]:
+        try:
+            ret = await self.batch(calls)
+        except RpcError as e:
+            ret = [e] * len(calls)
+        progress.update(len(calls))
+        return ret
+
+
+def rpc_map(endpoint: RpcEndpoint, calls: List[tuple[str, list]]) -> List[Any]:
+    async def run():
+        async with AsyncRpcClient(endpoint) as client:
+            return await client.map(calls)
+
+    return asyncio.run(run())
+
+
+def hex_address(column: str) -> pl.Expr:
+    return (pl.lit("0x") + pl.col(column).bin.encode("hex")).alias(column)
+
+
+def _hex_to_bytes(hex: pl.Expr) -> pl.Expr:
+    return hex.str.to_lowercase().str.strip_prefix("0x").str.decode("hex")
+
+
+def address_bytes(column: str) -> pl.Expr:
+    # addresses are 20-byte binary everywhere except at the presentation edge
+    return _hex_to_bytes(pl.col(column)).alias(column)
+
+
+def as_address_bytes(df: FrameT, columns: List[str]) -> FrameT:
+    # files written before addresses were stored as binary hold hex strings,
+    # or lists of them
+    schema = df.collect_schema()
+    return df.with_columns(
+        [address_bytes(c) for c in columns if schema[c] == pl.String]
+        + [
+            pl.col(c).list.eval(_hex_to_bytes(pl.element()))
+            for c in columns
+            if schema[c] == pl.List(pl.String)
+        ]
+    )
+
+
+def to_address_bytes(address: str) -> bytes:
+    return bytes.fromhex(address[2:] if address[:2] in ("0x", "0X") else address)
+
+
+class AddressSet:
+    # sorted, concatenated 20-byte addresses; one bytes object, so forked
+    # workers share its pages and membership is a binary search
+    def __init__(self, blob: bytes = b""):
+        self.blob = blob
+        self.size = len(blob) // 20
+
+    @staticmethod
+    def from_series(addresses: pl.Series) -> "AddressSet":
+        if addresses.dtype == pl.String:
+            addresses = addresses.to_frame().select(address_bytes(addresses.name))
+            addresses = addresses.to_series()
+        raw = addresses.drop_nulls().unique().sort()
+        return AddressSet(b"".join(raw.to_list()))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, address: Union[str, bytes]) -> bool:
+        if isinstance(address, str):
+            try:
+                address = to_address_bytes(address)
+            except ValueError:
+                return False
+        (lo, hi) = (0, self.size)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blob[mid * 20 : mid * 20 + 20] < address:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.size and self.blob[lo * 20 : lo * 20 + 20] == address
+
+
+def checksum_column(df: pl.DataFrame, column: str) -> pl.DataFrame:
+    # keccak once per distinct address instead of once per row; takes binary or
+    # hex addresses, lists of them are formatted element-wise
+    is_list = isinstance(df.schema[column], pl.List)
+    values = df[column].explode() if is_list else df[column]
+    distinct = values.drop_nulls().unique().to_list()
+    checksummed = [Web3.to_checksum_address(x) for x in distinct]
+    if len(distinct) == 0:
+        distinct = pl.Series([], dtype=values.dtype)
+    mapping = pl.element() if is_list else pl.col(column)
+    mapping = mapping.replace_strict(
+        distinct, checksummed, default=None, return_dtype=pl.String
+    )
+    if is_list:
+        return df.with_columns(pl.col(column).list.eval(mapping))
+    return df.with_columns(mapping)
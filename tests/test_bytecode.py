@@ -0,0 +1,37 @@
+import polars as pl
+import bytecode
+from bytecode import BytecodeStore, fetch_code_hashes
+
+EOA = b"\x01" * 20
+CONTRACT = b"\x02" * 20
+
+
+def _fetch(store, monkeypatch, blocks):
+    calls = []
+
+    def rpc_map(endpoint, batch):
+        calls.extend(batch)
+        return ["0x" if p[0] == "0x" + EOA.hex() else "0x6080" for (_, p) in batch]
+
+    monkeypatch.setattr(bytecode, "rpc_map", rpc_map)
+    ret = fetch_code_hashes(store, "arbitrum", [EOA, CONTRACT], blocks, None)
+    return (ret, calls)
+
+
+def test_fetch_code_hashes_reuses_store(tmp_path, monkeypatch):
+    store = BytecodeStore(str(tmp_path / "store"))
+    (ret, calls) = _fetch(store, monkeypatch, [100, 100])
+    assert len(calls) == 2
+    assert ret["code_size"].to_list() == [0, 2]
+    # same blocks again: nothing to fetch, nothing appended
+    (ret, calls) = _fetch(store, monkeypatch, [100, 100])
+    assert calls == []
+    assert store.addresses("arbitrum").shape[0] == 2
+    # later blocks: contract code is reused, the EOA may have been deployed to
+    (ret, calls) = _fetch(store, monkeypatch, [200, 200])
+    assert [p[0] for (_, p) in calls] == ["0x" + EOA.hex()]
+    assert ret.columns == ["address", "block_number", "code_hash", "code_size"]
+    # earlier blocks have nothing stored at or before them
+    (ret, calls) = _fetch(store, monkeypatch, [50, 50])
+    assert len(calls) == 2
+    assert ret.filter(pl.col("code_hash").is_null()).shape[0] == 0
@@ -0,0 +1,109 @@
+import polars as pl
+import pytest
+import period2
+from bench import SyntheticChain
+
+
+def _swaps(seed: int, symbols, decimals) -> pl.DataFrame:
+    data = SyntheticChain(seed, 40, 120, senders=20)
+    data.generate(3000, 0.3)
+    tokens = pl.DataFrame(
+        {
+            "symbol": [symbols(i) for i in range(len(data.tokens))],
+            "decimal": [decimals(i, d) for (i, d) in enumerate(data.decimals)],
+            "contract_address": data.tokens,
+        },
+        schema={
+            "symbol": pl.String,
+            "decimal": pl.Int64,
+            "contract_address": pl.Binary,
+        },
+    )
+    pools = pl.DataFrame(
+        {
+            "pool_address": [p[0] for p in data.pools],
+            "token0": [data.tokens[p[1]] for p in data.pools],
+            "token1": [data.tokens[p[2]] for p in data.pools],
+        }
+    )
+    lookup = period2.build_pool_lookup(tokens, pools)
+    (df2, df3) = (
+        pl.DataFrame(rows)
+        .with_columns(
+            pl.col("block_number", "transaction_index", "log_index").cast(pl.UInt32)
+        )
+        .unique(period2.LOG_KEY, keep="first", maintain_order=True)
+        for rows in (data.v2, data.v3)
+    )
+    return period2.enrich_swaps(df2, df3, lookup)
+
+
+@pytest.mark.parametrize(
+    "symbols,decimals",
+    [
+        (lambda i: f"TKN{i}", lambda i, d: d),
+        # look-alike tokens share a symbol, with or without the same decimals
+        (lambda i: f"TKN{i % 7}", lambda i, d: d),
+        (lambda i: f"TKN{i % 5}", lambda i, d: 18 if i % 2 else 6),
+        # tokens whose symbol or decimals could not be read
+        (lambda i: None if i % 6 == 0 else f"TKN{i}", lambda i, d: d),
+        (lambda i: f"TKN{i}", lambda i, d: None if i % 9 == 0 else d),
+    ],
+)
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_detect_arbitrage_matches_analyze(seed, symbols, decimals):
+    swaps = _swaps(seed, symbols, decimals)
+    expected = period2.analyze_reference(swaps)
+    assert expected.shape[0] > 0
+    period2.check_detection(swaps)
+
+
+def _exact_swaps(swaps) -> pl.DataFrame:
+    # (tx, (symbol, decimals, pool delta), (symbol, decimals, pool delta))
+    rows = [
+        {
+            "tx": tx,
+            "step": step,
+            "token0_symbol": t0[0],
+            "token0_decimals": t0[1],
+            "pool_delta_t0_raw": str(t0[2]),
+            "token1_symbol": t1[0],
+            "token1_decimals": t1[1],
+            "pool_delta_t1_raw": str(t1[2]),
+        }
+        for (step, (tx, t0, t1)) in enumerate(swaps)
+    ]
+    return pl.DataFrame(rows).with_columns(
+        pl.col("pool_delta_t0_raw", "pool_delta_t1_raw").cast(period2.EXACT_AMOUNT)
+    )
+
+
+def test_exact_profits_lookalike_decimals():
+    df = _exact_swaps(
+        [
+            # 18- and 6-decimal USDC look-alikes, near 10**30 at 18 decimals
+            (0, ("USDC", 18, 10**30 + 7), ("WETH", 18, -(5 * 10**20))),
+            (0, ("WETH", 18, 5 * 10**20), ("USDC", 6, -(10**18 + 3))),
+            # 0 and 20 decimals: the rescale is past what an Int64 power holds
+            (1, ("A", 0, 5), ("WETH", 18, -1)),
+            (1, ("WETH", 18, 1), ("A", 20, -(5 * 10**20 + 1))),
+            # 10**33 at 6 decimals is 10**45 at 18
+            (2, ("USDC", 18, 10**30), ("WETH", 18, -1)),
+            (2, ("WETH", 18, 1), ("USDC", 6, -(10**33))),
+            # each leg fits, their sum does not
+            (3, ("WETH", 18, 1), ("B", 18, -(6 * 10**37))),
+            (3, ("WETH", 18, 1), ("B", 18, -(6 * 10**37))),
+            (3, ("B", 18, 10**37), ("WETH", 18, -2)),
+            # opposite legs that cancel in any order are kept
+            (4, ("B", 18, 6 * 10**37), ("WETH", 18, -1)),
+            (4, ("WETH", 18, 1), ("B", 18, -(6 * 10**37 + 9))),
+        ]
+    )
+    profits = period2._exact_profits(df)
+    assert profits["tx"].to_list() == [0, 1, 4]
+    assert profits["profit_token"].to_list() == ["USDC", "A", "B"]
+    assert profits["profit_amount"].to_list() == [
+        (3 * 10**12 - 7) / 1e18,
+        1 / 1e20,
+        9 / 1e18,
+    ]
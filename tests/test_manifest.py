@@ -0,0 +1,67 @@
+import os
+from manifest import Manifest, merge_ranges, subtract_ranges
+
+
+def _touch(path: str, content: bytes = b"x") -> str:
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_subtract_ranges_partial_overlap():
+    covered = [(120, 180), (150, 220), (300, 400)]
+    assert merge_ranges(covered) == [(120, 220), (300, 400)]
+    assert subtract_ranges(100, 350, covered) == [(100, 120), (220, 300)]
+    assert subtract_ranges(130, 200, covered) == []
+
+
+def test_missing_partial_overlap(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.record("swaps", "arbitrum", 100, 200, [], [])
+    manifest.record("swaps", "arbitrum", 250, 300, [], [])
+    # other stages and chains don't count
+    manifest.record("swaps", "optimism", 200, 250, [], [])
+    manifest.record("prices", "arbitrum", 200, 250, [], [])
+    assert manifest.missing("swaps", "arbitrum", 150, 350) == [(200, 250), (300, 350)]
+    assert manifest.missing("swaps", "arbitrum", 0, 100) == [(0, 100)]
+    assert Manifest(manifest.path).missing("swaps", "arbitrum", 100, 200) == []
+
+
+def test_drop_stale_fingerprint(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    inputs = {
+        (0, 100): [_touch(str(tmp_path / "a.parquet"))],
+        (100, 200): [_touch(str(tmp_path / "b.parquet"))],
+    }
+    for (low, high), files in inputs.items():
+        out = _touch(str(tmp_path / f"out_{low}.parquet"))
+        manifest.record("swaps", "arbitrum", low, high, files, [out])
+    _touch(str(tmp_path / "b.parquet"), b"changed")
+    stale = manifest.drop_stale("swaps", "arbitrum", lambda lo, hi: inputs[(lo, hi)])
+    assert [(e["low"], e["high"]) for e in stale] == [(100, 200)]
+    assert not os.path.exists(tmp_path / "out_100.parquet")
+    assert os.path.exists(tmp_path / "out_0.parquet")
+    reloaded = Manifest(manifest.path)
+    assert reloaded.missing("swaps", "arbitrum", 0, 200) == [(100, 200)]
+    assert reloaded.is_complete(
+        "swaps", "arbitrum", 0, 100, lambda lo, hi: inputs[(lo, hi)]
+    )
+
+
+def test_merge_adjacent_ranges(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    files = [_touch(str(tmp_path / f"in_{n}.parquet")) for n in range(2)]
+    outputs = [_touch(str(tmp_path / f"part_{n}.parquet")) for n in range(2)]
+    manifest.record("swaps", "arbitrum", 0, 100, [files[0]], [outputs[0]])
+    manifest.record("swaps", "arbitrum", 100, 250, [files[1]], [outputs[1]])
+    merged_file = _touch(str(tmp_path / "merged.parquet"))
+    entry = manifest.merge(manifest.entries_for("swaps", "arbitrum"), [merged_file])
+    assert (entry["low"], entry["high"]) == (0, 250)
+    assert sorted(entry["inputs"]) == sorted(files)
+    assert not any(os.path.exists(f) for f in outputs)
+    assert os.path.exists(merged_file)
+    reloaded = Manifest(manifest.path)
+    assert [(e["low"], e["high"]) for e in reloaded.entries] == [(0, 250)]
+    assert reloaded.is_complete(
+        "swaps", "arbitrum", 0, 250, lambda lo, hi: files if hi > 100 else files[:1]
+    )
@@ -0,0 +1,133 @@
+import random
+import polars as pl
+import sqling
+from sqling import FUNCTION_MAP, main2
+from utils import AddressSet
+
+ADDRESSES = ["0x" + bytes([i]).hex() * 20 for i in range(1, 9)]
+POOL = ADDRESSES[0]
+
+
+def _flatten_data(y):
+    # the recursive walker main2 used before walk_calls
+    out = {}
+
+    def flatten(x, name=""):
+        if type(x) is dict:
+            for a in x:
+                flatten(x[a], name + a + "_")
+        elif type(x) is list:
+            for i, a in enumerate(x):
+                flatten(a, name + str(i) + "_")
+        else:
+            out[name[:-1]] = x
+
+    flatten(y)
+    return out
+
+
+def _old_main2(tx_hash, trace, adig):
+    d = _flatten_data({"result": trace})
+    sigs = dict()
+    for x in d.keys():
+        if "input" in x:
+            sel = d[x][:10]
+            for a in (d[x[:-5] + "from"], d[x[:-5] + "to"]):
+                sigs.setdefault(a, set()).add(sel)
+    # the old loop called None.lower() on calls without a "to"; skip those
+    known = set(FUNCTION_MAP)
+    ignore = set(x.lower() for x in sigs if x is not None and sigs[x] <= known)
+    ignore = ignore.union(adig)
+    filtered_out = set()
+    for x in d.keys():
+        if x[-3:] == "_to":
+            ff = x[:-3] + "_from"
+            if d[ff] is None or d[x] is None:
+                continue
+            if len({d[ff].lower(), d[x].lower()} & ignore) == 0:
+                filtered_out.add(x[:-3])
+    return [
+        {
+            "tx_hash": tx_hash,
+            "flattened_trace": x,
+            "to": d[x + "_to"],
+            "from": d[x + "_from"],
+            "function_selector": d[x + "_input"][:10],
+            "gas_used": int(d[x + "_gasUsed"], 16),
+        }
+        for x in filtered_out
+    ]
+
+
+def _call(rng, depth):
+    selectors = list(FUNCTION_MAP) + ["0x12345678", "0xdeadbeef"]
+    call = {
+        "type": rng.choice(["CALL", "STATICCALL", "DELEGATECALL"]),
+        "from": rng.choice(ADDRESSES),
+        "to": rng.choice(ADDRESSES + [None]),
+        "input": rng.choice(selectors) + "00" * rng.randrange(3),
+        "gasUsed": hex(rng.randrange(1, 10**6)),
+        "value": "0x0",
+    }
+    if depth < 4 and rng.random() < 0.7:
+        call["calls"] = [_call(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return call
+
+
+def _rows(rows):
+    keys = ["flattened_trace", "to", "from", "function_selector", "gas_used"]
+    return sorted(tuple(r[k] for k in keys) for r in rows)
+
+
+def test_walk_calls_matches_flatten_data(monkeypatch):
+    pools = AddressSet.from_series(pl.Series([POOL]))
+    monkeypatch.setattr(sqling, "IGNORE", pools)
+    rng = random.Random(7)
+    for i in range(200):
+        trace = _call(rng, 0)
+        new = main2(f"0x{i:064x}", trace)
+        assert _rows(new) == _rows(_old_main2(f"0x{i:064x}", trace, {POOL}))
+        assert all(r["depth"] == r["flattened_trace"].count("_calls_") for r in new)
+
+
+def test_walk_calls_order_and_paths():
+    trace = {
+        "type": "CALL",
+        "from": ADDRESSES[1],
+        "to": ADDRESSES[2],
+        "input": "0xdeadbeef",
+        "gasUsed": "0x10",
+        "calls": [
+            {
+                "type": "CALL",
+                "from": ADDRESSES[2],
+                "to": ADDRESSES[3],
+                "input": "0x12345678",
+                "gasUsed": "0x8",
+                "calls": [
+                    {
+                        "type": "STATICCALL",
+                        "from": ADDRESSES[3],
+                        "to": ADDRESSES[4],
+                        "input": "0x12345678",
+                        "gasUsed": "0x1",
+                    }
+                ],
+            },
+            {
+                "type": "CALL",
+                "from": ADDRESSES[2],
+                "to": ADDRESSES[5],
+                "input": "0x12345678",
+                "gasUsed": "0x4",
+            },
+        ],
+    }
+    (frames, selectors) = sqling.walk_calls(trace)
+    assert [(p, d) for (p, d, _) in frames] == [
+        ("result", 0),
+        ("result_calls_0", 1),
+        ("result_calls_0_calls_0", 2),
+        ("result_calls_1", 1),
+    ]
+    assert selectors[ADDRESSES[2]] == {"0xdeadbeef", "0x12345678"}
@@ -0,0 +1,43 @@
+import itertools
+import os
+import traces
+from traces import TraceCache
+
+
+def _trace(i: int) -> dict:
+    # random input so every entry compresses to about the same size
+    return {"type": "CALL", "gasUsed": hex(i), "input": "0x" + os.urandom(1000).hex()}
+
+
+def test_round_trip(tmp_path):
+    cache = TraceCache(str(tmp_path / "traces.sqlite"))
+    trace = {"type": "CALL", "to": "0xAb", "calls": [{"input": "0x", "value": None}]}
+    cache.put_many(42161, {"0xABC": trace})
+    assert cache.get_many(42161, ["0xabc", "0xABC", "0xdef"]) == {
+        "0xabc": trace,
+        "0xABC": trace,
+    }
+    assert cache.get_many(10, ["0xabc"]) == {}
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(traces.time, "time_ns", lambda: next(clock))
+    hashes = [f"0x{i:064x}" for i in range(5)]
+    path = str(tmp_path / "traces.sqlite")
+    cache = TraceCache(path)
+    cache.put_many(1, {hashes[0]: _trace(0)})
+    entry = cache.size()
+    cache.close()
+    # room for three entries and a bit
+    cache = TraceCache(path, max_mb=(3.5 * entry) / (1024 * 1024))
+    cache.put_many(1, {hashes[1]: _trace(1)})
+    cache.put_many(1, {hashes[2]: _trace(2)})
+    # reading the oldest entry makes it the most recently used
+    assert list(cache.get_many(1, [hashes[0]])) == [hashes[0]]
+    cache.put_many(1, {hashes[3]: _trace(3)})
+    cache.put_many(1, {hashes[4]: _trace(4)})
+    assert sorted(cache.get_many(1, hashes)) == [hashes[0], hashes[3], hashes[4]]
+    assert cache.size() <= cache.max_bytes
+    cache.close()
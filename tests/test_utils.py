@@ -0,0 +1,36 @@
+import polars as pl
+from utils import AddressSet
+
+FIRST = "0x" + "00" * 19 + "01"
+MIDDLE = "0x7F" + "ab" * 19
+LAST = "0x" + "ff" * 20
+
+
+def test_address_set_membership():
+    addresses = AddressSet.from_series(pl.Series([LAST, MIDDLE, None, FIRST, LAST]))
+    assert len(addresses) == 3
+    for address in (FIRST, MIDDLE, LAST):
+        assert address in addresses
+        assert address.lower() in addresses
+        assert bytes.fromhex(address[2:]) in addresses
+    assert "0x" + "00" * 20 not in addresses
+    assert "0x" + "7f" * 20 not in addresses
+    assert "0x" + "ff" * 19 + "fe" not in addresses
+    assert "not an address" not in addresses
+
+
+def test_address_set_from_binary():
+    raw = pl.Series([bytes.fromhex(LAST[2:]), bytes.fromhex(FIRST[2:])])
+    addresses = AddressSet.from_series(raw)
+    assert FIRST in addresses and LAST in addresses
+    assert MIDDLE not in addresses
+
+
+def test_empty_address_set():
+    for addresses in (
+        AddressSet(),
+        AddressSet.from_series(pl.Series([], dtype=pl.String)),
+    ):
+        assert len(addresses) == 0
+        assert FIRST not in addresses
+        assert b"\x00" * 20 not in addresses